@@ -1,19 +1,32 @@
 import os
-import glob
 import subprocess
 import numpy as np
-import shutil
-import time
+from concurrent.futures import ProcessPoolExecutor
+from fortran_io import read_record, create_record
+from job_monitor import SlurmScheduler, wait_for_jobs, SUCCESS_STATE
+from optimizer import LBFGS
+from event_manifest import EventManifest
+from model_staging import ModelStager
+from telemetry import measure_stage, record
+from smoothing import smooth_kernels
+from misfit_store import load_misfits, MISFIT_DB
+
+def parse_job_ids(stdout):
+    """
+    Job IDs from the "Submitted batch job <id> [for <event>]" lines of a submission script.
+    """
+    return [line.split()[3] for line in stdout.splitlines() if line.startswith("Submitted batch job")]
 
-def run_simulation(script_path='forward_specfem_all_synmodel.sh'):
+def run_simulation(script_path='forward_specfem_all_synmodel.sh', event_dirs=None):
     """
-    Run the bash script to start the simulations and capture job IDs.
+    Run the bash script to start the simulations of event_dirs (default: the
+    enabled events of the event manifest) and capture job IDs, one per event in order.
     """
     print("Starting the simulations with the bash script...")
-    result = subprocess.run(['bash', script_path], capture_output=True, text=True)
+    result = subprocess.run(['bash', script_path] + list(event_dirs or []), capture_output=True, text=True)
     if result.returncode == 0:
         print("Simulations initiated successfully.")
-        job_ids = [line.split()[-1] for line in result.stdout.splitlines() if "Submitted batch job" in line]
+        job_ids = parse_job_ids(result.stdout)
         print("Submitted Job IDs:", job_ids)
         return job_ids
     else:
@@ -21,71 +34,57 @@ def run_simulation(script_path='forward_specfem_all_synmodel.sh'):
         print(result.stderr)
         return []
 
-def check_job_status(job_ids):
-    """
-    Check the status of jobs by their job IDs using squeue.
+def check_simulation_status(event_dirs, job_ids, success_file='SUCCESS', check_interval=10, scheduler=None,
+                            on_event_done=None, on_event_failed=None):
     """
-    job_status = {}
-    result = subprocess.run(['squeue', '--jobs', ','.join(job_ids), '--format=%A %T', '--noheader'], 
-                            capture_output=True, text=True)
-    for line in result.stdout.splitlines():
-        job_id, status = line.split()
-        job_status[job_id] = status
-    return job_status
-
-def check_simulation_status(event_dirs, job_ids, success_file='SUCCESS', check_interval=10):
-    """
-    Monitor the status of multiple simulations until all are complete or failed.
-    """
-    while True:
-        all_completed = True
-        job_status = check_job_status(job_ids)
-        
-        # Print job status and check for completion
-        for job_id, status in job_status.items():
-            print(f"Job {job_id} Status: {status}")
-            if status in ['PENDING', 'RUNNING']:
-                all_completed = False
-
-        # Check for SUCCESS files in each event directory
-        for event in event_dirs:
-            event_status_file = os.path.join(event, success_file)
-            if os.path.exists(event_status_file):
-                print(f"{event}: SUCCESS")
-            else:
-                print(f"{event}: INCOMPLETE OR FAILED")
-                all_completed = False
+    Monitor the jobs of multiple simulations until all are complete or failed.
 
-        if all_completed:
-            print("All simulations completed successfully!")
-            break
-
-        print(f"Checking again in {check_interval} seconds...\n")
-        time.sleep(check_interval)
-
-def run_create_adjoint_sources(iteration):
+    The i-th job is taken to be the simulation of the i-th event, as submitted by
+    the forward and adjoint scripts. An event succeeds when its job COMPLETED and
+    wrote <event>/<success_file>. on_event_done(event, job) / on_event_failed(event, job)
+    fire as soon as that event's job finishes. Returns the final state per event.
     """
-    Run the create_adjoint_sources.sh script with the current iteration number.
+    if len(job_ids) == len(event_dirs):
+        jobs = [(job_id, event, os.path.join(event, success_file)) for job_id, event in zip(job_ids, event_dirs)]
+    else:
+        print(f"Warning: {len(job_ids)} jobs for {len(event_dirs)} events; tracking the jobs without SUCCESS files")
+        jobs = [(job_id, job_id, None) for job_id in job_ids]
+    states = wait_for_jobs(jobs, scheduler, on_event_done, on_event_failed, min_interval=check_interval)
+    if all(state == SUCCESS_STATE for state in states.values()):
+        print("All simulations completed successfully!")
+    return states
+
+def run_create_adjoint_sources(iteration, event_dirs=None):
+    """
+    Run the create_adjoint_sources.sh script with the current iteration number
+    for event_dirs (default: the enabled events of the event manifest).
     """
     print(f"Running create_adjoint_sources.sh for iteration {iteration}...")
-    result = subprocess.run(['bash', 'create_adjoint_sources.sh', str(iteration)], capture_output=True, text=True)
+    result = subprocess.run(['bash', 'create_adjoint_sources.sh', str(iteration)] + list(event_dirs or []),
+                            capture_output=True, text=True)
     if result.returncode == 0:
         print("Adjoint sources created successfully.")
     else:
         print("Error running create_adjoint_sources.sh:")
         print(result.stderr)
 
-def calculate_misfit(iteration):
+def calculate_misfit(iteration, event_dirs=None, manifest=None, misfit_db=MISFIT_DB):
     """
-    Calculate the total misfit for the given iteration by summing misfits from all events.
+    Calculate the total misfit for the given iteration by summing the misfits of
+    event_dirs (default: the enabled events of the event manifest), each times
+    its weight in the manifest.
+
+    The misfits are read from the misfit store; events it does not hold yet
+    are imported from their REF_SEM_<iteration>/misfit.txt.
     """
+    manifest = manifest or EventManifest()
+    event_dirs = event_dirs or manifest.events()
+    misfits = load_misfits(iteration, event_dirs, misfit_db)
     total_misfit = 0
-    for event in glob.glob('EVENT*'):
-        misfit_file = os.path.join(event, f'REF_SEM_{iteration}', 'misfit.txt')
-        if os.path.exists(misfit_file):
-            misfit = np.loadtxt(misfit_file)
-            total_misfit += misfit
-            print(f"Misfit for {event}: {misfit}")
+    for event in event_dirs:
+        if event in misfits:
+            total_misfit += manifest.weight(event) * misfits[event]
+            print(f"Misfit for {event}: {misfits[event]} (weight {manifest.weight(event)})")
         else:
             print(f"Warning: Misfit file not found for {event}")
     print(f"Total misfit for iteration {iteration}: {total_misfit}")
@@ -110,15 +109,17 @@ def compare_misfits(prev_misfit, current_misfit, threshold=0.005):
     return stop
 
 
-def run_adjoint_simulations():
+def run_adjoint_simulations(event_dirs=None):
     """
-    Run the adjoint_specfem_all_adjoint.sh script to submit adjoint simulations and capture job IDs.
+    Run the adjoint_specfem_all_adjoint.sh script to submit adjoint simulations of
+    event_dirs (default: the enabled events of the event manifest) and capture job IDs.
     """
     print("Submitting adjoint simulations...")
-    result = subprocess.run(['bash', 'adjoint_specfem_all_adjoint.sh'], capture_output=True, text=True)
+    result = subprocess.run(['bash', 'adjoint_specfem_all_adjoint.sh'] + list(event_dirs or []),
+                            capture_output=True, text=True)
     if result.returncode == 0:
         print("Adjoint simulations submitted successfully.")
-        adjoint_job_ids = [line.split()[-1] for line in result.stdout.splitlines() if "Submitted batch job" in line]
+        adjoint_job_ids = parse_job_ids(result.stdout)
         print("Submitted Adjoint Job IDs:", adjoint_job_ids)
         return adjoint_job_ids
     else:
@@ -126,146 +127,290 @@ def run_adjoint_simulations():
         print(result.stderr)
         return []
 
-def sum_kernels(events_dirs, output_dir='SUMMED_KERNELS', processor_count=12):
+def sum_kernels(events_dirs, output_dir='SUMMED_KERNELS', processor_count=12, workers=1, scale=1.0, manifest=None):
     """
-    Sum alpha, beta, and hess kernels across events for each processor.
+    Sum alpha, beta, and hess kernels across events for each processor, each event
+    times its weight in the event manifest and the sum times `scale` (e.g. N/B for
+    a mini-batch of B out of N events).
     """
     print("Summing alpha, beta, and hess kernels.")
-    sum_alpha_kernels(events_dirs, output_dir, processor_count)
-    sum_beta_kernels(events_dirs, output_dir, processor_count)
-    sum_hess_kernels(events_dirs, output_dir, processor_count)
+    weights = (manifest or EventManifest()).weights(events_dirs)
+    stack_kernels(events_dirs, ['alpha', 'beta', 'hess'], output_dir, processor_count, workers=workers, scale=scale,
+                  weights=weights)
 
-def sum_alpha_kernels(events_dirs, output_dir='SUMMED_KERNELS', processor_count=12):
+def stack_kernels(events_dirs, kernel_names, output_dir='SUMMED_KERNELS', processor_count=12,
+                  chunk_size=4194304, workers=1, scale=1.0, weights=None):
+    """
+    Sum any list of kernels across events in a single pass over the event directories.
+
+    With workers > 1 the processor slices are spread over a process pool. When
+    there are fewer slices than workers, each slice is further split into
+    contiguous value ranges. Every value is always summed in the order of
+    events_dirs, so the result is bit for bit identical for any worker count.
+
+    Args:
+        events_dirs (list): Event directories holding DATABASES_MPI/proc*_<name>_kernel.bin.
+        kernel_names (list): Kernel names to stack, e.g. ['alpha', 'beta', 'hess'].
+        output_dir (str): Directory for the proc*_<name>_kernel_summed.bin files.
+        processor_count (int): Number of processor slices.
+        chunk_size (int): Number of values streamed per chunk; bounds the memory used.
+        workers (int): Number of worker processes.
+        scale (float): Factor applied to the sums before they are written.
+        weights (list): Factor per event in events_dirs (default: all 1).
+    """
     os.makedirs(output_dir, exist_ok=True)
+    if workers <= 1:
+        for proc_id in range(processor_count):
+            stack_processor_kernels(proc_id, events_dirs, kernel_names, output_dir, chunk_size, scale=scale,
+                                    weights=weights)
+        return
+
+    nparts = -(-workers // processor_count)
     for proc_id in range(processor_count):
-        processor_id_str = f'{proc_id:06d}'
-        summed_alpha_kernel = None
+        for kernel_name in kernel_names:
+            kernel_file = os.path.join(events_dirs[0], 'DATABASES_MPI', f'proc{proc_id:06d}_{kernel_name}_kernel.bin')
+            summed_kernel_file = os.path.join(output_dir, f'proc{proc_id:06d}_{kernel_name}_kernel_summed.bin')
+            size = read_record(kernel_file, mmap=True).size
+            create_record(summed_kernel_file, 'float32', size).flush()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(stack_processor_kernels, proc_id, events_dirs, kernel_names,
+                                   output_dir, chunk_size, part, nparts, scale, weights)
+                   for proc_id in range(processor_count) for part in range(nparts)]
+        for future in futures:
+            future.result()
+
+def stack_processor_kernels(proc_id, events_dirs, kernel_names, output_dir='SUMMED_KERNELS',
+                            chunk_size=4194304, part=0, nparts=1, scale=1.0, weights=None):
+    """
+    Stack the kernels of one processor slice, or of part `part` out of `nparts`
+    contiguous ranges of it.
+
+    The payload of every (event, processor) kernel file is opened once as a
+    read-only memmap and streamed chunk by chunk into float64 accumulators,
+    always in the order of events_dirs, each times its weight. The summed
+    kernels are written as float32 Fortran records. With nparts > 1 the output
+    files must already exist with their final size.
+    """
+    processor_id_str = f'{proc_id:06d}'
+    weights = weights or [1.0] * len(events_dirs)
+    slabs = {}
+    for kernel_name in kernel_names:
+        slabs[kernel_name] = []
         for event_dir in events_dirs:
-            alpha_kernel_file = os.path.join(event_dir, 'DATABASES_MPI', f'proc{processor_id_str}_alpha_kernel.bin')
-            alpha_kernel = np.fromfile(alpha_kernel_file, dtype='float32')
-            if summed_alpha_kernel is None:
-                summed_alpha_kernel = alpha_kernel
-            else:
-                summed_alpha_kernel += alpha_kernel
-        summed_alpha_kernel_file = os.path.join(output_dir, f'proc{processor_id_str}_alpha_kernel_summed.bin')
-        summed_alpha_kernel.tofile(summed_alpha_kernel_file)
+            kernel_file = os.path.join(event_dir, 'DATABASES_MPI', f'proc{processor_id_str}_{kernel_name}_kernel.bin')
+            count = slabs[kernel_name][0].size if slabs[kernel_name] else None
+            slabs[kernel_name].append(read_record(kernel_file, count=count, mmap=True))
+
+    accumulator = np.empty(chunk_size, dtype='float64')
+    weighted = np.empty(chunk_size, dtype='float64')
+    for kernel_name in kernel_names:
+        kernel_slabs = slabs[kernel_name]
+        size = kernel_slabs[0].size
+        first, last = size * part // nparts, size * (part + 1) // nparts
+        summed_kernel_file = os.path.join(output_dir, f'proc{processor_id_str}_{kernel_name}_kernel_summed.bin')
+        if nparts == 1:
+            summed_kernel = create_record(summed_kernel_file, 'float32', size)
+        else:
+            summed_kernel = read_record(summed_kernel_file, count=size, mmap=True, mode='r+')
+        for start in range(first, last, chunk_size):
+            stop = min(start + chunk_size, last)
+            acc = accumulator[:stop - start]
+            acc[:] = kernel_slabs[0][start:stop]
+            if weights[0] != 1.0:
+                acc *= weights[0]
+            for slab, weight in zip(kernel_slabs[1:], weights[1:]):
+                if weight == 1.0:
+                    acc += slab[start:stop]
+                else:
+                    acc += np.multiply(slab[start:stop], weight, out=weighted[:stop - start], dtype='float64')
+            if scale != 1.0:
+                acc *= scale
+            summed_kernel[start:stop] = acc
+        if size:
+            summed_kernel.flush()
+        del summed_kernel, slabs[kernel_name]
+
+def accumulate_kernels(event_dir, kernel_names, accumulator_dir, processor_count=12, chunk_size=4194304, weight=1.0):
+    """
+    Add the kernels of one event, times `weight`, to running float64 sums, so events
+    can be stacked as their adjoint simulations finish instead of all at the end.
 
-def sum_beta_kernels(events_dirs, output_dir='SUMMED_KERNELS', processor_count=12):
-    os.makedirs(output_dir, exist_ok=True)
+    The sums are kept as accumulator_dir/proc*_<name>_kernel_sum.npy and created
+    for the first event; events already added, listed in accumulator_dir/events.txt,
+    are skipped. Events are summed in the order they arrive, so the result equals
+    stack_kernels up to float64 rounding.
+    """
+    os.makedirs(accumulator_dir, exist_ok=True)
+    events_file = os.path.join(accumulator_dir, 'events.txt')
+    if event_dir in accumulated_events(accumulator_dir):
+        print(f"Kernels of {event_dir} were already accumulated.")
+        return
     for proc_id in range(processor_count):
-        processor_id_str = f'{proc_id:06d}'
-        summed_beta_kernel = None
-        for event_dir in events_dirs:
-            beta_kernel_file = os.path.join(event_dir, 'DATABASES_MPI', f'proc{processor_id_str}_beta_kernel.bin')
-            beta_kernel = np.fromfile(beta_kernel_file, dtype='float32')
-            if summed_beta_kernel is None:
-                summed_beta_kernel = beta_kernel
+        for kernel_name in kernel_names:
+            kernel_file = os.path.join(event_dir, 'DATABASES_MPI', f'proc{proc_id:06d}_{kernel_name}_kernel.bin')
+            sum_file = os.path.join(accumulator_dir, f'proc{proc_id:06d}_{kernel_name}_kernel_sum.npy')
+            kernel = read_record(kernel_file, mmap=True)
+            if os.path.exists(sum_file):
+                summed = np.load(sum_file, mmap_mode='r+')
+                if summed.shape != kernel.shape:
+                    raise ValueError(f"{kernel_file}: {kernel.size} values, the sum has {summed.size}")
             else:
-                summed_beta_kernel += beta_kernel
-        summed_beta_kernel_file = os.path.join(output_dir, f'proc{processor_id_str}_beta_kernel_summed.bin')
-        summed_beta_kernel.tofile(summed_beta_kernel_file)
+                summed = np.lib.format.open_memmap(sum_file, mode='w+', dtype='float64', shape=kernel.shape)
+            for start in range(0, kernel.size, chunk_size):
+                if weight == 1.0:
+                    summed[start:start + chunk_size] += kernel[start:start + chunk_size]
+                else:
+                    summed[start:start + chunk_size] += weight * kernel[start:start + chunk_size].astype('float64')
+            summed.flush()
+            del summed, kernel
+    with open(events_file, 'a') as f:
+        f.write(event_dir + "\n")
+    print(f"Accumulated the kernels of {event_dir}.")
+
+def accumulated_events(accumulator_dir):
+    """
+    Events whose kernels have been added in accumulator_dir.
+    """
+    events_file = os.path.join(accumulator_dir, 'events.txt')
+    if not os.path.exists(events_file):
+        return []
+    with open(events_file) as f:
+        return f.read().split()
 
-def sum_hess_kernels(events_dirs, output_dir='SUMMED_KERNELS', processor_count=12):
+def write_accumulated_kernels(accumulator_dir, kernel_names, output_dir='SUMMED_KERNELS', processor_count=12,
+                              chunk_size=4194304):
+    """
+    Write the accumulated sums as float32 proc*_<name>_kernel_summed.bin records,
+    the same files stack_kernels writes.
+    """
     os.makedirs(output_dir, exist_ok=True)
     for proc_id in range(processor_count):
-        processor_id_str = f'{proc_id:06d}'
-        summed_hess_kernel = None
-        for event_dir in events_dirs:
-            hess_kernel_file = os.path.join(event_dir, 'DATABASES_MPI', f'proc{processor_id_str}_hess_kernel.bin')
-            hess_kernel = np.fromfile(hess_kernel_file, dtype='float32')
-            if summed_hess_kernel is None:
-                summed_hess_kernel = hess_kernel
-            else:
-                summed_hess_kernel += hess_kernel
-        summed_hess_kernel_file = os.path.join(output_dir, f'proc{processor_id_str}_hess_kernel_summed.bin')
-        summed_hess_kernel.tofile(summed_hess_kernel_file)
+        for kernel_name in kernel_names:
+            summed = np.load(os.path.join(accumulator_dir, f'proc{proc_id:06d}_{kernel_name}_kernel_sum.npy'),
+                             mmap_mode='r')
+            summed_kernel_file = os.path.join(output_dir, f'proc{proc_id:06d}_{kernel_name}_kernel_summed.bin')
+            summed_kernel = create_record(summed_kernel_file, 'float32', summed.size)
+            for start in range(0, summed.size, chunk_size):
+                summed_kernel[start:start + chunk_size] = summed[start:start + chunk_size]
+            if summed.size:
+                summed_kernel.flush()
+            del summed_kernel, summed
+    print(f"Summed kernels of {len(accumulated_events(accumulator_dir))} events written to {output_dir}.")
+
+def sum_alpha_kernels(events_dirs, output_dir='SUMMED_KERNELS', processor_count=12):
+    stack_kernels(events_dirs, ['alpha'], output_dir, processor_count)
+
+def sum_beta_kernels(events_dirs, output_dir='SUMMED_KERNELS', processor_count=12):
+    stack_kernels(events_dirs, ['beta'], output_dir, processor_count)
 
-def run_smooth_kernel(input_dir='SUMMED_KERNELS', output_dir='SUMMED_KERNELS'):
+def sum_hess_kernels(events_dirs, output_dir='SUMMED_KERNELS', processor_count=12):
+    stack_kernels(events_dirs, ['hess'], output_dir, processor_count)
+
+SMOOTHING_ENGINES = ['job', 'python']
+
+def run_smooth_kernel(input_dir='SUMMED_KERNELS', output_dir='SUMMED_KERNELS', scheduler=None, engine='job',
+                      processor_count=12, workers=1):
     """
-    Run smooth_kernel.sh to smooth the summed kernels and monitor its status.
+    Smooth the summed kernels. With engine='job' run smooth_kernel.sh and monitor its
+    status; with engine='python' clip and smooth them in this process instead, over
+    `workers` processes (see smoothing.py), with the same output files.
     """
+    if engine == 'python':
+        smooth_kernels(input_dir, output_dir, processor_count=processor_count, workers=workers)
+        return
+    if engine != 'job':
+        raise ValueError(f"unknown smoothing engine {engine}, expected one of {SMOOTHING_ENGINES}")
     print("Submitting smoothing job for kernels.")
-    result = subprocess.run(['sbatch', 'smooth_kernel.sh', input_dir, output_dir], capture_output=True, text=True)
-    
-    if result.returncode == 0:
-        job_id = result.stdout.strip().split()[-1]
-        print(f"Smoothing job submitted with Job ID: {job_id}")
-        monitor_smoothing_job(job_id)
-    else:
+    scheduler = scheduler or SlurmScheduler()
+    try:
+        job_id = scheduler.submit('smooth_kernel.sh', (input_dir, output_dir))
+    except (RuntimeError, OSError) as error:
         print("Error submitting smoothing job:")
-        print(result.stderr)
+        print(error)
+        return
+    print(f"Smoothing job submitted with Job ID: {job_id}")
+    monitor_smoothing_job(job_id, scheduler=scheduler)
 
-def monitor_smoothing_job(job_id, check_interval=10):
+def monitor_smoothing_job(job_id, check_interval=10, scheduler=None, success_file='SUCCESS'):
     """
-    Monitor the smoothing job by checking the job ID status until completion.
+    Monitor the smoothing job until it has finished; it succeeds when it COMPLETED
+    and wrote success_file. Returns its final state.
     """
     print(f"Monitoring smoothing job {job_id}...")
-    while True:
-        job_status = check_job_status([job_id])
-        status = job_status.get(job_id, "COMPLETED")
-
-        if status == "COMPLETED":
-            print(f"Smoothing job {job_id} completed successfully!")
-            break
-        elif status in ["PENDING", "RUNNING"]:
-            print(f"Smoothing job {job_id} Status: {status}")
-        else:
-            print(f"Smoothing job {job_id} encountered an issue: {status}")
-            break
-
-        time.sleep(check_interval)
+    state = wait_for_jobs([(job_id, 'smoothing', success_file)], scheduler, min_interval=check_interval)['smoothing']
+    if state == SUCCESS_STATE:
+        print(f"Smoothing job {job_id} completed successfully!")
+    else:
+        print(f"Smoothing job {job_id} encountered an issue: {state}")
+    return state
 
 def gauss_newton_update(model_dir='MODEL_1', kernel_dir='SUMMED_KERNELS',
-                        output_dir='MODEL_2_test', perturb_vp=0.01, perturb_vs=0.01, processor_count=12, update_vs=True):
+                        output_dir='MODEL_2_test', perturb_vp=0.01, perturb_vs=0.01, processor_count=12, update_vs=True,
+                        block_size=4194304):
     """
     Update the velocity model using Gauss-Newton method with known diagonal Hessian.
+
+    The model, kernel and Hessian files are memory-mapped and the updated model
+    is written through a memmap in blocks of block_size values, so memory use
+    does not grow with the mesh size. The Hessian block is read once and shared
+    by the vp and vs updates. All files are read as Fortran records, so a
+    kernel or Hessian that does not match the model size raises ValueError
+    before anything is written. Every output is a new file (see
+    fortran_io.create_record), also when output_dir is model_dir: the model is
+    read from the mapping of the replaced file, and a copy hard-linked into
+    DATABASES_MPI is never written through.
     """
     os.makedirs(output_dir, exist_ok=True)
     databases_mpi_dir = 'DATABASES_MPI'
     hess_dir = kernel_dir
-    
+    # fortran_io never writes through an existing file, so DATABASES_MPI can link to the model files
+    stager = ModelStager('hardlink')
+
     for proc_id in range(processor_count):
         processor_id_str = f'{proc_id:06d}'
-        vp_file = os.path.join(model_dir, f'proc{processor_id_str}_vp.bin')
-        vp = np.fromfile(vp_file, dtype='float32')
-        vp_first, vp_last = vp[0], vp[-1]
-        vp = vp[1:-1]
-
-        vs_file = os.path.join(model_dir, f'proc{processor_id_str}_vs.bin') if update_vs else None
-        if update_vs:
-            vs = np.fromfile(vs_file, dtype='float32')
-            vs_first, vs_last = vs[0], vs[-1]
-            vs = vs[1:-1]
-
-        # Load kernels for gradients
-        vp_kernel_file = os.path.join(kernel_dir, f'proc{processor_id_str}_alpha_kernel_summed_clip_smooth_smooth.bin')
-        vp_kernel = np.fromfile(vp_kernel_file, dtype='float32')[1:-1]
-
-        if update_vs:
-            vs_kernel_file = os.path.join(kernel_dir, f'proc{processor_id_str}_beta_kernel_summed_clip_smooth_smooth.bin')
-            vs_kernel = np.fromfile(vs_kernel_file, dtype='float32')[1:-1]
-
-        # Load diagonal Hessian elements for VP and VS
-        vp_hess_file = os.path.join(hess_dir, f'proc{processor_id_str}_hess_kernel_summed_smooth_smooth.bin')
-        vp_hessian = np.fromfile(vp_hess_file, dtype='float32')[1:-1]
 
-        update_vp = vp - perturb_vp * vp_kernel / (vp_hessian + 5e-14)
-        update_vp = np.concatenate(([vp_first], update_vp, [vp_last]))
+        # Load diagonal Hessian elements shared by VP and VS
+        hess_file = os.path.join(hess_dir, f'proc{processor_id_str}_hess_kernel_summed_smooth_smooth.bin')
+        hessian = read_record(hess_file, mmap=True)
 
+        # (parameter, kernel, step length, Hessian water level)
+        fields = [('vp', 'alpha', perturb_vp, 5e-14)]
         if update_vs:
-            vs_hess_file = os.path.join(hess_dir, f'proc{processor_id_str}_hess_kernel_summed_smooth_smooth.bin')
-            vs_hessian = np.fromfile(vs_hess_file, dtype='float32')[1:-1]
-            update_vs = vs - (perturb_vs * vs_kernel / vs_hessian)
-            update_vs = np.concatenate(([vs_first], update_vs, [vs_last]))
-
-        # Write the updated model files
-        update_vp.tofile(os.path.join(output_dir, f'proc{processor_id_str}_vp.bin'))
-        if update_vs:
-            update_vs.tofile(os.path.join(output_dir, f'proc{processor_id_str}_vs.bin'))
-
-        shutil.copy(os.path.join(output_dir, f'proc{processor_id_str}_vp.bin'), os.path.join(databases_mpi_dir, f'proc{processor_id_str}_vp.bin'))
-        if update_vs:
-            shutil.copy(os.path.join(output_dir, f'proc{processor_id_str}_vs.bin'), os.path.join(databases_mpi_dir, f'proc{processor_id_str}_vs.bin'))
+            fields.append(('vs', 'beta', perturb_vs, None))
+
+        inputs = []
+        for name, kernel_name, step, water_level in fields:
+            model_file = os.path.join(model_dir, f'proc{processor_id_str}_{name}.bin')
+            kernel_file = os.path.join(kernel_dir, f'proc{processor_id_str}_{kernel_name}_kernel_summed_clip_smooth_smooth.bin')
+            output_file = os.path.join(output_dir, f'proc{processor_id_str}_{name}.bin')
+            model = read_record(model_file, count=hessian.size, mmap=True)
+            kernel = read_record(kernel_file, count=hessian.size, mmap=True)
+            inputs.append((model, kernel, output_file, step, water_level))
+
+        # All inputs have been validated; create the output records
+        updates = [(model, kernel, create_record(output_file, 'float32', model.size), step, water_level)
+                   for model, kernel, output_file, step, water_level in inputs]
+
+        size = hessian.size
+        for start in range(0, size, block_size):
+            stop = min(start + block_size, size)
+            hessian_block = np.array(hessian[start:stop])
+            for model, kernel, updated, step, water_level in updates:
+                if water_level is None:
+                    updated[start:stop] = model[start:stop] - (step * kernel[start:stop] / hessian_block)
+                else:
+                    updated[start:stop] = model[start:stop] - step * kernel[start:stop] / (hessian_block + water_level)
+
+        for model, kernel, updated, step, water_level in updates:
+            updated.flush()
+        del inputs, updates, model, kernel, updated, hessian
+
+        # Stage the updated model files to DATABASES_MPI
+        for name, kernel_name, step, water_level in fields:
+            stager.stage_file(os.path.join(output_dir, f'proc{processor_id_str}_{name}.bin'), os.path.join(databases_mpi_dir, f'proc{processor_id_str}_{name}.bin'))
+    stager.save()
+    stager.report(f"Staged {output_dir} to {databases_mpi_dir}:")
 
     for proc_id in range(processor_count):
         processor_id_str = f'{proc_id:06d}'
@@ -302,29 +447,56 @@ def log_iteration(iteration, prev_misfit, current_misfit, stop):
         f.write("-" * 40 + "\n")
 
     print(f"Log for iteration {iteration} saved to {log_file}")
+    record('iteration', iteration=iteration, previous_misfit=float(prev_misfit), current_misfit=float(current_misfit),
+           stop=bool(stop))
 
 # Define workflow parameters
-def inversion_iteration(current_iteration,event_dirs):
-    print('new model is created and will launch simulations for iteration', current_iteration)
+OPTIMIZERS = ['gauss_newton', 'lbfgs']
+
+def update_model(current_iteration, step=1, output_dir=None, optimizer='gauss_newton'):
+    """
+    Create MODEL_<iteration>_test (or output_dir) from the previous model and the
+    smoothed kernels of the previous iteration, with `step` times the Gauss-Newton
+    or L-BFGS (see optimizer.py) update; the new model is also copied to DATABASES_MPI.
+    """
+    if optimizer == 'lbfgs':
+        LBFGS(processor_count=12, update_vs=False).update(
+            current_iteration - 1,
+            model_dir=f'MODEL_{current_iteration-1}_test/',
+            kernel_dir=f'SUMMED_KERNELS_l2_ITER{current_iteration-1}/',
+            output_dir=output_dir or f'MODEL_{current_iteration}_test',
+            step=step)
+        return
+    if optimizer != 'gauss_newton':
+        raise ValueError(f"unknown optimizer {optimizer}, expected one of {OPTIMIZERS}")
     gauss_newton_update(
         model_dir=f'MODEL_{current_iteration-1}_test/',
         kernel_dir=f'SUMMED_KERNELS_l2_ITER{current_iteration-1}/',
-        output_dir=f'MODEL_{current_iteration}_test',
-        perturb_vp=1,
-        perturb_vs=1,
+        output_dir=output_dir or f'MODEL_{current_iteration}_test',
+        perturb_vp=step,
+        perturb_vs=step,
         processor_count=12,
         update_vs=False
         )
-    job_ids = run_simulation()
-    if job_ids:
-        check_simulation_status(event_dirs, job_ids)
+
+def inversion_iteration(current_iteration,event_dirs,workers=1,optimizer='gauss_newton'):
+    # Every stage is timed and measured in logs/telemetry.jsonl (see telemetry.py)
+    with measure_stage('model_update', current_iteration):
+        print('new model is created and will launch simulations for iteration', current_iteration)
+        update_model(current_iteration, optimizer=optimizer)
+    with measure_stage('forward', current_iteration):
+        job_ids = run_simulation()
+        if job_ids:
+            check_simulation_status(event_dirs, job_ids)
 
     # Run the adjoint source creation after simulations are complete
-        run_create_adjoint_sources(current_iteration)
+    if job_ids:
+        with measure_stage('adjoint_sources', current_iteration):
+            run_create_adjoint_sources(current_iteration)
 
     # Calculate misfit for the current and previous iterations
-        current_misfit = calculate_misfit(current_iteration)
-        previous_misfit = calculate_misfit(current_iteration - 1)  # Assuming previous iteration exists
+            current_misfit = calculate_misfit(current_iteration)
+            previous_misfit = calculate_misfit(current_iteration - 1)  # Assuming previous iteration exists
 
     # Compare misfits and decide on adjoint simulation submission
     else:
@@ -335,20 +507,23 @@ def inversion_iteration(current_iteration,event_dirs):
     stop=compare_misfits(previous_misfit, current_misfit)
 
     if stop==False:
-        print('start adjoint simulations')
-        adjoint_job_ids = run_adjoint_simulations()
-        if job_ids:
-            check_simulation_status(event_dirs, adjoint_job_ids)
-        else:
-            print("No jobs were submitted.")
+        with measure_stage('adjoint', current_iteration):
+            print('start adjoint simulations')
+            adjoint_job_ids = run_adjoint_simulations()
+            if job_ids:
+                check_simulation_status(event_dirs, adjoint_job_ids)
+            else:
+                print("No jobs were submitted.")
 
 
 
     # Sum the kernels after adjoint simulations complete
-        sum_kernels(event_dirs, output_dir=f'SUMMED_KERNELS_l2_ITER{current_iteration}')
+        with measure_stage('summation', current_iteration):
+            sum_kernels(event_dirs, output_dir=f'SUMMED_KERNELS_l2_ITER{current_iteration}', workers=workers)
 
     # Run smoothing on the summed kernels
-        run_smooth_kernel(input_dir=f'SUMMED_KERNELS_l2_ITER{current_iteration}', output_dir=f'SUMMED_KERNELS_l2_ITER{current_iteration}')
+        with measure_stage('smoothing', current_iteration):
+            run_smooth_kernel(input_dir=f'SUMMED_KERNELS_l2_ITER{current_iteration}', output_dir=f'SUMMED_KERNELS_l2_ITER{current_iteration}')
     else:
         print('converged')
 
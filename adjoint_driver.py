@@ -0,0 +1,338 @@
+"""
+Adjoint source generation for many events at once.
+
+Replaces running adjointsources_l2.py / adjointsources_cc.py / adjointsources.py
+inside every event directory one after another: the (event, station, component)
+tasks of all events are spread over a process pool, the results come back in a
+fixed order and the misfit of every event is written to <event>/misfit.txt.
+Seismograms are read from the binary stores of seismogram_store.py rather than
+parsed from ASCII for every trace.
+
+No figures are rendered by default; --plot-worst N / --plot-sample N render a
+diagnostic subset afterwards in a detached background process.
+
+Usage:
+    python adjoint_driver.py --measure l2 --workers 16 --iteration 7 --plot-worst 5 EVENT1 EVENT2 EVENT3 EVENT4
+"""
+import os
+import sys
+import glob
+import json
+import argparse
+import subprocess
+import numpy as np
+import obspy
+import pyadjoint
+from concurrent.futures import ProcessPoolExecutor
+from seismogram_store import STORE_NAME, SeismogramStore, refresh_store
+from misfit_engine import MISFITS, batched_adjoint_sources
+from event_manifest import load_events
+from misfit_store import MisfitStore, MISFIT_DB
+
+# pyadjoint misfit function and config class of every measurement
+MEASUREMENTS = {
+    'l2': ('waveform_misfit', 'ConfigWaveForm'),
+    'cc': ('cc_traveltime_misfit_new', 'ConfigCrossCorrelation'),
+    'ep': ('exponentiated_phase_misfit', 'ConfigExponentiatedPhase'),
+}
+
+# Per component (measurement, window start, window end, weight), matching
+# adjointsources_l2.py, adjointsources_cc.py and adjointsources.py. A component
+# with weight zero gets an all-zero adjoint source and adds nothing to the misfit.
+COMPONENT_SETTINGS = {
+    'l2': {'Z': ('l2', 20, 60, 1.0), 'E': ('ep', 20, 60, 0.0), 'N': ('ep', 20, 60, 0.0)},
+    'cc': {'Z': ('cc', 20, 60, 1.0), 'E': ('ep', 20, 60, 0.0), 'N': ('ep', 20, 60, 0.0)},
+    'ep': {'Z': ('ep', 30, 70, 1.0), 'E': ('ep', 20, 70, 0.0), 'N': ('ep', 20, 70, 0.0)},
+}
+
+NETWORK = 'XX'
+MIN_PERIOD = 2
+MAX_PERIOD = 40
+
+# Seismogram stores opened in this process, by directory
+_stores = {}
+
+
+def component_settings(measure='l2', weights=None):
+    """
+    The per component settings of a measurement, with the weights given in
+    `weights` (e.g. {'E': 0.5}) replacing the defaults.
+    """
+    weights = weights or {}
+    unknown = set(weights) - set(COMPONENT_SETTINGS[measure])
+    if unknown:
+        raise ValueError(f"unknown components in weights: {sorted(unknown)}")
+    return {component: settings[:3] + (float(weights.get(component, settings[3])),)
+            for component, settings in COMPONENT_SETTINGS[measure].items()}
+
+
+def adjoint_source_tasks(event_dirs, measure='l2', weights=None):
+    """
+    List the (event, observed file, component, settings) tasks in a fixed order:
+    events as given, then components Z, E, N, then stations sorted by file name.
+    """
+    tasks = []
+    for event_dir in event_dirs:
+        for component, settings in component_settings(measure, weights).items():
+            pattern = os.path.join(event_dir, 'REF_SEIS', f'{NETWORK}*.BX{component}.semd')
+            for obsfile in sorted(glob.glob(pattern)):
+                tasks.append((event_dir, obsfile, component, settings))
+    return tasks
+
+
+def trace_store(trace_dir):
+    """
+    Open the seismogram store of a directory, reusing it while it is unchanged.
+    """
+    index_mtime = os.stat(os.path.join(trace_dir, f'{STORE_NAME}.json')).st_mtime_ns
+    store = _stores.get(trace_dir)
+    if store is None or store[0] != index_mtime:
+        store = _stores[trace_dir] = (index_mtime, SeismogramStore(trace_dir))
+    return store[1]
+
+
+def refresh_event_stores(event_dirs, workers=1):
+    """
+    Convert new or changed REF_SEIS and OUTPUT_FILES seismograms of every event
+    into their binary stores.
+    """
+    trace_dirs = [os.path.join(event_dir, subdir) for event_dir in event_dirs for subdir in ['REF_SEIS', 'OUTPUT_FILES']]
+    if workers <= 1:
+        rebuilt = [refresh_store(trace_dir) for trace_dir in trace_dirs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            rebuilt = list(executor.map(refresh_store, trace_dirs))
+    print(f"Seismogram stores rebuilt: {[d for d, r in zip(trace_dirs, rebuilt) if r]}")
+
+
+def generate_adjoint_source(event_dir, obsfile, component, settings, plot=False, write=True):
+    """
+    Calculate and write the adjoint source of one station and component.
+
+    With plot=True pyadjoint also renders OUTPUT_FILES/XX.<station>_<component>.jpg;
+    with write=False the .adj file is not written (used to render diagnostics).
+    Returns (event_dir, station, component, misfit, weight).
+    """
+    measurement, window_start, window_end, weight = settings
+    misfit_type, config_class = MEASUREMENTS[measurement]
+    filename = os.path.basename(obsfile)
+    synfile = os.path.join(event_dir, 'OUTPUT_FILES', filename)
+    stationname = filename.split('.')[1]
+    channel = f'BX{component}'
+
+    time_offset, dt, obs_data = trace_store(os.path.dirname(obsfile)).trace(filename)
+    _, syn_dt, syn_data = trace_store(os.path.dirname(synfile)).trace(filename)
+    config = getattr(pyadjoint.config, config_class)(min_period=MIN_PERIOD, max_period=MAX_PERIOD)
+    # pyadjoint and obspy may modify trace data in place, so hand them copies of the memmap rows
+    obs = obspy.Trace()
+    obs.data = np.array(obs_data)
+    obs.stats.delta = dt
+    obs.stats.network = NETWORK
+    obs.stats.station = stationname
+    obs.stats.channel = channel
+    syn = obspy.Trace()
+    syn.data = np.array(syn_data)
+    syn.stats.delta = syn_dt
+    syn.stats.network = NETWORK
+    syn.stats.channel = channel
+    plot_filename = os.path.join(event_dir, 'OUTPUT_FILES', f'{NETWORK}.{stationname}_{component}.jpg')
+    adjtmp = pyadjoint.adjoint_source.calculate_adjoint_source(misfit_type,
+                                obs, syn, config,
+                                [[window_start-time_offset, window_end-time_offset]], adjoint_src=True,
+                                plot=plot, plot_filename=plot_filename)
+    if write:
+        adjtmp.adjoint_source = np.flip(adjtmp.adjoint_source) * weight
+        os.makedirs(os.path.join(event_dir, 'SEM'), exist_ok=True)
+        adjfile = os.path.join(event_dir, 'SEM', f'{NETWORK}.{stationname}.{channel}.adj')
+        # A zero adjoint source of an earlier run may be a symlink shared by many stations
+        if os.path.islink(adjfile):
+            os.remove(adjfile)
+        adjtmp.write(filename=adjfile, format="SPECFEM", time_offset=time_offset)
+    return event_dir, stationname, component, adjtmp.misfit, weight
+
+
+def write_zero_adjoint_sources(event_dir, component, obsfiles, link=True):
+    """
+    Write all-zero adjoint sources for a component with weight zero, without
+    computing any misfit. The time axis is taken from the observed traces. With
+    link=True the first file of every distinct time axis is written and the other
+    stations are symlinked to it; every writer of real adjoint sources removes
+    such a link first instead of writing through it.
+
+    Returns a list of (event_dir, station, component, 0.0, 0.0).
+    """
+    os.makedirs(os.path.join(event_dir, 'SEM'), exist_ok=True)
+    written = {}
+    results = []
+    for obsfile in obsfiles:
+        filename = os.path.basename(obsfile)
+        stationname = filename.split('.')[1]
+        t0, dt, data = trace_store(os.path.dirname(obsfile)).trace(filename)
+        adjfile = os.path.join(event_dir, 'SEM', f'{NETWORK}.{stationname}.BX{component}.adj')
+        if os.path.lexists(adjfile):
+            os.remove(adjfile)
+        time_axis = (t0, dt, data.size)
+        if link and time_axis in written:
+            os.symlink(os.path.basename(written[time_axis]), adjfile)
+        else:
+            to_write = np.zeros((data.size, 2))
+            to_write[:, 0] = np.linspace(0, (data.size - 1) * dt, data.size) + t0
+            np.savetxt(adjfile, to_write)
+            written[time_axis] = adjfile
+        results.append((event_dir, stationname, component, 0.0, 0.0))
+    return results
+
+
+def generate_adjoint_sources(event_dirs, measure='l2', workers=1, plot=False, engine='pyadjoint', bandpass=True,
+                             weights=None, link_zero=True, write=True, iteration=None, misfit_db=MISFIT_DB):
+    """
+    Generate the adjoint sources of all events and write <event>/misfit.txt.
+    With write=False only the misfits are computed and nothing is written, e.g.
+    to evaluate the trial models of a line search. Given the iteration, the
+    station and event misfits are also recorded in the misfit store (see
+    misfit_store.py).
+
+    Components whose weight is zero (see component_settings) get all-zero
+    adjoint sources without any misfit computation. With engine='batched' the
+    l2 and cc components are computed per (event, component) by misfit_engine
+    on stacked traces (bandpassed unless bandpass=False); the other components
+    still go through pyadjoint. No figures are rendered unless plot=True; see
+    select_diagnostics and render_in_background for plotting a subset
+    afterwards. The misfit of an event is the weighted sum of its station
+    misfits. Returns (misfits per event, list of (event, station, component,
+    misfit, weight)).
+    """
+    refresh_event_stores(event_dirs, workers)
+    settings_by_component = component_settings(measure, weights)
+    tasks = adjoint_source_tasks(event_dirs, measure, weights)
+    zero_tasks = {}
+    for task in tasks:
+        if task[3][3] == 0:
+            zero_tasks.setdefault((task[0], task[2]), []).append(task[1])
+    tasks = [task for task in tasks if task[3][3] != 0]
+    batches = []
+    if engine == 'batched':
+        batches = [(event_dir, component, settings) for event_dir in event_dirs
+                   for component, settings in settings_by_component.items()
+                   if settings[0] in MISFITS and settings[3] != 0]
+        batched = set((event_dir, component) for event_dir, component, settings in batches)
+        tasks = [task for task in tasks if (task[0], task[2]) not in batched]
+    print(f"Generating {len(tasks)} adjoint sources and {len(batches)} batches for {len(event_dirs)} events with {workers} workers; "
+          f"{sum(len(obsfiles) for obsfiles in zero_tasks.values())} zero-weight adjoint sources are written directly.")
+    results = []
+    for (event_dir, component), obsfiles in zero_tasks.items():
+        if write:
+            results += write_zero_adjoint_sources(event_dir, component, obsfiles, link_zero)
+        else:
+            results += [(event_dir, os.path.basename(obsfile).split('.')[1], component, 0.0, 0.0) for obsfile in obsfiles]
+    if workers <= 1:
+        results += [generate_adjoint_source(*task, plot=plot, write=write) for task in tasks]
+        batch_results = [batched_adjoint_sources(*batch, bandpass=bandpass, write=write) for batch in batches]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(generate_adjoint_source, *task, plot=plot, write=write) for task in tasks]
+            batch_futures = [executor.submit(batched_adjoint_sources, *batch, bandpass=bandpass, write=write)
+                             for batch in batches]
+            results += [future.result() for future in futures]
+            batch_results = [future.result() for future in batch_futures]
+    for batch_result in batch_results:
+        results += batch_result
+    # Back to the fixed event, component, station order
+    order = {(event_dir, component): i for i, (event_dir, component) in
+             enumerate((e, c) for e in event_dirs for c in settings_by_component)}
+    results.sort(key=lambda r: (order[(r[0], r[2])], r[1]))
+
+    misfits = {event_dir: 0.0 for event_dir in event_dirs}
+    for event_dir, stationname, component, misfit, weight in results:
+        misfits[event_dir] += weight * misfit
+    for event_dir, misfit in misfits.items():
+        if write:
+            with open(os.path.join(event_dir, 'misfit.txt'), 'w') as fh:
+                fh.write(str(misfit)+"\n")
+        print(f"Misfit for {event_dir}: {misfit}")
+    if write and iteration is not None:
+        store = MisfitStore(misfit_db)
+        store.record(iteration, misfits, results)
+        store.close()
+    return misfits, results
+
+
+def select_diagnostics(results, measure='l2', worst=0, sample=0, seed=0, weights=None):
+    """
+    Pick the tasks to plot: the `worst` largest weighted misfits of every event
+    plus a seeded random `sample` of the remaining weighted traces.
+    """
+    settings = component_settings(measure, weights)
+    candidates = [r for r in results if r[4] != 0]
+    selected = []
+    for event_dir in dict.fromkeys(r[0] for r in candidates):
+        event_results = [r for r in candidates if r[0] == event_dir]
+        selected += sorted(event_results, key=lambda r: r[3] * r[4], reverse=True)[:worst]
+    remaining = [r for r in candidates if r not in selected]
+    if sample and remaining:
+        rng = np.random.default_rng(seed)
+        picks = rng.choice(len(remaining), size=min(sample, len(remaining)), replace=False)
+        selected += [remaining[i] for i in sorted(picks)]
+    return [(event_dir, os.path.join(event_dir, 'REF_SEIS', f'{NETWORK}.{stationname}.BX{component}.semd'),
+             component, settings[component])
+            for event_dir, stationname, component, misfit, weight in selected]
+
+
+def render_diagnostics(tasks, workers=1):
+    """
+    Render the pyadjoint figures of the given tasks without touching the adjoint sources.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    if workers <= 1:
+        for task in tasks:
+            generate_adjoint_source(*task, plot=True, write=False)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(generate_adjoint_source, *task, plot=True, write=False) for task in tasks]:
+            future.result()
+
+
+def render_in_background(tasks, workers=2, tasks_file='diagnostic_plots.json'):
+    """
+    Render the figures of the given tasks in a detached process and return it
+    right away, so the inversion does not wait for figure output.
+    """
+    if not tasks:
+        return None
+    with open(tasks_file, 'w') as f:
+        json.dump(tasks, f)
+    print(f"Rendering {len(tasks)} diagnostic figures in the background.")
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), '--render', tasks_file, '--workers', str(workers)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate adjoint sources for several events in parallel.')
+    parser.add_argument('event_dirs', nargs='*', help='events (default: the enabled events of the event manifest)')
+    parser.add_argument('--measure', choices=sorted(COMPONENT_SETTINGS), default='l2')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--engine', choices=['pyadjoint', 'batched'], default='pyadjoint',
+                        help='batched: stacked, vectorized l2/cc misfits of misfit_engine.py')
+    parser.add_argument('--no-bandpass', action='store_true',
+                        help='do not bandpass traces in the batched engine, to match the pyadjoint engine')
+    parser.add_argument('--weights', default='',
+                        help='component weights overriding the defaults, e.g. Z=1,E=0.5,N=0.5; zero skips the component')
+    parser.add_argument('--no-link-zero', action='store_true', help='write every zero adjoint source instead of symlinking')
+    parser.add_argument('--plot', action='store_true', help='render a figure for every trace (slow)')
+    parser.add_argument('--plot-worst', type=int, default=0, help='afterwards render the N worst misfits of every event')
+    parser.add_argument('--plot-sample', type=int, default=0, help='afterwards render N randomly chosen traces')
+    parser.add_argument('--iteration', type=int, default=None,
+                        help='record the misfits as this iteration in the misfit store (see misfit_store.py)')
+    parser.add_argument('--render', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    weights = dict((item.split('=')[0], float(item.split('=')[1])) for item in args.weights.split(',') if item)
+    if args.render:
+        with open(args.render) as f:
+            render_diagnostics([tuple(task) for task in json.load(f)], args.workers)
+    else:
+        misfits, results = generate_adjoint_sources(args.event_dirs or load_events(), args.measure, args.workers, args.plot,
+                                                    args.engine, not args.no_bandpass, weights, not args.no_link_zero,
+                                                    iteration=args.iteration)
+        render_in_background(select_diagnostics(results, args.measure, args.plot_worst, args.plot_sample, weights=weights),
+                             workers=max(1, min(4, args.workers)))
@@ -1,14 +1,18 @@
 #!/usr/bin/env bash 
 
+# events to simulate, e.g. a mini-batch: bash adjoint_specfem_all_adjoint.sh EVENT2 EVENT4
+# (default: the enabled events of the event manifest, see event_manifest.py)
+EVENTS=${@:-$(python event_manifest.py)}
 echo "Submitting adjoint simulations and capturing job IDs"
 
-for EVENT in EVENT1 EVENT2 EVENT3 EVENT4
+for EVENT in $EVENTS
 do
     cp specfem_adjoint_event.sh $EVENT
+    OPTIONS=$(python event_manifest.py --sbatch-options $EVENT)
     cd $EVENT
     rm -rf SUCCESS
     # Capture the job ID of each submission
-    job_id=$(sbatch specfem_adjoint_event.sh | awk '{print $NF}')
+    job_id=$(sbatch $OPTIONS specfem_adjoint_event.sh | awk '{print $NF}')
     # Print the job ID for Python to capture
     echo "Submitted batch job $job_id for $EVENT"
     cd ..
@@ -1,14 +1,25 @@
+import os
 import numpy as np
-import matplotlib.pyplot as plt
 import pyadjoint
 import pyadjoint
 import obspy
 import glob
 
+# pyadjoint figures per station and component are slow; set to True for diagnostics
+PLOT=False
+# Weights of the E and N adjoint sources; with weight 0 a zero adjoint source is
+# written directly without computing the misfit
+WEIGHT_E=0
+WEIGHT_N=0
+
 config=pyadjoint.config.ConfigCrossCorrelation(min_period=2,max_period=40)
 obs_waveforms=glob.glob('REF_SEIS/XX*.BXZ.semd')
 fh = open('misfit.txt','w')
 Misfits_all=0.0
+def unlink_adj(adjfile):
+    # adjoint_driver.py symlinks zero adjoint sources to one shared file; never write through such a link
+    if os.path.islink(adjfile):
+        os.remove(adjfile)
 def generate_adj(obsfile,synfile):
     ds1=np.loadtxt(obsfile)
     ds2=np.loadtxt(synfile)
@@ -30,11 +41,12 @@ def generate_adj(obsfile,synfile):
     syn.stats.channel = 'BXZ'
     adjtmp=pyadjoint.adjoint_source.calculate_adjoint_source('cc_traveltime_misfit_new', 
                                 obs, syn, config,
-                                [[20-time_offset,60-time_offset]],adjoint_src=True, plot=True,plot_filename='OUTPUT_FILES/XX.'+stationname+'_Z.jpg')
+                                [[20-time_offset,60-time_offset]],adjoint_src=True, plot=PLOT,plot_filename='OUTPUT_FILES/XX.'+stationname+'_Z.jpg')
     adjtmp.adjoint_source=np.flip(adjtmp.adjoint_source)
     network = 'XX'
     station = stationname
     syn.stats.channel = 'BXZ'
+    unlink_adj('SEM/'+network+'.'+station+'.BXZ'+'.adj')
     adjtmp.write(filename='SEM/'+network+'.'+station+'.BXZ'+'.adj',format="SPECFEM", time_offset=time_offset)
     return adjtmp.misfit
 
@@ -46,7 +58,19 @@ for file in obs_waveforms:
     Misfits_all+=misfit
 
 
+def write_zero_adj(obsfile,channel):
+    ds1=np.loadtxt(obsfile)
+    stationname=obsfile.split('/')[-1].split('.')[1]
+    to_write=np.zeros((ds1.shape[0],2))
+    to_write[:,0]=ds1.T[0]
+    unlink_adj('SEM/XX.'+stationname+'.'+channel+'.adj')
+    np.savetxt('SEM/XX.'+stationname+'.'+channel+'.adj',to_write)
+
+
 def generate_adj_E(obsfile,synfile):
+    if WEIGHT_E==0:
+        write_zero_adj(obsfile,'BXE')
+        return 0.0
     ds1=np.loadtxt(obsfile)
     ds2=np.loadtxt(synfile)
     time_offset=ds1.T[0][0]
@@ -66,21 +90,27 @@ def generate_adj_E(obsfile,synfile):
     syn.stats.channel = 'BXE'
     adjtmp=pyadjoint.adjoint_source.calculate_adjoint_source('exponentiated_phase_misfit', 
                                 obs, syn, config,
-                                [[20-time_offset,60-time_offset]],adjoint_src=True, plot=True,plot_filename='OUTPUT_FILES/XX.'+stationname+'_E.jpg')
-    adjtmp.adjoint_source=np.flip(adjtmp.adjoint_source)*0
+                                [[20-time_offset,60-time_offset]],adjoint_src=True, plot=PLOT,plot_filename='OUTPUT_FILES/XX.'+stationname+'_E.jpg')
+    adjtmp.adjoint_source=np.flip(adjtmp.adjoint_source)*WEIGHT_E
     network = 'XX'
     station = stationname
     syn.stats.channel = 'BXE'
+    unlink_adj('SEM/'+network+'.'+station+'.BXE'+'.adj')
     adjtmp.write(filename='SEM/'+network+'.'+station+'.BXE'+'.adj',format="SPECFEM", time_offset=time_offset)
+    return WEIGHT_E*adjtmp.misfit
 
 obs_waveforms=glob.glob('REF_SEIS/XX*.BXE.semd')
 for file in obs_waveforms:
     syn='OUTPUT_FILES/'+file.split('/')[1]
     print(syn)
-    generate_adj_E(file,syn)
+    misfit=generate_adj_E(file,syn)
+    Misfits_all+=misfit
 
 
 def generate_adj_N(obsfile,synfile):
+    if WEIGHT_N==0:
+        write_zero_adj(obsfile,'BXN')
+        return 0.0
     ds1=np.loadtxt(obsfile)
     ds2=np.loadtxt(synfile)
     time_offset=ds1.T[0][0]
@@ -100,17 +130,20 @@ def generate_adj_N(obsfile,synfile):
     syn.stats.channel = 'BXN'
     adjtmp=pyadjoint.adjoint_source.calculate_adjoint_source('exponentiated_phase_misfit', 
                                 obs, syn, config,
-                                [[20-time_offset,60-time_offset]],adjoint_src=True, plot=True,plot_filename='OUTPUT_FILES/XX.'+stationname+'_N.jpg')
-    adjtmp.adjoint_source=np.flip(adjtmp.adjoint_source)*0
+                                [[20-time_offset,60-time_offset]],adjoint_src=True, plot=PLOT,plot_filename='OUTPUT_FILES/XX.'+stationname+'_N.jpg')
+    adjtmp.adjoint_source=np.flip(adjtmp.adjoint_source)*WEIGHT_N
     network = 'XX'
     station = stationname
     syn.stats.channel = 'BXN'
+    unlink_adj('SEM/'+network+'.'+station+'.BXN'+'.adj')
     adjtmp.write(filename='SEM/'+network+'.'+station+'.BXN'+'.adj',format="SPECFEM", time_offset=time_offset)
+    return WEIGHT_N*adjtmp.misfit
 
 obs_waveforms=glob.glob('REF_SEIS/XX*.BXN.semd')
 for file in obs_waveforms:
     syn='OUTPUT_FILES/'+file.split('/')[1]
     print(syn)
-    generate_adj_N(file,syn)
+    misfit=generate_adj_N(file,syn)
+    Misfits_all+=misfit
 
 fh.write(str(Misfits_all)+"\n")
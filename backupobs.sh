@@ -1,6 +1,8 @@
 
 
-for EVENT in EVENT1 EVENT2 EVENT3 EVENT4
+# events to back up (default: all events of the event manifest, see event_manifest.py)
+EVENTS=${@:-$(python event_manifest.py --all)}
+for EVENT in $EVENTS
 do
     cp $EVENT/OUTPUT_FILES/* $EVENT/REF_SEIS/
 done
\ No newline at end of file
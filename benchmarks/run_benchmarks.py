@@ -0,0 +1,219 @@
+"""
+Benchmarks of the Python hot paths on synthetic SPECFEM trees.
+
+For every scale a tree is generated with synthetic_mesh.make_tree and every
+stage is run in a fresh Python process inside it, `repeat` times. Each run
+records the wall times and the peak resident memory of the process (and of
+its worker processes) above what the imports already used:
+
+    sum_kernels              Inversion.sum_kernels over all events
+    gauss_newton_update      Inversion.gauss_newton_update of vp and vs
+    recover_gll_coordinates  gll_coordinates_model_modify.recover_all_gll_coordinates
+    apply_velocity_anomaly   gll_coordinates_model_modify.apply_velocity_anomaly of every slice
+    adjoint_sources          adjoint_driver.generate_adjoint_sources (l2) of all events
+
+The results go to a JSON file. With --compare, the best time and the peak
+memory of every stage and scale are compared with a stored baseline (e.g. an
+earlier results file), and the exit status is 1 if anything is slower or
+larger than the baseline by more than --tolerance.
+
+Usage:
+    python benchmarks/run_benchmarks.py [--scales small medium] [--stages sum_kernels ...]
+                                        [--repeat 3] [--workers N] [--output results.json]
+                                        [--compare baseline.json [--tolerance 0.25]]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import importlib
+import tempfile
+import resource
+import datetime
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic_mesh import make_tree
+
+# make_tree arguments per scale
+SCALES = {
+    'small': {'nspec': 512, 'processor_count': 4, 'event_count': 2, 'stations': 10, 'nt': 4000},
+    'medium': {'nspec': 8000, 'processor_count': 4, 'event_count': 4, 'stations': 40, 'nt': 4000},
+    'large': {'nspec': 27000, 'processor_count': 8, 'event_count': 4, 'stations': 100, 'nt': 8000},
+}
+# module of every stage, imported before the baseline memory is taken
+STAGE_MODULES = {'sum_kernels': 'Inversion', 'gauss_newton_update': 'Inversion',
+                 'recover_gll_coordinates': 'gll_coordinates_model_modify',
+                 'apply_velocity_anomaly': 'gll_coordinates_model_modify', 'adjoint_sources': 'adjoint_driver'}
+STAGES = list(STAGE_MODULES)
+# memory growth below this is not reported as a regression
+MEMORY_SLACK_MB = 10
+
+
+def run_stage(stage, sizes, workers=1, engine='batched'):
+    """
+    Run one stage in the current directory, a tree written by make_tree.
+    """
+    processor_count = sizes['processor_count']
+    event_dirs = [f'EVENT{event + 1}' for event in range(sizes['event_count'])]
+    if stage == 'sum_kernels':
+        from Inversion import sum_kernels
+        sum_kernels(event_dirs, output_dir='BENCH_SUMMED_KERNELS', processor_count=processor_count, workers=workers)
+    elif stage == 'gauss_newton_update':
+        from Inversion import gauss_newton_update
+        gauss_newton_update('MODEL_1_test', 'SUMMED_KERNELS', 'BENCH_MODEL_2', processor_count=processor_count,
+                            update_vs=True)
+    elif stage == 'recover_gll_coordinates':
+        from gll_coordinates_model_modify import recover_all_gll_coordinates
+        recover_all_gll_coordinates('DATABASES_MPI', 'BENCH_GLL', processor_count, workers)
+    elif stage == 'apply_velocity_anomaly':
+        from gll_coordinates_model_modify import apply_velocity_anomaly
+        for proc_id in range(processor_count):
+            prefix = os.path.join('DATABASES_MPI', f'proc{proc_id:06d}')
+            apply_velocity_anomaly(f'{prefix}_vp.bin', f'{prefix}_x_gll_recovered.bin', f'{prefix}_y_gll_recovered.bin',
+                                   f'{prefix}_z_gll_recovered.bin', output_dir='BENCH_ANOMALY',
+                                   processor_id=f'{proc_id:06d}')
+    elif stage == 'adjoint_sources':
+        from adjoint_driver import generate_adjoint_sources
+        generate_adjoint_sources(event_dirs, 'l2', workers, engine=engine)
+    else:
+        raise ValueError(f"unknown stage {stage}")
+
+
+def memory_status():
+    """
+    Current and peak resident memory of this process in MB, from /proc/self/status.
+    """
+    values = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(('VmRSS:', 'VmHWM:')):
+                values[line.split(':')[0]] = int(line.split()[1]) / 1024
+    return values['VmRSS'], values['VmHWM']
+
+
+def reset_peak_memory():
+    """
+    Reset the peak resident memory of this process to the current one (Linux 4.0+).
+    ru_maxrss cannot be used: it keeps the peak of the parent from before exec.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        print("Warning: cannot reset the peak memory; the stage memory includes the imports")
+
+
+def child_main(spec):
+    """
+    Time a stage in this process; prints the measurement as the last line of output.
+    """
+    os.chdir(spec['tree'])
+    importlib.import_module(STAGE_MODULES[spec['stage']])
+    reset_peak_memory()
+    baseline, peak = memory_status()
+    seconds = []
+    for repeat in range(spec['repeat']):
+        start = time.perf_counter()
+        run_stage(spec['stage'], spec['sizes'], spec['workers'], spec['engine'])
+        seconds.append(time.perf_counter() - start)
+    current, peak = memory_status()
+    workers_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(json.dumps({'seconds': seconds, 'baseline_rss_mb': baseline, 'peak_rss_mb': peak,
+                      'stage_rss_mb': peak - baseline, 'workers_peak_rss_mb': workers_peak}))
+
+
+def measure(stage, scale, tree, sizes, repeat=3, workers=1, engine='batched'):
+    """
+    Run a stage in a fresh Python process and return its result record.
+    """
+    spec = {'stage': stage, 'tree': tree, 'sizes': sizes, 'repeat': repeat, 'workers': workers, 'engine': engine}
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', json.dumps(spec)],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"benchmark {stage} ({scale}) failed:\n{result.stderr}")
+    record = json.loads(result.stdout.strip().splitlines()[-1])
+    record.update({'stage': stage, 'scale': scale, 'workers': workers, 'best': min(record['seconds']),
+                   'median': sorted(record['seconds'])[len(record['seconds']) // 2]}, **sizes)
+    print(f"{stage:<25} {scale:<7} best {record['best']:9.3f} s  median {record['median']:9.3f} s  "
+          f"memory {record['stage_rss_mb']:8.1f} MB")
+    return record
+
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    Compare best times and stage memory with a baseline; returns the regressions.
+    """
+    reference = dict(((record['stage'], record['scale']), record) for record in baseline['results'])
+    regressions = []
+    for record in results['results']:
+        base = reference.get((record['stage'], record['scale']))
+        if base is None:
+            continue
+        time_ratio = record['best'] / base['best']
+        memory_ratio = (record['stage_rss_mb'] + 1) / (base['stage_rss_mb'] + 1)
+        flag = ''
+        memory_limit = (1 + tolerance) * base['stage_rss_mb'] + MEMORY_SLACK_MB
+        if time_ratio > 1 + tolerance or record['stage_rss_mb'] > memory_limit:
+            flag = 'REGRESSION'
+            regressions.append(record)
+        print(f"{record['stage']:<25} {record['scale']:<7} time x{time_ratio:6.2f}  memory x{memory_ratio:6.2f}  {flag}")
+    return regressions
+
+
+def run_benchmarks(scales, stages, repeat=3, workers=1, engine='batched', work_dir=None, keep=False):
+    """
+    Generate a tree per scale and measure every stage on it.
+    """
+    temporary = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='specfem_bench_')
+    results = {'created': str(datetime.datetime.now()), 'host': platform.node(), 'python': platform.python_version(),
+               'cpu_count': os.cpu_count(), 'results': []}
+    try:
+        for scale in scales:
+            tree = os.path.join(work_dir, scale)
+            start = time.perf_counter()
+            sizes = make_tree(tree, **SCALES[scale])
+            print(f"Generated the {scale} tree {sizes} in {time.perf_counter() - start:.1f} s")
+            for stage in stages:
+                results['results'].append(measure(stage, scale, tree, sizes, repeat, workers, engine))
+            if not keep:
+                shutil.rmtree(tree)
+    finally:
+        if temporary and not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Python hot paths on synthetic SPECFEM trees.')
+    parser.add_argument('--scales', nargs='+', choices=sorted(SCALES), default=['small', 'medium'])
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--engine', choices=['pyadjoint', 'batched'], default='batched',
+                        help='engine of the adjoint_sources stage')
+    parser.add_argument('--work-dir', help='directory for the generated trees (default: a temporary directory)')
+    parser.add_argument('--keep', action='store_true', help='keep the generated trees')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', metavar='BASELINE', help='results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown or memory growth')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child_main(json.loads(args.child))
+        sys.exit(0)
+    results = run_benchmarks(args.scales, args.stages, args.repeat, args.workers, args.engine, args.work_dir, args.keep)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
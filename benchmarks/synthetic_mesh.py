@@ -0,0 +1,138 @@
+"""
+Synthetic SPECFEM trees for the benchmarks.
+
+make_tree writes, for a configurable number of elements per slice, processor
+slices, events, stations and time steps, everything the benchmarked stages read:
+
+    DATABASES_MPI/proc*_{ibool,x,y,z,vp,vs,rho}.bin      Fortran records
+    DATABASES_MPI/proc*_{x,y,z}_gll_recovered.bin        plain float32 GLL coordinates
+    MODEL_1_test/proc*_{vp,vs}.bin                       the current model
+    SUMMED_KERNELS/proc*_{alpha,beta}_kernel_summed_clip_smooth_smooth.bin
+    SUMMED_KERNELS/proc*_hess_kernel_summed_smooth_smooth.bin
+    EVENT*/DATABASES_MPI/proc*_{alpha,beta,hess}_kernel.bin
+    EVENT*/{REF_SEIS,OUTPUT_FILES}/XX.S*.BX{Z,E,N}.semd
+
+Every slice is a block of hexahedral elements with the 5 GLL points per
+direction, so ibool shares the points on element faces like a real mesh. The
+mesh is placed over Box ANOMALY_BOX of gll_coordinates_model_modify.py, so the
+anomaly touches part of it.
+
+Usage: python benchmarks/synthetic_mesh.py OUT_DIR [--nspec 4096] [--processors 4]
+                                          [--events 2] [--stations 20] [--nt 4000]
+"""
+import os
+import sys
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fortran_io import write_record
+
+NGLL = 5
+# GLL points of degree 4 on [-1, 1]
+GLL_POINTS = np.array([-1.0, -np.sqrt(3 / 7), 0.0, np.sqrt(3 / 7), 1.0])
+ORIGIN = (440e3, 4.42e6, -200e3)
+ELEMENT_SIZE = 5e3
+KERNEL_NAMES = ['alpha', 'beta', 'hess']
+
+
+def element_grid(nspec):
+    """
+    (nx, ny, nz) elements of a block holding at least nspec elements.
+    """
+    nx = ny = int(np.ceil(nspec ** (1 / 3)))
+    nz = -(-nspec // (nx * ny))
+    return nx, ny, nz
+
+
+def make_slice_mesh(nspec, proc_id):
+    """
+    ibool (nspec, 5, 5, 5), 1-based, and the x, y, z coordinates of the global
+    points of one slice; slices sit next to each other along x.
+    """
+    nx, ny, nz = element_grid(nspec)
+    npoints = [4 * n + 1 for n in (nx, ny, nz)]
+    axes = []
+    for n, origin in zip((nx, ny, nz), ORIGIN):
+        nodes = (np.arange(n)[:, None] + (GLL_POINTS[None, :4] + 1) / 2).ravel()
+        axes.append(origin + ELEMENT_SIZE * np.append(nodes, n))
+    axes[0] = axes[0] + proc_id * nx * ELEMENT_SIZE
+    x, y, z = np.meshgrid(*axes, indexing='ij')
+
+    # element (a, b, c) and its GLL point (i, j, k) -> global point, stored as [ispec, k, j, i]
+    a, b, c = [index.ravel()[:nspec] for index in np.meshgrid(np.arange(nx), np.arange(ny), np.arange(nz), indexing='ij')]
+    gll = np.arange(NGLL)
+    gi = 4 * a[:, None, None, None] + gll[None, None, None, :]
+    gj = 4 * b[:, None, None, None] + gll[None, None, :, None]
+    gk = 4 * c[:, None, None, None] + gll[None, :, None, None]
+    ibool = (gi * npoints[1] + gj) * npoints[2] + gk + 1
+    return ibool.astype('int32'), x.ravel(), y.ravel(), z.ravel()
+
+
+def write_traces(directory, stations, nt, shift, rng, dt=0.02):
+    """
+    Write BX{Z,E,N} .semd traces starting at -10 s: a Gaussian-windowed sine at
+    30 s, inside the 20-60 s misfit windows, delayed by `shift` s plus noise.
+    """
+    os.makedirs(directory, exist_ok=True)
+    t = np.round(-10 + dt * np.arange(nt), 6)
+    for station in range(stations):
+        for component in 'ZEN':
+            delay = shift + 0.1 * rng.standard_normal()
+            trace = np.sin(2 * np.pi * (t - delay) / 8) * np.exp(-((t - 30 - delay) / 6) ** 2)
+            np.savetxt(os.path.join(directory, f'XX.S{station:03d}.BX{component}.semd'), np.c_[t, trace],
+                       fmt='%14.6f %15.7E')
+
+
+def make_tree(root, nspec=4096, processor_count=4, event_count=2, stations=20, nt=4000, seed=0):
+    """
+    Write a synthetic tree under root (see the module docstring) and return its sizes.
+    """
+    rng = np.random.default_rng(seed)
+    size = nspec * NGLL ** 3
+    for directory in ['DATABASES_MPI', 'MODEL_1_test', 'SUMMED_KERNELS']:
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+    for proc_id in range(processor_count):
+        prefix = f'proc{proc_id:06d}'
+        ibool, x, y, z = make_slice_mesh(nspec, proc_id)
+        databases = os.path.join(root, 'DATABASES_MPI')
+        write_record(os.path.join(databases, f'{prefix}_ibool.bin'), ibool.ravel())
+        for name, store in zip('xyz', (x, y, z)):
+            write_record(os.path.join(databases, f'{prefix}_{name}.bin'), store.astype('float32'))
+            store.astype('float32')[ibool - 1].tofile(os.path.join(databases, f'{prefix}_{name}_gll_recovered.bin'))
+        for name, value in [('vp', 6000.0), ('vs', 3500.0), ('rho', 2700.0)]:
+            field = (value * (1 + 0.01 * rng.standard_normal(size))).astype('float32')
+            write_record(os.path.join(databases, f'{prefix}_{name}.bin'), field)
+            if name != 'rho':
+                write_record(os.path.join(root, 'MODEL_1_test', f'{prefix}_{name}.bin'), field)
+        kernels = os.path.join(root, 'SUMMED_KERNELS')
+        for name in ['alpha', 'beta']:
+            write_record(os.path.join(kernels, f'{prefix}_{name}_kernel_summed_clip_smooth_smooth.bin'),
+                         (1e-10 * rng.standard_normal(size)).astype('float32'))
+        write_record(os.path.join(kernels, f'{prefix}_hess_kernel_summed_smooth_smooth.bin'),
+                     (1e-8 * (1 + rng.random(size))).astype('float32'))
+        for event in range(event_count):
+            event_databases = os.path.join(root, f'EVENT{event + 1}', 'DATABASES_MPI')
+            os.makedirs(event_databases, exist_ok=True)
+            for name in KERNEL_NAMES:
+                write_record(os.path.join(event_databases, f'{prefix}_{name}_kernel.bin'),
+                             (1e-10 * rng.standard_normal(size)).astype('float32'))
+    for event in range(event_count):
+        event_dir = os.path.join(root, f'EVENT{event + 1}')
+        write_traces(os.path.join(event_dir, 'REF_SEIS'), stations, nt, 0.0, rng)
+        write_traces(os.path.join(event_dir, 'OUTPUT_FILES'), stations, nt, 0.5, rng)
+    return {'nspec': nspec, 'processor_count': processor_count, 'event_count': event_count, 'stations': stations,
+            'nt': nt}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic SPECFEM tree for benchmarks.')
+    parser.add_argument('root')
+    parser.add_argument('--nspec', type=int, default=4096, help='elements per slice')
+    parser.add_argument('--processors', type=int, default=4, help='processor slices')
+    parser.add_argument('--events', type=int, default=2)
+    parser.add_argument('--stations', type=int, default=20)
+    parser.add_argument('--nt', type=int, default=4000, help='time steps per trace')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(make_tree(args.root, args.nspec, args.processors, args.events, args.stations, args.nt, args.seed))
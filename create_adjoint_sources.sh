@@ -1,19 +1,20 @@
 #!/bin/bash
 #################################################
+# usage: bash create_adjoint_sources.sh ITERATION [EVENT ...]
+# (default: the enabled events of the event manifest, see event_manifest.py)
 it=$1
+shift
 newdir='REF_SEM_'$it
+EVENTS=${@:-$(python event_manifest.py)}
 echo "use the pyadjoint to calculate the adjoint sources"
-for EVENT in EVENT1 EVENT2 EVENT3 EVENT4
+# all events, stations and components are processed together in a process pool
+python adjoint_driver.py --measure l2 --workers `nproc` --iteration $it $EVENTS
+if [[ $? -ne 0 ]]; then exit 1; fi
+for EVENT in $EVENTS
 do 
    echo $EVENT
-   rm -rf  $EVENT/adjointsources_l2.py
    rm -rf $EVENT/$newdir
-   cp -r adjointsources_l2.py $EVENT
-   cd $EVENT
-   #cp -r DATABASES_MPI/* $EVENT/DATABASES_MPI/
-   python adjointsources_l2.py
-   mkdir $newdir
-   cp OUTPUT_FILES/*.semd  $newdir
-   cp misfit.txt $newdir
-   cd ..
-done
\ No newline at end of file
+   mkdir $EVENT/$newdir
+   cp $EVENT/OUTPUT_FILES/*.semd  $EVENT/$newdir
+   cp $EVENT/misfit.txt $EVENT/$newdir
+done
@@ -0,0 +1,114 @@
+"""
+Event manifest: the one list of events that every stage of the inversion uses.
+
+The manifest (events.json in the working directory) lists the events in the
+order they are processed, with a weight, an enabled flag and optional sbatch
+resource hints per event:
+
+    {"events": [
+        {"name": "EVENT1", "weight": 1.0, "enabled": true},
+        {"name": "EVENT2", "weight": 0.5, "enabled": true,
+         "resources": {"ntasks": 24, "time": "04:00:00"}},
+        {"name": "EVENT3", "enabled": false}
+    ]}
+
+Disabled events are skipped by submission, adjoint sources, misfit and kernel
+summation alike. The weight multiplies the misfit of the event in the total
+misfit and its kernels in the summed kernels (the misfit.txt files and the
+adjoint sources themselves stay unweighted). Resource hints are passed to
+sbatch as --<key>=<value> and override the #SBATCH lines of the job script.
+Without a manifest file all EVENT* directories are used with weight 1.
+
+The shell scripts read the manifest through the command line:
+
+    python event_manifest.py                          # enabled events, one line
+    python event_manifest.py --all                    # all events
+    python event_manifest.py --sbatch-options EVENT2  # sbatch options of an event
+    python event_manifest.py --init                   # write events.json from the EVENT* directories
+"""
+import os
+import glob
+import json
+import argparse
+
+MANIFEST_FILE = 'events.json'
+DEFAULT_EVENT = {'weight': 1.0, 'enabled': True, 'resources': {}}
+
+
+class EventManifest:
+    """
+    The events of an inversion with their weights, enabled flags and resource hints.
+
+    Args:
+        filename (str): Manifest file; if it does not exist, all EVENT* directories.
+    """
+    def __init__(self, filename=MANIFEST_FILE):
+        self.filename = filename
+        if os.path.exists(filename):
+            with open(filename) as f:
+                entries = json.load(f)['events']
+        else:
+            entries = [{'name': event_dir} for event_dir in sorted(glob.glob('EVENT*')) if os.path.isdir(event_dir)]
+        self.entries = {}
+        for entry in entries:
+            entry = dict(DEFAULT_EVENT, **entry)
+            if entry['name'] in self.entries:
+                raise ValueError(f"{filename}: event {entry['name']} is listed twice")
+            if not entry['weight'] >= 0:
+                raise ValueError(f"{filename}: event {entry['name']} has a negative weight {entry['weight']}")
+            self.entries[entry['name']] = entry
+
+    def events(self, include_disabled=False):
+        """
+        Names of the (enabled) events, in manifest order.
+        """
+        return [name for name, entry in self.entries.items() if include_disabled or entry['enabled']]
+
+    def weight(self, event_dir):
+        """
+        Weight of an event; 1 for events not in the manifest.
+        """
+        return self.entries.get(event_dir, DEFAULT_EVENT)['weight']
+
+    def weights(self, event_dirs):
+        """
+        Weights of event_dirs, in order.
+        """
+        return [self.weight(event_dir) for event_dir in event_dirs]
+
+    def sbatch_options(self, event_dir):
+        """
+        sbatch command-line options from the resource hints of an event.
+        """
+        resources = self.entries.get(event_dir, DEFAULT_EVENT)['resources']
+        return [f'--{key}={value}' for key, value in resources.items()]
+
+    def save(self):
+        with open(self.filename, 'w') as f:
+            json.dump({'events': list(self.entries.values())}, f, indent=1)
+
+
+def load_events(filename=MANIFEST_FILE):
+    """
+    The enabled events of the manifest.
+    """
+    return EventManifest(filename).events()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the events of the event manifest.')
+    parser.add_argument('--manifest', default=MANIFEST_FILE)
+    parser.add_argument('--all', action='store_true', help='include disabled events')
+    parser.add_argument('--sbatch-options', metavar='EVENT', help='print the sbatch options of an event')
+    parser.add_argument('--init', action='store_true', help='write the manifest from the EVENT* directories')
+    args = parser.parse_args()
+    manifest = EventManifest(args.manifest)
+    if args.init:
+        if os.path.exists(args.manifest):
+            parser.error(f"{args.manifest} already exists")
+        manifest.save()
+        print(f"Wrote {len(manifest.entries)} events to {args.manifest}")
+    elif args.sbatch_options:
+        print(' '.join(manifest.sbatch_options(args.sbatch_options)))
+    else:
+        print(' '.join(manifest.events(args.all)))
@@ -0,0 +1,139 @@
+"""
+Reader and writer for the Fortran unformatted (sequential access) .bin files of SPECFEM.
+
+Every record in such a file is stored as
+
+    <int32 nbytes> <nbytes of payload> <int32 nbytes>
+
+Model, kernel and coordinate files (proc*_vp.bin, proc*_alpha_kernel.bin,
+proc*_x.bin, ...) hold a single float32 record and proc*_ibool.bin holds a
+single int32 record. The functions below check the record markers against the
+file size and return the payload only, either read into memory or as a
+zero-copy memmap view.
+
+Files are never rewritten through their existing inode: write_records writes a
+temporary file and renames it over the destination, and create_record removes
+the old file first. A model file hard-linked into DATABASES_MPI (see
+model_staging.py) therefore keeps its contents when the other name is written.
+"""
+import os
+import numpy as np
+
+MARKER_DTYPE = np.dtype('<i4')
+MARKER_SIZE = MARKER_DTYPE.itemsize
+
+
+def scan_records(filename):
+    """
+    Return the (payload offset, payload nbytes) of every record in the file.
+
+    Raises ValueError when a record marker is negative, the leading and trailing
+    markers of a record differ, or a record runs past the end of the file.
+    """
+    file_size = os.path.getsize(filename)
+    records = []
+    with open(filename, 'rb') as f:
+        offset = 0
+        while offset < file_size:
+            if offset + MARKER_SIZE > file_size:
+                raise ValueError(f"{filename}: truncated record marker at byte {offset}")
+            f.seek(offset)
+            nbytes = int(np.frombuffer(f.read(MARKER_SIZE), dtype=MARKER_DTYPE)[0])
+            if nbytes < 0:
+                raise ValueError(f"{filename}: negative record length {nbytes} at byte {offset} "
+                                 "(subrecords are not supported)")
+            end = offset + MARKER_SIZE + nbytes
+            if end + MARKER_SIZE > file_size:
+                raise ValueError(f"{filename}: record of {nbytes} bytes at byte {offset} "
+                                 f"runs past the end of the file ({file_size} bytes)")
+            f.seek(end)
+            trailing = int(np.frombuffer(f.read(MARKER_SIZE), dtype=MARKER_DTYPE)[0])
+            if trailing != nbytes:
+                raise ValueError(f"{filename}: record markers at byte {offset} disagree "
+                                 f"({nbytes} != {trailing})")
+            records.append((offset + MARKER_SIZE, nbytes))
+            offset = end + MARKER_SIZE
+    return records
+
+
+def read_record(filename, dtype='float32', count=None, record=0, mmap=False, mode='r'):
+    """
+    Read the payload of one record.
+
+    Args:
+        filename (str): Fortran unformatted file.
+        dtype (str): Data type of the payload, e.g. 'float32' or 'int32' for ibool.
+        count (int): Expected number of values; a different size raises ValueError.
+        record (int): Index of the record in the file.
+        mmap (bool): Return a memmap view of the payload instead of reading it.
+        mode (str): Memmap mode, 'r' or 'r+' to update the payload in place.
+    """
+    records = scan_records(filename)
+    if record >= len(records):
+        raise ValueError(f"{filename}: record {record} requested but the file has {len(records)} records")
+    offset, nbytes = records[record]
+    return _payload(filename, offset, nbytes, dtype, count, mmap, mode)
+
+
+def read_records(filename, dtypes, mmap=False, mode='r'):
+    """
+    Read every record of a multi-record file, the i-th one as dtypes[i].
+    """
+    records = scan_records(filename)
+    if len(records) != len(dtypes):
+        raise ValueError(f"{filename}: expected {len(dtypes)} records, found {len(records)}")
+    return [_payload(filename, offset, nbytes, dtype, None, mmap, mode)
+            for (offset, nbytes), dtype in zip(records, dtypes)]
+
+
+def write_record(filename, data):
+    """
+    Write one array as a single-record file.
+    """
+    write_records(filename, [data])
+
+
+def write_records(filename, arrays):
+    """
+    Write each array as one record, with the markers set to its size in bytes.
+    The records are written to a temporary file that then replaces filename.
+    """
+    tmp_file = os.path.join(os.path.dirname(filename), f'.{os.path.basename(filename)}.tmp')
+    with open(tmp_file, 'wb') as f:
+        for data in arrays:
+            data = np.ascontiguousarray(data)
+            marker = np.array([data.nbytes], dtype=MARKER_DTYPE)
+            marker.tofile(f)
+            data.tofile(f)
+            marker.tofile(f)
+    os.replace(tmp_file, filename)
+
+
+def create_record(filename, dtype, count):
+    """
+    Create a single-record file of count values and return a writable memmap of its payload.
+    An existing file is removed first, so other hard links to it are left unchanged.
+    """
+    nbytes = np.dtype(dtype).itemsize * count
+    if os.path.lexists(filename):
+        os.remove(filename)
+    marker = np.array([nbytes], dtype=MARKER_DTYPE)
+    with open(filename, 'wb') as f:
+        marker.tofile(f)
+        f.seek(MARKER_SIZE + nbytes)
+        marker.tofile(f)
+    return np.memmap(filename, dtype=dtype, mode='r+', offset=MARKER_SIZE, shape=(count,))
+
+
+def _payload(filename, offset, nbytes, dtype, count, mmap, mode):
+    dtype = np.dtype(dtype)
+    if nbytes % dtype.itemsize:
+        raise ValueError(f"{filename}: record of {nbytes} bytes is not a whole number of {dtype} values")
+    size = nbytes // dtype.itemsize
+    if count is not None and size != count:
+        raise ValueError(f"{filename}: expected {count} {dtype} values, found {size}")
+    if mmap:
+        if size == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode=mode, offset=offset, shape=(size,))
+    return np.fromfile(filename, dtype=dtype, count=size, offset=offset)
@@ -1,19 +1,25 @@
-echo "Copying the Par_file and DATABASES to event directory"
-for EVENT in EVENT1 EVENT2 EVENT3 EVENT4
+# events to simulate, e.g. a mini-batch: bash forward_specfem_all_synmodel.sh EVENT2 EVENT4
+# (default: the enabled events of the event manifest, see event_manifest.py)
+EVENTS=${@:-$(python event_manifest.py)}
+echo "Copying the Par_file and staging DATABASES to event directory"
+for EVENT in $EVENTS
 do
    cp -r DATA/Par_file $EVENT/DATA/Par_file
-   cp -r DATABASES_MPI/* $EVENT/DATABASES_MPI/
 done
+# writes only the changed files (reflinked where the filesystem allows), see model_staging.py
+python model_staging.py DATABASES_MPI $(for EVENT in $EVENTS; do echo $EVENT/DATABASES_MPI; done)
+if [[ $? -ne 0 ]]; then exit 1; fi
 
 echo "Running the forward simulation with new model"
 
-for EVENT in EVENT1 EVENT2 EVENT3 EVENT4
+for EVENT in $EVENTS
 do
     cp Specfem_FWI_for_event.sh $EVENT
+    OPTIONS=$(python event_manifest.py --sbatch-options $EVENT)
     cd $EVENT
     rm -rf SUCCESS
     # Capture the job ID of each sbatch submission
-    job_id=$(sbatch Specfem_FWI_for_event.sh | awk '{print $NF}')
+    job_id=$(sbatch $OPTIONS Specfem_FWI_for_event.sh | awk '{print $NF}')
     echo "Submitted batch job $job_id"  # Only output the job ID line for Python to parse
     cd ..
 done
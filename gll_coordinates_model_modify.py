@@ -2,45 +2,62 @@
 # coding: utf-8
 # %% [markdown]
 # this code could generate the real x y z coordinates for gll points, then you could modify your velocity model easily.
-# note that, the first and final points in the orginal binary file is not used for the generation of gll coorinate files e.g. proc000000x_gll_recovered.bin
+# note that, the binary files are Fortran records: the record markers are checked and dropped by fortran_io, and the gll coordinate files e.g. proc000000_x_gll_recovered.bin are plain float32 arrays without markers
 
 import numpy as np
 import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from fortran_io import read_record, write_record
 databases_mpi_path='DATABASES_MPI'
+GLL_CACHE_DIR='GLL_CACHE'
 
 
 
 
 
+def mesh_nspec(size, filename=''):
+    """
+    Number of spectral elements for a GLL field of the given size.
+    """
+    if size % (5 * 5 * 5):
+        raise ValueError(f"{filename}: {size} values is not a whole number of 5x5x5 elements")
+    return size // (5 * 5 * 5)
+
+
+def gather_gll_coordinates(ibool, x_store, y_store, z_store):
+    """
+    Gather the global x, y, z coordinates onto the GLL points given by ibool.
+
+    Returns a float32 array of shape (3,) + ibool.shape. Entries of ibool below 1
+    are invalid and get the coordinate 0.
+    """
+    iglob = ibool.astype(np.int64) - 1  # Fortran to Python index conversion
+    xyz_store = np.stack((x_store, y_store, z_store)).astype('float32', copy=False)
+    if iglob.size and iglob.max() >= xyz_store.shape[1]:
+        raise ValueError(f"ibool refers to global point {iglob.max() + 1} but only {xyz_store.shape[1]} coordinates were given")
+    valid = iglob >= 0
+    if valid.all():
+        return xyz_store[:, iglob]
+    xyz_gll = np.zeros((3,) + ibool.shape, dtype='float32')
+    xyz_gll[:, valid] = xyz_store[:, iglob[valid]]
+    return xyz_gll
+
 
 def recover_gll_coordinates(vp_file, ibool_file, x_file, y_file, z_file, output_dir='DATABASES_MPI', processor_id='000000'):
     # Load the input data
-    vp = np.fromfile(vp_file, dtype='float32')
-    nspec = (vp.size - 2) // (5 * 5 * 5)  # Calculate nspec based on vp size, excluding first and last points
-    vp = vp[1:-1].reshape((nspec, 5, 5, 5))
+    vp = read_record(vp_file)
+    nspec = mesh_nspec(vp.size, vp_file)
+    vp = vp.reshape((nspec, 5, 5, 5))
     
-    ibool = np.fromfile(ibool_file, dtype='int32')[1:-1].reshape((nspec, 5, 5, 5))
-    x_store = np.fromfile(x_file, dtype='float32')[1:]
-    y_store = np.fromfile(y_file, dtype='float32')[1:]
-    z_store = np.fromfile(z_file, dtype='float32')[1:]
-
-    # Initialize output arrays with the same shape as vp
-    x_gll = np.zeros(vp.shape, dtype='float32')
-    y_gll = np.zeros(vp.shape, dtype='float32')
-    z_gll = np.zeros(vp.shape, dtype='float32')
-    #print(nspec)
-    # Iterate over all elements and GLL points to recover global coordinates
-    for ispec in range(nspec):
-        for i in range(5):
-            for j in range(5):
-                for k in range(5):
-                    iglob = ibool[ispec, i, j, k]-1  # Fortran to Python index conversion
-                    #print(iglob)
-                    if iglob >= 0:  # Ensure valid index
-                        #print(ispec, i, j, k,   z_store[iglob])
-                        x_gll[ispec, i, j, k] = x_store[iglob]
-                        y_gll[ispec, i, j, k] = y_store[iglob]
-                        z_gll[ispec, i, j, k] = z_store[iglob]
+    ibool = read_record(ibool_file, dtype='int32', count=vp.size).reshape((nspec, 5, 5, 5))
+    x_store = read_record(x_file)
+    y_store = read_record(y_file, count=x_store.size)
+    z_store = read_record(z_file, count=x_store.size)
+
+    # Gather the global coordinates of all GLL points at once
+    x_gll, y_gll, z_gll = gather_gll_coordinates(ibool, x_store, y_store, z_store)
 
     # Ensure output directory exists
     os.makedirs(output_dir, exist_ok=True)
@@ -50,60 +67,309 @@ def recover_gll_coordinates(vp_file, ibool_file, x_file, y_file, z_file, output_
     y_gll.tofile(os.path.join(output_dir, f'proc{processor_id}_y_gll_recovered.bin'))
     z_gll.tofile(os.path.join(output_dir, f'proc{processor_id}_z_gll_recovered.bin'))
 
-# Example usage for multiple processors:
-ncpu=12
-for proc_id in range(ncpu):
-    print(proc_id)
-    processor_id_str = f'{proc_id:06d}'
-    recover_gll_coordinates(
-        f'DATABASES_MPI/proc{processor_id_str}_vp.bin',
-        f'DATABASES_MPI/proc{processor_id_str}_ibool.bin',
-        f'DATABASES_MPI/proc{processor_id_str}_x.bin',
-        f'DATABASES_MPI/proc{processor_id_str}_y.bin',
-        f'DATABASES_MPI/proc{processor_id_str}_z.bin',
-        output_dir='DATABASES_MPI',
-        processor_id=processor_id_str
-    )
 
+def recover_all_gll_coordinates(databases_dir='DATABASES_MPI', output_dir='DATABASES_MPI', processor_count=12, workers=1):
+    """
+    Recover the GLL coordinates of every processor slice, spread over `workers` processes.
+    """
+    tasks = []
+    for proc_id in range(processor_count):
+        processor_id_str = f'{proc_id:06d}'
+        tasks.append((
+            os.path.join(databases_dir, f'proc{processor_id_str}_vp.bin'),
+            os.path.join(databases_dir, f'proc{processor_id_str}_ibool.bin'),
+            os.path.join(databases_dir, f'proc{processor_id_str}_x.bin'),
+            os.path.join(databases_dir, f'proc{processor_id_str}_y.bin'),
+            os.path.join(databases_dir, f'proc{processor_id_str}_z.bin'),
+            output_dir,
+            processor_id_str,
+        ))
+    if workers <= 1:
+        for task in tasks:
+            recover_gll_coordinates(*task)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(recover_gll_coordinates, *task) for task in tasks]:
+            future.result()
+
+
+def mesh_files(databases_dir, processor_id):
+    """
+    The ibool, x, y, z files that define the geometry of one slice.
+    """
+    return [os.path.join(databases_dir, f'proc{processor_id}_{name}.bin') for name in ['ibool', 'x', 'y', 'z']]
+
+
+def mesh_hash(databases_dir, processor_id):
+    """
+    Content hash of the ibool, x, y, z files of one slice, including its nspec.
+    """
+    ibool_file = mesh_files(databases_dir, processor_id)[0]
+    nspec = mesh_nspec(read_record(ibool_file, dtype='int32', mmap=True).size, ibool_file)
+    digest = hashlib.sha1(f'nspec={nspec}'.encode())
+    for filename in mesh_files(databases_dir, processor_id):
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def load_gll_coordinates(databases_dir='DATABASES_MPI', processor_id='000000', cache_dir=GLL_CACHE_DIR):
+    """
+    Return the GLL coordinates of one slice as a read-only (3, nspec, 5, 5, 5) memmap.
+
+    The coordinates are cached in cache_dir under the content hash of the slice's
+    ibool, x, y, z files and built on first use. A small stat file remembers which
+    hash belongs to which mesh files, so later calls only stat the mesh files
+    and open the cache; the files are hashed again only when they have changed.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    files = mesh_files(databases_dir, processor_id)
+    signature = [[os.path.realpath(f), os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in files]
+    path_key = hashlib.sha1(os.path.realpath(files[0]).encode()).hexdigest()[:16]
+    stat_file = os.path.join(cache_dir, f'proc{processor_id}_{path_key}.stat.json')
+
+    key = None
+    if os.path.exists(stat_file):
+        with open(stat_file) as f:
+            stat = json.load(f)
+        if stat['signature'] == signature:
+            key = stat['key']
+    if key is None:
+        key = mesh_hash(databases_dir, processor_id)
+        _write_atomic(stat_file, lambda f: f.write(json.dumps({'signature': signature, 'key': key}).encode()))
+
+    cache_file = os.path.join(cache_dir, f'proc{processor_id}_{key}.npy')
+    if not os.path.exists(cache_file):
+        ibool_file, x_file, y_file, z_file = files
+        ibool = read_record(ibool_file, dtype='int32')
+        nspec = mesh_nspec(ibool.size, ibool_file)
+        x_store = read_record(x_file)
+        xyz_gll = gather_gll_coordinates(ibool.reshape((nspec, 5, 5, 5)), x_store,
+                                         read_record(y_file, count=x_store.size),
+                                         read_record(z_file, count=x_store.size))
+        _write_atomic(cache_file, lambda f: np.save(f, xyz_gll))
+    return np.load(cache_file, mmap_mode='r')
+
+
+def build_gll_cache(databases_dir='DATABASES_MPI', processor_count=12, cache_dir=GLL_CACHE_DIR, workers=1):
+    """
+    Build or validate the GLL coordinate cache of every slice, spread over `workers` processes.
+    """
+    processor_ids = [f'{proc_id:06d}' for proc_id in range(processor_count)]
+    if workers <= 1:
+        for processor_id in processor_ids:
+            load_gll_coordinates(databases_dir, processor_id, cache_dir)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(_cache_slice, databases_dir, processor_id, cache_dir) for processor_id in processor_ids]:
+            future.result()
+
+
+def _cache_slice(databases_dir, processor_id, cache_dir):
+    load_gll_coordinates(databases_dir, processor_id, cache_dir)
+
+
+def _write_atomic(filename, write):
+    tmp_file = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as f:
+        write(f)
+    os.replace(tmp_file, filename)
+
+class Box:
+    """
+    Points with xmin <= x <= xmax, ymin <= y <= ymax and zmin <= z <= zmax.
+    """
+    def __init__(self, xmin, xmax, ymin, ymax, zmin, zmax):
+        self.xmin, self.xmax = xmin, xmax
+        self.ymin, self.ymax = ymin, ymax
+        self.zmin, self.zmax = zmin, zmax
+
+    def bounds(self):
+        return (self.xmin, self.ymin, self.zmin), (self.xmax, self.ymax, self.zmax)
+
+    def value(self, x, y, z):
+        inside = ((x >= self.xmin) & (x <= self.xmax) & (y >= self.ymin) & (y <= self.ymax)
+                  & (z >= self.zmin) & (z <= self.zmax))
+        return inside.astype('float32')
+
+
+class Sphere:
+    """
+    Points within radius of center.
+    """
+    def __init__(self, center, radius):
+        self.center, self.radius = tuple(center), radius
+
+    def bounds(self):
+        return (tuple(c - self.radius for c in self.center), tuple(c + self.radius for c in self.center))
+
+    def value(self, x, y, z):
+        cx, cy, cz = self.center
+        return ((x - cx) ** 2 + (y - cy) ** 2 + (z - cz) ** 2 <= self.radius ** 2).astype('float32')
+
+
+class GaussianBlob:
+    """
+    Gaussian exp(-r^2 / 2) of the distance r scaled by sigma (a number or one per axis),
+    cut to zero beyond `cutoff` sigmas.
+    """
+    def __init__(self, center, sigma, cutoff=3.0):
+        self.center = tuple(center)
+        self.sigma = tuple(sigma) if np.ndim(sigma) else (sigma,) * 3
+        self.cutoff = cutoff
 
+    def bounds(self):
+        return (tuple(c - self.cutoff * s for c, s in zip(self.center, self.sigma)),
+                tuple(c + self.cutoff * s for c, s in zip(self.center, self.sigma)))
 
-def apply_velocity_anomaly(vp_file, x_file, y_file, z_file, output_dir='DATABASES_MPI', processor_id='000000'):
+    def value(self, x, y, z):
+        r2 = sum(((v - c) / s) ** 2 for v, c, s in zip((x, y, z), self.center, self.sigma))
+        return np.where(r2 <= self.cutoff ** 2, np.exp(-0.5 * r2), 0).astype('float32')
+
+
+class Checkerboard:
+    """
+    Alternating +1/-1 cells of the given size per axis starting at origin, or the
+    smooth product of sines when smooth is True, optionally limited to a Box.
+    """
+    def __init__(self, size, origin=(0.0, 0.0, 0.0), limits=None, smooth=False):
+        self.size, self.origin = tuple(size), tuple(origin)
+        self.limits, self.smooth = limits, smooth
+
+    def bounds(self):
+        return self.limits.bounds() if self.limits is not None else None
+
+    def value(self, x, y, z):
+        sines = [np.sin(np.pi * (v - o) / s) for v, o, s in zip((x, y, z), self.origin, self.size)]
+        pattern = sines[0] * sines[1] * sines[2]
+        if not self.smooth:
+            pattern = np.sign(pattern)
+        if self.limits is not None:
+            pattern = pattern * self.limits.value(x, y, z)
+        return pattern.astype('float32')
+
+
+class Perturbation:
+    """
+    Perturb the fields named in amplitudes, e.g. {'vp': 0.1, 'vs': -0.05}, inside a region.
+
+    With mode 'multiplicative' a field becomes field * (1 + amplitude * value), with
+    mode 'additive' field + amplitude * value, where value is the region's shape
+    (1 inside a Box or Sphere, the Gaussian for a GaussianBlob, +-1 for a Checkerboard).
+    """
+    def __init__(self, region, amplitudes, mode='multiplicative'):
+        if mode not in ('multiplicative', 'additive'):
+            raise ValueError(f"unknown perturbation mode {mode!r}")
+        self.region, self.amplitudes, self.mode = region, dict(amplitudes), mode
+
+
+def candidate_elements(region, element_min, element_max):
+    """
+    Indices of the elements whose bounding box intersects the bounding box of the region.
+    """
+    bounds = region.bounds()
+    if bounds is None:
+        return np.arange(element_min.shape[1])
+    low, high = (np.asarray(b, dtype='float64')[:, None] for b in bounds)
+    return np.nonzero(np.all((element_max >= low) & (element_min <= high), axis=0))[0]
+
+
+def perturb_slice(databases_dir, processor_id, perturbations, output_dir=None, cache_dir=GLL_CACHE_DIR):
+    """
+    Apply a list of Perturbation to the model of one slice and write every field they name.
+
+    Only elements whose bounding box intersects a region are evaluated. Returns the
+    number of GLL points changed per field.
+    """
+    output_dir = output_dir or databases_dir
+    xyz_gll = load_gll_coordinates(databases_dir, processor_id, cache_dir)
+    nspec = xyz_gll.shape[1]
+    points = xyz_gll.reshape((3, nspec, 5 * 5 * 5))
+    element_min, element_max = points.min(axis=2), points.max(axis=2)
+
+    fields, changed = {}, {}
+    for name in sorted(set(name for perturbation in perturbations for name in perturbation.amplitudes)):
+        model_file = os.path.join(databases_dir, f'proc{processor_id}_{name}.bin')
+        fields[name] = read_record(model_file, count=nspec * 5 * 5 * 5).reshape((nspec, 5 * 5 * 5))
+        changed[name] = np.zeros(fields[name].shape, dtype=bool)
+
+    for perturbation in perturbations:
+        elements = candidate_elements(perturbation.region, element_min, element_max)
+        if not elements.size:
+            continue
+        x, y, z = points[:, elements]
+        value = perturbation.region.value(x, y, z)
+        for name, amplitude in perturbation.amplitudes.items():
+            if perturbation.mode == 'multiplicative':
+                fields[name][elements] *= 1 + amplitude * value
+            else:
+                fields[name][elements] += amplitude * value
+            changed[name][elements] |= value != 0
+
+    # Ensure output directory exists
+    os.makedirs(output_dir, exist_ok=True)
+    for name, values in fields.items():
+        write_record(os.path.join(output_dir, f'proc{processor_id}_{name}.bin'), values)
+    return {name: int(mask.sum()) for name, mask in changed.items()}
+
+
+def perturb_model(databases_dir, perturbations, output_dir=None, processor_count=12, cache_dir=GLL_CACHE_DIR, workers=1):
+    """
+    Apply a list of Perturbation to every slice of a model, spread over `workers` processes.
+    """
+    processor_ids = [f'{proc_id:06d}' for proc_id in range(processor_count)]
+    if workers <= 1:
+        results = [perturb_slice(databases_dir, processor_id, perturbations, output_dir, cache_dir)
+                   for processor_id in processor_ids]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(perturb_slice, databases_dir, processor_id, perturbations, output_dir, cache_dir)
+                       for processor_id in processor_ids]
+            results = [future.result() for future in futures]
+    for processor_id, counts in zip(processor_ids, results):
+        print(f'proc{processor_id}: perturbed GLL points {counts}')
+    return results
+
+
+# High velocity anomaly in the middle of x and y, and between -70 to -150 km in z
+ANOMALY_BOX = Box(382462.359375+100000, 442462.359375+100000, 4349473.75+100000, 4369473.75+130000, -150e3, -70e3)
+
+
+def apply_velocity_anomaly(vp_file, x_file=None, y_file=None, z_file=None, output_dir='DATABASES_MPI', processor_id='000000',
+                           region=ANOMALY_BOX, amplitude=0.1):
     # Load the input data
-    vp = np.fromfile(vp_file, dtype='float32')
-    first_element = vp[0]
-    last_element = vp[-1]
-    nspec = (vp.size - 2) // (5 * 5 * 5)  # Calculate nspec based on vp size, excluding first and last points
-    vp = vp[1:-1].reshape((nspec, 5, 5, 5))
-
-    x_gll = np.fromfile(x_file, dtype='float32').reshape((nspec, 5, 5, 5))
-    y_gll = np.fromfile(y_file, dtype='float32').reshape((nspec, 5, 5, 5))
-    z_gll = np.fromfile(z_file, dtype='float32').reshape((nspec, 5, 5, 5))
-    
-    # Apply high velocity anomaly in the middle of x and y, and between -100 to -150 km in z
-    for ispec in range(nspec):
-        for k in range(5):
-            for j in range(5):
-                for i in range(5):
-                    if -150e3 <= z_gll[ispec, i, j, k] <= -70e3:      
-                        if x_gll[ispec, i, j, k] <= 442462.359375+100000  and y_gll[ispec, i, j, k] <=  4369473.75+130000 and  x_gll[ispec, i, j, k] >= 382462.359375+100000  and y_gll[ispec, i, j, k] >= 4349473.75+100000:
-                            print('find')
-                            vp[ispec, i, j, k] *= 1.1  # Increase velocity by 50%
-    vp_modified = np.concatenate(([first_element], vp.flatten(), [last_element]))
+    vp = read_record(vp_file)
+    nspec = mesh_nspec(vp.size, vp_file)
+    vp = vp.reshape((nspec, 5, 5, 5))
+
+    if x_file is None:
+        # Use the cached coordinates of the mesh next to vp_file
+        x_gll, y_gll, z_gll = load_gll_coordinates(os.path.dirname(vp_file) or '.', processor_id)
+        if x_gll.shape != vp.shape:
+            raise ValueError(f"{vp_file}: {nspec} elements but the mesh has {x_gll.shape[0]}")
+    else:
+        x_gll = np.fromfile(x_file, dtype='float32', count=vp.size).reshape((nspec, 5, 5, 5))
+        y_gll = np.fromfile(y_file, dtype='float32', count=vp.size).reshape((nspec, 5, 5, 5))
+        z_gll = np.fromfile(z_file, dtype='float32', count=vp.size).reshape((nspec, 5, 5, 5))
+
+    # Increase velocity by 10% inside the region
+    vp *= 1 + amplitude * region.value(x_gll, y_gll, z_gll)
     # Ensure output directory exists
     os.makedirs(output_dir, exist_ok=True)
 
     # Write modified vp to binary file
-    vp_modified.tofile(os.path.join(output_dir, f'proc{processor_id}_vp.bin'))
-
-# Example usage for multiple processors:
-for proc_id in range(12):
-    processor_id_str = f'{proc_id:06d}'
-    apply_velocity_anomaly(
-        f'DATABASES_MPI/proc{processor_id_str}_vp.bin',
-        f'DATABASES_MPI/proc{processor_id_str}_x_gll_recovered.bin',
-        f'DATABASES_MPI/proc{processor_id_str}_y_gll_recovered.bin',
-        f'DATABASES_MPI/proc{processor_id_str}_z_gll_recovered.bin',
-        output_dir='DATABASES_MPI',
-        processor_id=processor_id_str
-    )
+    write_record(os.path.join(output_dir, f'proc{processor_id}_vp.bin'), vp)
+
+if __name__ == '__main__':
+    # Example usage for multiple processors:
+    ncpu=12
+    build_gll_cache('DATABASES_MPI', processor_count=ncpu, workers=ncpu)
+
+    # Example usage for multiple processors: +10% vp in the anomaly box
+    perturb_model('DATABASES_MPI', [Perturbation(ANOMALY_BOX, {'vp': 0.1})],
+                  output_dir='DATABASES_MPI', processor_count=ncpu, workers=ncpu)
 
+    # Example checkerboard resolution test: +-5% vp and vs in 20 km cells
+    # perturb_model('DATABASES_MPI', [Perturbation(Checkerboard((20e3, 20e3, 20e3)), {'vp': 0.05, 'vs': 0.05})],
+    #               output_dir='DATABASES_MPI_checkerboard', processor_count=ncpu, workers=ncpu)
@@ -0,0 +1,129 @@
+"""
+Persistent state of a multi-iteration inversion, so an interrupted run can resume.
+
+The state file (JSON, rewritten atomically after every change) records for
+every iteration the stages that finished and, per stage, the size and mtime
+of every output file and the values the stage produced (misfits, step
+length, ...):
+
+    {"iterations": {"7": {"stages": {"forward": {"finished": "...",
+                                                 "outputs": {path: [size, mtime_ns]},
+                                                 "values": {}}, ...},
+                          "complete": true}}}
+
+A finished stage is trusted only while its outputs are unchanged, i.e. still
+have the recorded size and mtime. The outputs include every per-event
+seismogram and kernel, so they are not hashed.
+"""
+import os
+import glob
+import json
+import datetime
+
+STATE_FILE = 'inversion_state.json'
+
+
+def file_signature(filename):
+    """
+    [size, mtime_ns] of a file.
+    """
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def output_files(patterns):
+    """
+    The files matching each glob pattern, sorted. Raises RuntimeError if a
+    pattern matches nothing.
+    """
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise RuntimeError(f"no output files match {pattern}")
+        files += matches
+    return files
+
+
+def outputs_unchanged(outputs):
+    """
+    True if every recorded output file still exists with the recorded size and mtime.
+    State files written before the sha1 was dropped hold [size, mtime_ns, sha1].
+    """
+    for filename, signature in outputs.items():
+        if not os.path.exists(filename) or file_signature(filename) != signature[:2]:
+            return False
+    return True
+
+
+class InversionState:
+    """
+    Read and update the state file of an inversion.
+    """
+    def __init__(self, filename=STATE_FILE):
+        self.filename = filename
+        self.state = {'iterations': {}}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.state = json.load(f)
+
+    def iteration(self, iteration):
+        """
+        The (mutable) record of an iteration, created if needed.
+        """
+        return self.state['iterations'].setdefault(str(iteration), {'stages': {}})
+
+    def save(self):
+        tmp_file = f'{self.filename}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(tmp_file, self.filename)
+
+    def finish_stage(self, iteration, stage, patterns, values=None):
+        """
+        Record a stage as finished together with the signatures of its outputs and
+        the values it produced.
+        """
+        outputs = {filename: file_signature(filename) for filename in output_files(patterns)}
+        self.iteration(iteration)['stages'][stage] = {'finished': str(datetime.datetime.now()), 'outputs': outputs,
+                                                      'values': values or {}}
+        self.save()
+
+    def values(self, iteration):
+        """
+        The values produced by the finished stages of an iteration, later stages
+        taking precedence.
+        """
+        values = {}
+        for stage in self.iteration(iteration)['stages'].values():
+            values.update(stage['values'])
+        return values
+
+    def reset_stages(self, iteration, stages):
+        """
+        Forget the given stages of an iteration, e.g. the ones after a stage that is rerun.
+        """
+        record = self.iteration(iteration)
+        for stage in stages:
+            record['stages'].pop(stage, None)
+        self.save()
+
+    def resume_index(self, iteration, stages):
+        """
+        Index of the first stage to run: one past the last recorded stage whose
+        outputs are unchanged. Earlier stages count as done even if their outputs
+        were consumed since (e.g. seismograms moved by the adjoint run).
+        """
+        recorded = self.iteration(iteration)['stages']
+        for index in range(len(stages) - 1, -1, -1):
+            stage = recorded.get(stages[index])
+            if stage is not None and outputs_unchanged(stage['outputs']):
+                return index + 1
+        return 0
+
+    def set(self, iteration, **values):
+        """
+        Store values in the record of an iteration itself, e.g. complete=True.
+        """
+        self.iteration(iteration).update(values)
+        self.save()
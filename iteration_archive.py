@@ -0,0 +1,398 @@
+"""
+Compressed, deduplicated archive of finished iterations.
+
+An iteration leaves full float32 copies of its model (MODEL_<n>_test), its
+summed kernels (SUMMED_KERNELS_l2_ITER<n>: raw, clipped, smoothed, ...) and
+the synthetics of every event (<event>/REF_SEM_<n>). archive_iteration packs
+them into ARCHIVE/:
+
+    ARCHIVE/iteration_0007.json          relative path -> object of every file
+    ARCHIVE/objects/<key>.json           how an object is encoded and where its chunks are
+    ARCHIVE/objects/<key>.bin            its compressed chunks
+
+Files made of one Fortran record (.bin) are stored as their 32-bit words in
+chunks of CHUNK_VALUES values, byte-shuffled (all first bytes, then all second
+bytes, ...) and zlib-compressed, so every chunk decompresses on its own and a
+range of one slice is read without touching the rest. Model files are stored
+as the XOR of their words with the same file of the previous iteration's model,
+which leaves mostly zero high bytes where the model hardly changed; every
+`keyframe_every` iterations a model is stored in full, so a read never walks
+more than that many deltas. Kernels may optionally be rounded to `kernel_bits`
+mantissa bits (lossy, relative error below 2^-(kernel_bits+1)). Other files are
+stored as zlib-compressed bytes.
+
+Objects are named by the checksum of the original file and of how it is
+encoded, so identical files (e.g. the coordinates linked into every kernel
+directory) are stored once. restore writes the original files back, with
+their record markers; lossless files are checked against their sha1.
+
+Usage:
+    python iteration_archive.py archive ITERATION [--kernel-bits 16] [--keyframe-every 5] [--workers N] [--remove]
+    python iteration_archive.py restore ITERATION [--output DIR] [--files PATH ...]
+    python iteration_archive.py list ITERATION
+"""
+import os
+import json
+import zlib
+import shutil
+import hashlib
+import argparse
+import datetime
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from fortran_io import scan_records, MARKER_DTYPE
+from model_staging import file_sha1
+from event_manifest import EventManifest
+
+ARCHIVE_DIR = 'ARCHIVE'
+CHUNK_VALUES = 1 << 20
+WORD = np.dtype('<u4')
+
+
+def iteration_directories(iteration, event_dirs=None):
+    """
+    The directories an iteration leaves behind: its model, its summed kernels and
+    the REF_SEM_<iteration> backups of event_dirs (default: all events of the manifest).
+    """
+    event_dirs = event_dirs or EventManifest().events(include_disabled=True)
+    return ([f'MODEL_{iteration}_test', f'SUMMED_KERNELS_l2_ITER{iteration}'] +
+            [os.path.join(event_dir, f'REF_SEM_{iteration}') for event_dir in event_dirs])
+
+
+def shuffle(words):
+    return words.view(np.uint8).reshape(-1, WORD.itemsize).T.tobytes()
+
+
+def unshuffle(data):
+    return np.frombuffer(data, dtype=np.uint8).reshape(WORD.itemsize, -1).T.copy().view(WORD).ravel()
+
+
+def round_mantissa(words, bits):
+    """
+    Round float32 words to `bits` mantissa bits (to nearest, ties to even).
+    """
+    drop = 23 - bits
+    wide = words.astype(np.uint64)
+    wide += (1 << (drop - 1)) - 1 + ((wide >> drop) & 1)
+    return (wide & ~np.uint64((1 << drop) - 1)).astype(WORD)
+
+
+def single_record(filename):
+    """
+    (payload offset, nbytes) if the file is a .bin file of one record of 32-bit words, else None.
+    """
+    if not filename.endswith('.bin'):
+        return None
+    try:
+        records = scan_records(filename)
+    except ValueError:
+        return None
+    if len(records) != 1 or records[0][1] % WORD.itemsize:
+        return None
+    return records[0]
+
+
+class IterationArchive:
+    """
+    Archive of finished iterations; see the module docstring.
+
+    Args:
+        archive_dir (str): Directory of the archive.
+        level (int): zlib compression level.
+    """
+    def __init__(self, archive_dir=ARCHIVE_DIR, level=6):
+        self.archive_dir = archive_dir
+        self.objects_dir = os.path.join(archive_dir, 'objects')
+        self.level = level
+        self.metas = {}
+
+    def manifest_file(self, iteration):
+        return os.path.join(self.archive_dir, f'iteration_{iteration:04d}.json')
+
+    def manifest(self, iteration):
+        """
+        {relative path: object key} of an archived iteration, or None.
+        """
+        if not os.path.exists(self.manifest_file(iteration)):
+            return None
+        with open(self.manifest_file(iteration)) as f:
+            return json.load(f)['files']
+
+    def meta(self, key):
+        if key not in self.metas:
+            with open(os.path.join(self.objects_dir, f'{key}.json')) as f:
+                self.metas[key] = json.load(f)
+        return self.metas[key]
+
+    def chunk(self, key, index):
+        """
+        The decoded words (or, for raw objects, bytes) of one chunk of an object.
+        """
+        meta = self.meta(key)
+        offset, nbytes = meta['chunks'][index]
+        with open(os.path.join(self.objects_dir, f'{key}.bin'), 'rb') as f:
+            f.seek(offset)
+            data = zlib.decompress(f.read(nbytes))
+        if meta['encoding'] == 'raw':
+            return data
+        words = unshuffle(data)
+        if meta['base'] is not None:
+            words ^= self.chunk(meta['base'], index)
+        return words
+
+    def store(self, filename, base=None, bits=None, keyframe_every=5, chunk_values=CHUNK_VALUES):
+        """
+        Store one file as an object, delta-encoded against the object `base` if given,
+        unless the delta chain is already keyframe_every long; returns its key.
+        """
+        record = single_record(filename)
+        base_meta = self.meta(base) if base is not None else None
+        if (record is None or base_meta is None or base_meta['encoding'] != 'record'
+                or base_meta['count'] != record[1] // WORD.itemsize or base_meta['chunk_values'] != chunk_values
+                or base_meta['depth'] + 1 >= keyframe_every):
+            base = None
+        if record is None:
+            bits = None
+        description = json.dumps([file_sha1(filename), 'raw' if record is None else 'record', base, bits, chunk_values])
+        key = hashlib.sha1(description.encode()).hexdigest()
+        if os.path.exists(os.path.join(self.objects_dir, f'{key}.json')):
+            return key
+        os.makedirs(self.objects_dir, exist_ok=True)
+        tmp_file = os.path.join(self.objects_dir, f'{key}.bin.{os.getpid()}.tmp')
+        chunks, offset = [], 0
+        with open(filename, 'rb') as src, open(tmp_file, 'wb') as dst:
+            if record is not None:
+                src.seek(record[0])
+            remaining = record[1] if record is not None else os.path.getsize(filename)
+            index = 0
+            while remaining > 0:
+                data = src.read(min(remaining, chunk_values * WORD.itemsize))
+                remaining -= len(data)
+                if record is not None:
+                    words = np.frombuffer(data, dtype=WORD)
+                    if bits is not None:
+                        words = round_mantissa(words, bits)
+                    if base is not None:
+                        words = words ^ self.chunk(base, index)
+                    data = shuffle(words)
+                compressed = zlib.compress(data, self.level)
+                dst.write(compressed)
+                chunks.append([offset, len(compressed)])
+                offset += len(compressed)
+                index += 1
+        meta = {'encoding': 'raw' if record is None else 'record', 'size': os.path.getsize(filename),
+                'sha1': file_sha1(filename), 'chunks': chunks, 'chunk_values': chunk_values, 'stored': offset,
+                'lossless': bits is None}
+        if record is not None:
+            meta.update({'count': record[1] // WORD.itemsize, 'base': base, 'bits': bits,
+                         'depth': base_meta['depth'] + 1 if base is not None else 0})
+        os.replace(tmp_file, os.path.join(self.objects_dir, f'{key}.bin'))
+        tmp_file = os.path.join(self.objects_dir, f'{key}.json.{os.getpid()}.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_file, os.path.join(self.objects_dir, f'{key}.json'))
+        self.metas[key] = meta
+        return key
+
+    def archive_iteration(self, iteration, directories=None, kernel_bits=None, keyframe_every=5, workers=1):
+        """
+        Archive every (non-hidden) file of the directories of an iteration (default:
+        iteration_directories) and return its manifest. Kernels are rounded to
+        kernel_bits mantissa bits if given; model files are delta-encoded against the
+        previous iteration's model when it is archived.
+        """
+        directories = [directory for directory in (directories or iteration_directories(iteration))
+                       if os.path.isdir(directory)]
+        previous = self.manifest(iteration - 1) or {}
+        model_dir, previous_model_dir = f'MODEL_{iteration}_test', f'MODEL_{iteration - 1}_test'
+        tasks = []
+        for directory in directories:
+            for root, subdirs, names in os.walk(directory):
+                subdirs[:] = sorted(subdir for subdir in subdirs if not subdir.startswith('.'))
+                for name in sorted(names):
+                    if name.startswith('.'):
+                        continue
+                    path = os.path.normpath(os.path.join(root, name))
+                    base = None
+                    if os.path.dirname(path) == model_dir:
+                        base = previous.get(os.path.join(previous_model_dir, name))
+                    bits = kernel_bits if '_kernel' in name else None
+                    tasks.append((path, base, bits))
+        if workers <= 1:
+            keys = [self.store(path, base, bits, keyframe_every) for path, base, bits in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_store, self.archive_dir, self.level, path, base, bits, keyframe_every)
+                           for path, base, bits in tasks]
+                keys = [future.result() for future in futures]
+        files = dict((path, key) for (path, base, bits), key in zip(tasks, keys))
+        os.makedirs(self.archive_dir, exist_ok=True)
+        tmp_file = f'{self.manifest_file(iteration)}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'iteration': iteration, 'created': str(datetime.datetime.now()), 'directories': directories,
+                       'files': files}, f, indent=1)
+        os.replace(tmp_file, self.manifest_file(iteration))
+        self.report(iteration)
+        return files
+
+    def read(self, iteration, path, start=0, stop=None, dtype='float32'):
+        """
+        Values [start, stop) of the record of an archived .bin file, e.g.
+        read(7, 'MODEL_7_test/proc000003_vp.bin'); only the chunks holding them are decoded.
+        """
+        key = self.manifest(iteration)[os.path.normpath(path)]
+        meta = self.meta(key)
+        if meta['encoding'] != 'record':
+            raise ValueError(f"{path} is not a single-record .bin file")
+        stop = meta['count'] if stop is None else min(stop, meta['count'])
+        if stop <= start:
+            return np.empty(0, dtype=dtype)
+        chunk_values = meta['chunk_values']
+        first, last = start // chunk_values, (stop - 1) // chunk_values
+        words = np.concatenate([self.chunk(key, index) for index in range(first, last + 1)])
+        return words[start - first * chunk_values:stop - first * chunk_values].view(dtype)
+
+    def read_slice(self, iteration, directory, processor_id, dtype='float32'):
+        """
+        {file name: values} of every archived .bin file of one slice in one directory of an iteration.
+        """
+        prefix = os.path.join(os.path.normpath(directory), f'proc{processor_id}_')
+        return dict((os.path.basename(path), self.read(iteration, path, dtype=dtype))
+                    for path, key in sorted(self.manifest(iteration).items())
+                    if path.startswith(prefix) and self.meta(key)['encoding'] == 'record')
+
+    def restore_file(self, key, filename):
+        """
+        Write an object back as its original file; returns False if a lossless one does not match its sha1.
+        """
+        meta = self.meta(key)
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        tmp_file = f'{filename}.{os.getpid()}.restore'
+        with open(tmp_file, 'wb') as f:
+            if meta['encoding'] == 'record':
+                marker = np.array([meta['count'] * WORD.itemsize], dtype=MARKER_DTYPE).tobytes()
+                f.write(marker)
+            for index in range(len(meta['chunks'])):
+                data = self.chunk(key, index)
+                f.write(data if meta['encoding'] == 'raw' else data.tobytes())
+            if meta['encoding'] == 'record':
+                f.write(marker)
+        if meta['lossless'] and file_sha1(tmp_file) != meta['sha1']:
+            os.remove(tmp_file)
+            return False
+        os.replace(tmp_file, filename)
+        return True
+
+    def restore(self, iteration, output_dir='.', paths=None):
+        """
+        Write the files of an archived iteration (or only `paths`) back under output_dir.
+        """
+        files = self.manifest(iteration)
+        if files is None:
+            raise ValueError(f"iteration {iteration} is not archived in {self.archive_dir}")
+        failed = []
+        for path in paths or sorted(files):
+            if not self.restore_file(files[os.path.normpath(path)], os.path.join(output_dir, path)):
+                failed.append(path)
+        if failed:
+            raise RuntimeError(f"restored files do not match their checksums: {failed}")
+        print(f"Restored {len(paths or files)} files of iteration {iteration} to {output_dir}.")
+
+    def verify(self, iteration):
+        """
+        Paths of the archived files of an iteration that do not decode to their original
+        contents (lossless files) or size (rounded kernels).
+        """
+        bad = []
+        for path, key in sorted(self.manifest(iteration).items()):
+            meta = self.meta(key)
+            digest = hashlib.sha1()
+            size = 0
+            if meta['encoding'] == 'record':
+                marker = np.array([meta['count'] * WORD.itemsize], dtype=MARKER_DTYPE).tobytes()
+                digest.update(marker)
+                size += 2 * len(marker)
+            for index in range(len(meta['chunks'])):
+                data = self.chunk(key, index)
+                data = data if meta['encoding'] == 'raw' else data.tobytes()
+                digest.update(data)
+                size += len(data)
+            if meta['encoding'] == 'record':
+                digest.update(marker)
+            if size != meta['size'] or (meta['lossless'] and digest.hexdigest() != meta['sha1']):
+                bad.append(path)
+        return bad
+
+    def report(self, iteration):
+        """
+        Print the original and stored size of an archived iteration; objects shared
+        with other files are counted once.
+        """
+        files = self.manifest(iteration)
+        keys = set(files.values())
+        original = sum(self.meta(key)['size'] for key in files.values())
+        stored = sum(self.meta(key)['stored'] for key in keys)
+        print(f"Iteration {iteration}: {len(files)} files, {original / 1e9:.3f} GB in {len(keys)} objects "
+              f"of {stored / 1e9:.3f} GB ({original / max(stored, 1):.1f}x)")
+
+
+def _store(archive_dir, level, filename, base, bits, keyframe_every):
+    return IterationArchive(archive_dir, level).store(filename, base, bits, keyframe_every)
+
+
+def archive_iteration(iteration, archive_dir=ARCHIVE_DIR, kernel_bits=None, keyframe_every=5, workers=1, remove=False):
+    """
+    Archive an iteration and, with remove=True, delete its directories once the
+    archive decodes correctly. The model and summed kernels of the newest iteration
+    are kept, because the next model update reads them. Removing is refused for
+    rounded kernels, which verify can only check by size.
+    """
+    if remove and kernel_bits is not None:
+        raise ValueError("kernels rounded to kernel_bits are lossy; refusing to remove the original directories")
+    archive = IterationArchive(archive_dir)
+    archive.archive_iteration(iteration, kernel_bits=kernel_bits, keyframe_every=keyframe_every, workers=workers)
+    if not remove:
+        return archive
+    bad = archive.verify(iteration)
+    if bad:
+        raise RuntimeError(f"archive of iteration {iteration} does not decode correctly: {bad}")
+    with open(archive.manifest_file(iteration)) as f:
+        directories = json.load(f)['directories']
+    newest = not os.path.isdir(f'MODEL_{iteration + 1}_test')
+    for directory in directories:
+        if newest and directory in (f'MODEL_{iteration}_test', f'SUMMED_KERNELS_l2_ITER{iteration}'):
+            print(f"Keeping {directory}: the next model update reads it.")
+            continue
+        shutil.rmtree(directory)
+        print(f"Removed {directory}")
+    return archive
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Archive, list and restore finished iterations.')
+    parser.add_argument('command', choices=['archive', 'restore', 'list'])
+    parser.add_argument('iteration', type=int)
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR)
+    parser.add_argument('--kernel-bits', type=int, default=None,
+                        help='round kernels to this many mantissa bits (lossy; default: lossless)')
+    parser.add_argument('--keyframe-every', type=int, default=5, help='store a full model every N iterations')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--remove', action='store_true',
+                        help='delete the archived directories after verifying (not with --kernel-bits)')
+    parser.add_argument('--output', default='.', help='directory to restore into')
+    parser.add_argument('--files', nargs='+', default=None, help='restore only these paths')
+    args = parser.parse_args()
+    if args.command == 'archive':
+        if args.remove and args.kernel_bits is not None:
+            parser.error("--remove cannot be combined with the lossy --kernel-bits")
+        archive_iteration(args.iteration, args.archive_dir, args.kernel_bits, args.keyframe_every, args.workers,
+                          args.remove)
+    elif args.command == 'restore':
+        IterationArchive(args.archive_dir).restore(args.iteration, args.output, args.files)
+    else:
+        archive = IterationArchive(args.archive_dir)
+        for path, key in sorted(archive.manifest(args.iteration).items()):
+            meta = archive.meta(key)
+            print(f"{path:<60} {meta['size']:>12} -> {meta['stored']:>12} {meta['encoding']}"
+                  f"{' delta' if meta.get('base') else ''}{'' if meta['lossless'] else ' rounded'}")
+        archive.report(args.iteration)
@@ -0,0 +1,372 @@
+"""
+Asynchronous tracker for the forward, adjoint and smoothing jobs of an iteration.
+
+All watched jobs are polled together: one squeue call per poll for the jobs
+still queued, one sacct call for the jobs that dropped out of the queue, so the
+final state (COMPLETED, FAILED, TIMEOUT, ...) is known instead of assumed. A job
+only counts as successful when the scheduler reports COMPLETED and, if a marker
+file (e.g. <event>/SUCCESS) is given, the marker was written during the job.
+The poll interval starts short, grows while nothing changes and drops back as
+soon as a job changes state. Callbacks fire the moment a job finishes, so
+per-event work can start before the slowest event is done. Every finished
+job is written to the telemetry log (see telemetry.py) with its queue and run
+times.
+
+The scheduler is pluggable: SlurmScheduler talks to sbatch/squeue/sacct and
+LocalScheduler runs the job scripts as local subprocesses, as a stand-in for
+testing the workflow without a cluster.
+"""
+import os
+import asyncio
+import inspect
+import subprocess
+import datetime
+import time
+import telemetry
+
+ACTIVE_STATES = {'PENDING', 'CONFIGURING', 'RUNNING', 'COMPLETING', 'SUSPENDED', 'REQUEUED', 'RESIZING',
+                 'STAGE_OUT', 'SIGNALING'}
+SUCCESS_STATE = 'COMPLETED'
+# Final state of a job the scheduler no longer knows about and that left no marker
+UNKNOWN_STATE = 'UNKNOWN'
+# Final state of a job reported COMPLETED that did not write its marker file
+NO_MARKER_STATE = 'NO_MARKER'
+
+
+async def _run(cmd):
+    """
+    Run a command without blocking the event loop. Returns stdout, or None if the
+    command is missing or fails.
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE)
+    except FileNotFoundError:
+        return None
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        print(f"{cmd[0]} failed: {stderr.decode().strip()}")
+        return None
+    return stdout.decode()
+
+
+class SlurmScheduler:
+    """
+    Submit and query Slurm jobs, batching the queries of all watched jobs.
+    """
+    def submit(self, script, args=(), cwd='.', options=()):
+        """
+        Submit a job script with sbatch and return its job ID. `options` are sbatch
+        options such as --ntasks=24, overriding the #SBATCH lines of the script.
+        """
+        result = subprocess.run(['sbatch', *options, script, *map(str, args)], cwd=cwd, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"sbatch {script} in {cwd} failed: {result.stderr.strip()}")
+        return result.stdout.strip().split()[-1]
+
+    def cancel(self, job_id):
+        """
+        Cancel a job with scancel.
+        """
+        subprocess.run(['scancel', str(job_id)], capture_output=True, text=True)
+
+    async def query(self, job_ids):
+        """
+        Return {job_id: state} for the given jobs; jobs unknown to both squeue and
+        sacct are left out. Returns None if squeue or sacct fails (e.g. a busy
+        controller), since a missing job then says nothing about it.
+        """
+        states = {}
+        output = await _run(['squeue', '--jobs', ','.join(job_ids), '--states=all', '--format=%A %T', '--noheader'])
+        if output is None:
+            return None
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[0] in job_ids:
+                states[fields[0]] = fields[1]
+        finished = [job_id for job_id in job_ids if states.get(job_id, SUCCESS_STATE) not in ACTIVE_STATES]
+        if finished:
+            output = await _run(['sacct', '--jobs', ','.join(finished), '--allocations', '--noheader',
+                                 '--parsable2', '--format=JobID,State'])
+            if output is None:
+                return None
+            for line in output.splitlines():
+                fields = line.split('|')
+                if len(fields) == 2 and fields[0] in finished:
+                    # e.g. 'CANCELLED by 1234'
+                    states[fields[0]] = fields[1].split()[0]
+        return states
+
+    async def times(self, job_ids):
+        """
+        Return {job_id: (submit, start, end)} as epoch seconds from sacct; times
+        Slurm does not know (yet) are None.
+        """
+        times = {}
+        output = await _run(['sacct', '--jobs', ','.join(job_ids), '--allocations', '--noheader', '--parsable2',
+                             '--format=JobID,Submit,Start,End'])
+        for line in (output or '').splitlines():
+            fields = line.split('|')
+            if len(fields) == 4 and fields[0] in job_ids:
+                times[fields[0]] = tuple(_epoch(field) for field in fields[1:])
+        return times
+
+
+def _epoch(timestamp):
+    """
+    Epoch seconds of a sacct timestamp such as 2024-05-01T12:00:00, or None for Unknown/None.
+    """
+    try:
+        return datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S').timestamp()
+    except ValueError:
+        return None
+
+
+class LocalScheduler:
+    """
+    Run job scripts with bash as local subprocesses, in place of Slurm.
+    The output of a job goes to <script>.local.out in its working directory.
+    """
+    def __init__(self):
+        self.processes = {}
+        self.cancelled = set()
+
+    def submit(self, script, args=(), cwd='.', options=()):
+        """
+        Start a job script and return its job ID (the process ID); sbatch options
+        are ignored.
+        """
+        with open(os.path.join(cwd, f'{os.path.basename(script)}.local.out'), 'w') as log:
+            process = subprocess.Popen(['bash', script, *map(str, args)], cwd=cwd, stdout=log,
+                                       stderr=subprocess.STDOUT)
+        job_id = str(process.pid)
+        self.processes[job_id] = process
+        return job_id
+
+    def cancel(self, job_id):
+        """
+        Terminate a running job.
+        """
+        process = self.processes.get(str(job_id))
+        if process is not None and process.poll() is None:
+            process.terminate()
+            self.cancelled.add(str(job_id))
+
+    async def query(self, job_ids):
+        """
+        Return {job_id: state} for the jobs started by this scheduler.
+        """
+        states = {}
+        for job_id in job_ids:
+            if job_id in self.processes:
+                returncode = self.processes[job_id].poll()
+                if returncode is None:
+                    states[job_id] = 'RUNNING'
+                elif job_id in self.cancelled:
+                    states[job_id] = 'CANCELLED'
+                else:
+                    states[job_id] = SUCCESS_STATE if returncode == 0 else 'FAILED'
+        return states
+
+
+class Job:
+    """
+    A watched job: scheduler ID, name (usually the event directory), optional marker
+    file and the callbacks to fire when it finishes.
+    """
+    def __init__(self, job_id, name, marker=None, on_done=None, on_failed=None):
+        self.job_id = str(job_id)
+        self.name = name
+        self.marker = marker
+        self.on_done = on_done
+        self.on_failed = on_failed
+        self.state = 'SUBMITTED'
+        self.final = False
+        self.missing = 0
+        # Seen by the polls: when watching began, the job was first seen running and it finished
+        self.watched = time.time()
+        self.started = None
+        self.finished = None
+        # A marker left over from an earlier run does not count
+        self.marker_mtime = _mtime(marker)
+        # The telemetry stage the job belongs to, e.g. the forward stage of one event in pipeline.py
+        self.stage = telemetry.open_stage()
+
+    def marker_written(self):
+        """
+        True if the marker file was (re)written since the job started being watched.
+        """
+        if self.marker is None:
+            return True
+        mtime = _mtime(self.marker)
+        return mtime is not None and mtime != self.marker_mtime
+
+
+def _mtime(filename):
+    if filename is None or not os.path.exists(filename):
+        return None
+    return os.stat(filename).st_mtime_ns
+
+
+class JobMonitor:
+    """
+    Watch many jobs at once with one batched scheduler query per poll.
+
+    Args:
+        scheduler: SlurmScheduler (default) or LocalScheduler.
+        min_interval (float): Poll interval in seconds right after a state change.
+        max_interval (float): Longest poll interval while nothing changes.
+        backoff (float): Factor by which the interval grows after a quiet poll.
+        missing_polls (int): Polls a job may be unknown to the scheduler before it is
+            given up as UNKNOWN (or COMPLETED, if its marker was written).
+    """
+    def __init__(self, scheduler=None, min_interval=2, max_interval=60, backoff=1.5, missing_polls=3):
+        self.scheduler = scheduler or SlurmScheduler()
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.missing_polls = missing_polls
+        self.jobs = []
+        self._poller = None
+
+    def watch(self, job_id, name=None, marker=None, on_done=None, on_failed=None):
+        """
+        Add a job. on_done(name, job) / on_failed(name, job) may be functions or coroutines.
+        """
+        job = Job(job_id, name or str(job_id), marker, on_done, on_failed)
+        self.jobs.append(job)
+        return job
+
+    async def run(self):
+        """
+        Poll until every watched job has finished. Returns {name: final state}.
+        """
+        interval = self.min_interval
+        pending = set()
+        while True:
+            while any(not job.final for job in self.jobs):
+                changed = await self.poll([job for job in self.jobs if not job.final], pending)
+                if any(not job.final for job in self.jobs):
+                    interval = self.min_interval if changed else min(interval * self.backoff, self.max_interval)
+                    await asyncio.sleep(interval)
+            # Callbacks run concurrently with the polling; wait for the last ones,
+            # which may have watched new jobs
+            await asyncio.gather(*pending)
+            pending = set()
+            if all(job.final for job in self.jobs):
+                return {job.name: job.state for job in self.jobs}
+
+    async def wait(self, job_id, name=None, marker=None):
+        """
+        Watch a job from a running event loop and return its final state once it
+        has finished. Jobs waited on concurrently share the batched polls.
+        """
+        future = asyncio.get_running_loop().create_future()
+
+        def resolve(name, job):
+            if not future.done():
+                future.set_result(job.state)
+
+        self.watch(job_id, name, marker, resolve, resolve)
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.ensure_future(self.run())
+        await asyncio.wait([future, self._poller], return_when=asyncio.FIRST_COMPLETED)
+        if not future.done():
+            # The poller stopped without finishing the job, e.g. a failed query
+            self._poller.result()
+        return await future
+
+    def cancel(self, job_id):
+        """
+        Cancel a watched job; it finishes with the scheduler's cancelled state.
+        """
+        print(f"Cancelling job {job_id}")
+        self.scheduler.cancel(job_id)
+
+    async def poll(self, jobs, pending):
+        """
+        Update the state of the given jobs with one scheduler query. Callbacks of
+        finished jobs are started and added to `pending`. Returns True if any
+        state changed. A failed query changes nothing and does not count as a
+        poll in which the jobs were missing.
+        """
+        states = await self.scheduler.query([job.job_id for job in jobs])
+        if states is None:
+            print("Scheduler query failed; keeping the job states until the next poll.")
+            return False
+        changed = False
+        finished = []
+        for job in jobs:
+            state = states.get(job.job_id)
+            if state is None:
+                job.missing += 1
+                if job.missing < self.missing_polls:
+                    continue
+                state = SUCCESS_STATE if job.marker is not None and job.marker_written() else UNKNOWN_STATE
+            else:
+                job.missing = 0
+            if state in ACTIVE_STATES:
+                if state not in ('PENDING', 'CONFIGURING', 'REQUEUED') and job.started is None:
+                    job.started = time.time()
+                if state != job.state:
+                    print(f"{job.name} (job {job.job_id}): {state}")
+                    job.state = state
+                    changed = True
+                continue
+            if state == SUCCESS_STATE and not job.marker_written():
+                state = NO_MARKER_STATE
+            job.state = state
+            job.final = True
+            job.finished = time.time()
+            finished.append(job)
+            changed = True
+            callback = job.on_done if state == SUCCESS_STATE else job.on_failed
+            print(f"{job.name} (job {job.job_id}): {state}")
+            if callback is not None:
+                result = callback(job.name, job)
+                if inspect.isawaitable(result):
+                    pending.add(asyncio.ensure_future(result))
+        if finished:
+            await self.record_jobs(finished)
+        return changed
+
+    async def record_jobs(self, jobs):
+        """
+        Write finished jobs to the telemetry log with their queue and run times,
+        from the scheduler's accounting if it has any, else from the polls.
+        """
+        times = {}
+        if hasattr(self.scheduler, 'times'):
+            times = await self.scheduler.times([job.job_id for job in jobs])
+        for job in jobs:
+            submit, start, end = times.get(job.job_id, (None, None, None))
+            if submit is not None and start is not None and end is not None:
+                source, pending_s, running_s = 'sacct', start - submit, end - start
+            else:
+                started = job.started or job.finished
+                source, pending_s, running_s = 'poll', started - job.watched, job.finished - started
+            stage = {} if job.stage is None else {'iteration': job.stage['iteration'], 'stage': job.stage['stage']}
+            telemetry.record('job', job_id=job.job_id, name=job.name, state=job.state, pending_s=pending_s,
+                             running_s=running_s, times_from=source, **stage)
+
+
+def wait_for_jobs(jobs, scheduler=None, on_done=None, on_failed=None, min_interval=2, max_interval=60):
+    """
+    Block until all jobs have finished.
+
+    Args:
+        jobs (list): (job_id, name, marker file or None) tuples.
+        on_done, on_failed: Callbacks fired per job as soon as it finishes.
+
+    Returns:
+        dict: Final state of every job by name.
+    """
+    monitor = JobMonitor(scheduler, min_interval, max_interval)
+    for job_id, name, marker in jobs:
+        monitor.watch(job_id, name, marker, on_done, on_failed)
+    start = time.time()
+    states = asyncio.run(monitor.run())
+    failed = sorted(name for name, state in states.items() if state != SUCCESS_STATE)
+    print(f"{len(states)} jobs finished in {time.time() - start:.0f} s; "
+          f"{'all succeeded' if not failed else 'failed: ' + ', '.join(failed)}")
+    return states
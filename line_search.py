@@ -0,0 +1,141 @@
+"""
+Step length search along the model update direction before the update is committed.
+
+Every trial step builds the trial model with update_model(iteration, step),
+runs forward simulations for a subset of the events only and evaluates their
+misfit without writing adjoint sources. The misfit of the current model
+(step 0) is that of the previous iteration, from the misfit store (see
+Inversion.calculate_misfit); events without a misfit there, e.g. events that
+were not in the mini-batch of the previous iteration, are run at step 0 first.
+Misfits are weighted and jobs submitted as given by the event manifest.
+
+Two strategies are available:
+
+    backtracking  try initial_step, initial_step*shrink, ... and accept the first
+                  step whose misfit is at least `min_decrease` (relative) below
+                  the current misfit
+    parabolic     evaluate two steps, fit a parabola through them and step 0,
+                  evaluate its minimum and keep the best step seen
+
+The sufficient decrease is relative, like compare_misfits, rather than an
+Armijo slope: the kernels are not volume weighted, so the directional
+derivative of the misfit along the update is not available here.
+"""
+import os
+import json
+import asyncio
+import numpy as np
+from Inversion import update_model, calculate_misfit
+from misfit_store import load_misfits
+from job_monitor import JobMonitor, SUCCESS_STATE
+from event_manifest import EventManifest
+from pipeline import FORWARD_SCRIPT, stage_forward_inputs, submit_event_job
+
+
+async def _run_forwards(event_dirs, scheduler=None, check_interval=10):
+    monitor = JobMonitor(scheduler, min_interval=check_interval)
+    manifest = EventManifest()
+
+    async def forward(event_dir):
+        await asyncio.to_thread(stage_forward_inputs, event_dir)
+        job_id = submit_event_job(monitor.scheduler, event_dir, FORWARD_SCRIPT, manifest.sbatch_options(event_dir))
+        return await monitor.wait(job_id, f'{event_dir} forward', os.path.join(event_dir, 'SUCCESS'))
+
+    states = await asyncio.gather(*[forward(event_dir) for event_dir in event_dirs])
+    failed = [event_dir for event_dir, state in zip(event_dirs, states) if state != SUCCESS_STATE]
+    if failed:
+        raise RuntimeError(f"forward simulations failed: {', '.join(failed)}")
+
+
+def forward_misfit(event_dirs, scheduler=None, measure='l2', workers=1, engine='pyadjoint', check_interval=10):
+    """
+    Run forward simulations of the model in DATABASES_MPI for event_dirs and return
+    their weighted total misfit; no adjoint sources or misfit files are written.
+    """
+    from adjoint_driver import generate_adjoint_sources
+    asyncio.run(_run_forwards(event_dirs, scheduler, check_interval))
+    misfits, results = generate_adjoint_sources(event_dirs, measure, workers, engine=engine, write=False)
+    manifest = EventManifest()
+    return sum(manifest.weight(event_dir) * misfit for event_dir, misfit in misfits.items())
+
+
+def current_misfit(iteration, event_dirs, scheduler=None, measure='l2', workers=1, engine='pyadjoint',
+                   check_interval=10, trial_dir=None, optimizer='gauss_newton'):
+    """
+    Weighted misfit of the current model for event_dirs: from the previous iteration
+    for the events measured there, and from a forward run of the step 0 model in
+    trial_dir for the others.
+    """
+    misfits = load_misfits(iteration - 1, event_dirs)
+    measured = [event_dir for event_dir in event_dirs if event_dir in misfits]
+    unmeasured = [event_dir for event_dir in event_dirs if event_dir not in misfits]
+    misfit = float(calculate_misfit(iteration - 1, measured)) if measured else 0.0
+    if unmeasured:
+        print(f"Line search for iteration {iteration}: no misfit of iteration {iteration - 1} for "
+              f"{', '.join(unmeasured)}; running them at step 0")
+        update_model(iteration, 0.0, output_dir=trial_dir, optimizer=optimizer)
+        misfit += forward_misfit(unmeasured, scheduler, measure, workers, engine, check_interval)
+    return misfit
+
+
+def parabola_minimum(steps, misfits):
+    """
+    Step at the minimum of the parabola through three (step, misfit) points, or
+    None if the parabola is not convex.
+    """
+    a, b, c = np.polyfit(steps, misfits, 2)
+    if a <= 0:
+        return None
+    return -b / (2 * a)
+
+
+def line_search(iteration, event_dirs, method='backtracking', initial_step=1.0, shrink=0.5, max_trials=4,
+                min_decrease=0.005, scheduler=None, measure='l2', workers=1, engine='pyadjoint', check_interval=10,
+                log_dir='logs', optimizer='gauss_newton'):
+    """
+    Search the step length of the update of `iteration` (made by `optimizer`, see
+    Inversion.update_model) on the events event_dirs.
+
+    Returns (chosen step, misfit of the current model, lowest trial misfit); the
+    step is None if no trial step lowers the misfit by min_decrease. The trials
+    are written to <log_dir>/line_search_iteration_<iteration>.json.
+    """
+    trial_dir = f'MODEL_{iteration}_linesearch'
+    f0 = current_misfit(iteration, event_dirs, scheduler, measure, workers, engine, check_interval, trial_dir,
+                        optimizer)
+    trials = []
+
+    def evaluate(step):
+        print(f"Line search for iteration {iteration}: trying step {step}")
+        update_model(iteration, step, output_dir=trial_dir, optimizer=optimizer)
+        misfit = forward_misfit(event_dirs, scheduler, measure, workers, engine, check_interval)
+        print(f"Step {step}: misfit {misfit} (current model {f0})")
+        trials.append([float(step), float(misfit)])
+        return misfit
+
+    if method == 'backtracking':
+        step = initial_step
+        for trial in range(max_trials):
+            if evaluate(step) <= (1 - min_decrease) * f0:
+                break
+            step *= shrink
+    elif method == 'parabolic':
+        steps = [initial_step * shrink, initial_step]
+        misfits = [evaluate(step) for step in steps]
+        step = parabola_minimum([0.0] + steps, [f0] + misfits)
+        if step is not None:
+            step = float(np.clip(step, initial_step * shrink ** max_trials, initial_step / shrink))
+            if all(abs(step - trial_step) > 1e-3 * initial_step for trial_step, misfit in trials):
+                evaluate(step)
+    else:
+        raise ValueError(f"unknown line search method {method}")
+
+    best_step, best_misfit = min(trials, key=lambda trial: trial[1])
+    chosen = best_step if best_misfit <= (1 - min_decrease) * f0 else None
+    print(f"Line search for iteration {iteration}: chosen step {chosen}")
+
+    os.makedirs(log_dir, exist_ok=True)
+    with open(os.path.join(log_dir, f'line_search_iteration_{iteration}.json'), 'w') as f:
+        json.dump({'method': method, 'events': event_dirs, 'current_misfit': f0, 'trials': trials,
+                   'step': chosen}, f, indent=1)
+    return chosen, f0, best_misfit
@@ -0,0 +1,43 @@
+"""
+Mini-batch event sampling for stochastic inversion iterations.
+
+A mini-batch iteration simulates a seeded random subset of batch_size out of
+the N events; the draw depends only on (seed, iteration), so a resumed run gets
+the same batch. The summed kernels of a batch are scaled by N / batch_size, an
+unbiased estimate of the full-batch gradient, and so is the batch misfit.
+
+The misfits of different batches are not comparable, so the misfit gate only
+runs on the full-batch checks: every `full_batch_every`-th iteration simulates
+all events and compares the total misfit with that of the last full-batch
+check.
+"""
+import numpy as np
+
+
+def is_full_batch(iteration, event_dirs, batch_size=None, full_batch_every=0):
+    """
+    True if the iteration simulates all events: no mini-batching, a batch at
+    least as large as the event set, or a periodic full-batch check.
+    """
+    if not batch_size or batch_size >= len(event_dirs):
+        return True
+    return bool(full_batch_every) and iteration % full_batch_every == 0
+
+
+def sample_events(iteration, event_dirs, batch_size=None, full_batch_every=0, seed=0):
+    """
+    The events simulated in an iteration, in the order of event_dirs.
+    """
+    if is_full_batch(iteration, event_dirs, batch_size, full_batch_every):
+        return list(event_dirs)
+    rng = np.random.default_rng([seed, iteration])
+    chosen = set(rng.choice(len(event_dirs), size=batch_size, replace=False).tolist())
+    return [event_dir for i, event_dir in enumerate(event_dirs) if i in chosen]
+
+
+def batch_scale(event_dirs, batch):
+    """
+    Factor N / B that makes the sum over a batch of B out of N events an unbiased
+    estimate of the sum over all events.
+    """
+    return len(event_dirs) / len(batch)
@@ -0,0 +1,178 @@
+"""
+Misfit history of the inversion in an SQLite database.
+
+The adjoint source step (adjoint_driver.py --iteration N) records the misfit of
+every station and component next to the event totals it writes to misfit.txt:
+
+    station_misfits(iteration, event, station, component, misfit, weight)
+    event_misfits(iteration, event, misfit)       weighted sum over stations and components
+
+Both tables are keyed by their leading columns, so the total of an iteration
+is a lookup of its event rows instead of a scan of the REF_SEM_<iteration>
+directories. Iterations from before the store existed are imported from their
+REF_SEM_<iteration>/misfit.txt files (event totals only) the first time they
+are asked for.
+
+Usage:
+    python misfit_store.py trend [--events EVENT1 ...]
+    python misfit_store.py events ITERATION [--events EVENT1 ...]
+    python misfit_store.py worst ITERATION [--count 10] [--event EVENT1]
+    python misfit_store.py import ITERATION [--events EVENT1 ...]
+"""
+import os
+import sqlite3
+import argparse
+import numpy as np
+from event_manifest import EventManifest
+
+MISFIT_DB = 'misfits.sqlite'
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS station_misfits (
+    iteration INTEGER NOT NULL, event TEXT NOT NULL, station TEXT NOT NULL, component TEXT NOT NULL,
+    misfit REAL NOT NULL, weight REAL NOT NULL,
+    PRIMARY KEY (iteration, event, station, component));
+CREATE TABLE IF NOT EXISTS event_misfits (
+    iteration INTEGER NOT NULL, event TEXT NOT NULL, misfit REAL NOT NULL,
+    PRIMARY KEY (iteration, event));
+"""
+
+
+class MisfitStore:
+    """
+    Per-station and per-event misfits of every iteration.
+
+    Args:
+        filename (str): SQLite database, created on first use.
+        timeout (float): Seconds to wait for other processes writing the database.
+    """
+    def __init__(self, filename=MISFIT_DB, timeout=60):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, timeout=timeout)
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def record(self, iteration, misfits, results=()):
+        """
+        Store the {event: misfit} totals of an iteration and the (event, station, component,
+        misfit, weight) results of generate_adjoint_sources, replacing what was stored
+        for these events before.
+        """
+        with self.connection:
+            for event in misfits:
+                self.connection.execute('DELETE FROM station_misfits WHERE iteration = ? AND event = ?',
+                                        (iteration, event))
+            self.connection.executemany('INSERT INTO station_misfits VALUES (?, ?, ?, ?, ?, ?)',
+                                        [(iteration, event, station, component, float(misfit), float(weight))
+                                         for event, station, component, misfit, weight in results])
+            self.connection.executemany('INSERT OR REPLACE INTO event_misfits VALUES (?, ?, ?)',
+                                        [(iteration, event, float(misfit)) for event, misfit in misfits.items()])
+
+    def import_misfit_files(self, iteration, event_dirs):
+        """
+        Store the event totals of <event>/REF_SEM_<iteration>/misfit.txt; returns the imported {event: misfit}.
+        """
+        misfits = {}
+        for event in event_dirs:
+            misfit_file = os.path.join(event, f'REF_SEM_{iteration}', 'misfit.txt')
+            if os.path.exists(misfit_file):
+                misfits[event] = float(np.loadtxt(misfit_file))
+        if misfits:
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO event_misfits VALUES (?, ?, ?)',
+                                            [(iteration, event, misfit) for event, misfit in misfits.items()])
+        return misfits
+
+    def event_misfits(self, iteration, event_dirs=None):
+        """
+        {event: misfit} of an iteration, for event_dirs or all stored events.
+        """
+        rows = self.connection.execute('SELECT event, misfit FROM event_misfits WHERE iteration = ? ORDER BY event',
+                                       (iteration,))
+        misfits = dict(rows)
+        if event_dirs is None:
+            return misfits
+        return dict((event, misfits[event]) for event in event_dirs if event in misfits)
+
+    def total(self, iteration, event_dirs=None, weights=None):
+        """
+        Sum of the event misfits of an iteration, each times weights[event] (default 1).
+        """
+        weights = weights or {}
+        misfits = self.event_misfits(iteration, event_dirs)
+        return sum(weights.get(event, 1.0) * misfit for event, misfit in misfits.items())
+
+    def iterations(self):
+        rows = self.connection.execute('SELECT DISTINCT iteration FROM event_misfits ORDER BY iteration')
+        return [row[0] for row in rows]
+
+    def trend(self, event_dirs=None, weights=None):
+        """
+        [(iteration, total misfit, relative change to the previous iteration or None)] of all stored iterations.
+        """
+        trend = []
+        for iteration in self.iterations():
+            total = self.total(iteration, event_dirs, weights)
+            change = (total - trend[-1][1]) / trend[-1][1] if trend and trend[-1][1] else None
+            trend.append((iteration, total, change))
+        return trend
+
+    def worst_stations(self, iteration, count=10, event=None):
+        """
+        The `count` largest weighted station misfits of an iteration, as
+        (event, station, component, misfit, weight), optionally of one event.
+        """
+        query = 'SELECT event, station, component, misfit, weight FROM station_misfits WHERE iteration = ?'
+        parameters = [iteration]
+        if event is not None:
+            query += ' AND event = ?'
+            parameters.append(event)
+        query += ' ORDER BY misfit * weight DESC LIMIT ?'
+        return self.connection.execute(query, parameters + [count]).fetchall()
+
+
+def load_misfits(iteration, event_dirs, misfit_db=MISFIT_DB):
+    """
+    {event: misfit} of an iteration for event_dirs from the misfit store; events it
+    does not hold yet are imported from their REF_SEM_<iteration>/misfit.txt, and
+    events without either are left out.
+    """
+    store = MisfitStore(misfit_db)
+    misfits = store.event_misfits(iteration, event_dirs)
+    missing = [event for event in event_dirs if event not in misfits]
+    if missing:
+        misfits.update(store.import_misfit_files(iteration, missing))
+    store.close()
+    return misfits
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the misfit history of the inversion.')
+    parser.add_argument('command', choices=['trend', 'events', 'worst', 'import'])
+    parser.add_argument('iteration', type=int, nargs='?')
+    parser.add_argument('--events', nargs='+', default=None,
+                        help='events (default: the enabled events of the event manifest; for import all of them)')
+    parser.add_argument('--event', default=None, help='event of the worst stations')
+    parser.add_argument('--count', type=int, default=10)
+    parser.add_argument('--db', default=MISFIT_DB)
+    args = parser.parse_args()
+    if args.command != 'trend' and args.iteration is None:
+        parser.error(f"{args.command} needs an iteration")
+    store = MisfitStore(args.db)
+    manifest = EventManifest()
+    events = args.events or manifest.events(include_disabled=args.command == 'import')
+    if args.command == 'trend':
+        # Weighted by the manifest, like the totals of the misfit gate
+        for iteration, total, change in store.trend(events, dict(zip(events, manifest.weights(events)))):
+            print(f"{iteration:>9} {total:>15.6e} {'' if change is None else f'{100 * change:+.2f}%'}")
+    elif args.command == 'events':
+        for event, misfit in store.event_misfits(args.iteration, events).items():
+            print(f"{event:<12} {misfit:.6e}")
+    elif args.command == 'worst':
+        for event, station, component, misfit, weight in store.worst_stations(args.iteration, args.count, args.event):
+            print(f"{event:<12} {station:<8} {component} {misfit * weight:.6e}")
+    else:
+        imported = store.import_misfit_files(args.iteration, events)
+        print(f"Imported the misfits of {len(imported)} events for iteration {args.iteration}.")
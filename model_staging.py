@@ -0,0 +1,212 @@
+"""
+Model staging: distribute model and database files without copying unchanged data.
+
+Every file is placed with one of three methods, falling back to the next one
+when the filesystem does not support it:
+
+    hardlink  a second name for the same file; only for files that are never
+              written in place afterwards (e.g. a finished model directory)
+    reflink   a copy-on-write clone (FICLONE, e.g. on XFS, Btrfs) that shares
+              the data until either copy is written
+    copy      a plain copy
+
+The event jobs rerun the mesher and the database generation, which rewrite the
+files of <event>/DATABASES_MPI in place, so events are staged with reflinks by
+default: a hard link would let one event overwrite the database of all others.
+
+A destination that already holds the same contents is left alone, so staging
+a new model into an event directory only writes the changed vp/vs slices. The
+sha1 of every source file and of every staged file is kept in a hidden
+.staging.json per directory, keyed by size and mtime, so unchanged files are
+not read again. Staged files are placed under a temporary name, verified
+against the sha1 of the source and then renamed over the destination.
+
+Usage: python model_staging.py SRC_DIR DST_DIR [DST_DIR ...] [--method reflink|hardlink|copy]
+"""
+import os
+import json
+import errno
+import fcntl
+import shutil
+import hashlib
+import argparse
+import threading
+
+RECORD_FILE = '.staging.json'
+METHODS = ['hardlink', 'reflink', 'copy']
+FICLONE = 0x40049409
+# errors meaning the filesystem cannot link or clone this file
+UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EPERM, errno.EMLINK, errno.ENOSYS)
+
+
+def file_sha1(filename):
+    """
+    sha1 of the contents of a file, read in 16 MB blocks.
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def reflink(src_file, dst_file):
+    """
+    Clone src_file to dst_file with the FICLONE ioctl.
+    """
+    with open(src_file, 'rb') as src, open(dst_file, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+class ModelStager:
+    """
+    Stage files and directories and count the bytes that did not have to be copied.
+
+    Args:
+        method (str): Preferred method, 'hardlink', 'reflink' or 'copy'.
+        verify (bool): Check the sha1 of every staged copy or clone.
+    """
+    def __init__(self, method='reflink', verify=True):
+        if method not in METHODS:
+            raise ValueError(f"unknown staging method {method}, expected one of {METHODS}")
+        self.methods = METHODS[METHODS.index(method):]
+        self.verify = verify
+        self.records = {}
+        self.stats = {'files': 0, 'unchanged': 0, 'hardlink': 0, 'reflink': 0, 'copy': 0}
+        self.bytes = dict((key, 0) for key in self.stats)
+
+    def record(self, directory):
+        """
+        The {name: [size, mtime_ns, sha1]} record of a directory, loaded once.
+        """
+        if directory not in self.records:
+            record_file = os.path.join(directory, RECORD_FILE)
+            self.records[directory] = {}
+            if os.path.exists(record_file):
+                with open(record_file) as f:
+                    self.records[directory] = json.load(f)
+        return self.records[directory]
+
+    def sha1(self, filename):
+        """
+        sha1 of a file, from the record of its directory while size and mtime match.
+        """
+        record = self.record(os.path.dirname(filename))
+        stat = os.stat(filename)
+        name = os.path.basename(filename)
+        if name in record and record[name][:2] == [stat.st_size, stat.st_mtime_ns]:
+            return record[name][2]
+        sha1 = file_sha1(filename)
+        record[name] = [stat.st_size, stat.st_mtime_ns, sha1]
+        return sha1
+
+    def place(self, src_file, tmp_file):
+        """
+        Create tmp_file from src_file with the first method that works; returns the method.
+        """
+        for method in self.methods:
+            try:
+                if method == 'hardlink':
+                    os.link(src_file, tmp_file)
+                elif method == 'reflink':
+                    reflink(src_file, tmp_file)
+                else:
+                    shutil.copyfile(src_file, tmp_file)
+                return method
+            except OSError as error:
+                if method == 'copy' or error.errno not in UNSUPPORTED:
+                    raise
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+
+    def stage_file(self, src_file, dst_file):
+        """
+        Make dst_file a file with the contents of src_file, unless it already is one.
+        Contents are only compared when the file would not be hard-linked anyway.
+        """
+        size = os.path.getsize(src_file)
+        self.stats['files'] += 1
+        self.bytes['files'] += size
+        compare = self.methods[0] != 'hardlink'
+        if os.path.exists(dst_file) and (os.path.samefile(src_file, dst_file) or (
+                compare and os.path.getsize(dst_file) == size and self.sha1(dst_file) == self.sha1(src_file))):
+            self.stats['unchanged'] += 1
+            self.bytes['unchanged'] += size
+            return 'unchanged'
+        tmp_file = os.path.join(os.path.dirname(dst_file) or '.', f'.{os.path.basename(dst_file)}.staging')
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        method = self.place(src_file, tmp_file)
+        if self.verify and method != 'hardlink' and file_sha1(tmp_file) != self.sha1(src_file):
+            os.remove(tmp_file)
+            raise RuntimeError(f"staging {src_file} to {dst_file}: checksum mismatch")
+        # Replace rather than overwrite, so a previous hard link is never written through
+        os.replace(tmp_file, dst_file)
+        if method != 'hardlink':
+            stat = os.stat(dst_file)
+            self.record(os.path.dirname(dst_file))[os.path.basename(dst_file)] = [stat.st_size, stat.st_mtime_ns,
+                                                                                 self.sha1(src_file)]
+        self.stats[method] += 1
+        self.bytes[method] += size
+        return method
+
+    def stage_directory(self, src_dir, dst_dir):
+        """
+        Stage every (non-hidden) file of src_dir into dst_dir; subdirectories are staged recursively.
+        """
+        os.makedirs(dst_dir, exist_ok=True)
+        for name in sorted(os.listdir(src_dir)):
+            if name.startswith('.'):
+                continue
+            src_path = os.path.join(src_dir, name)
+            if os.path.isdir(src_path):
+                self.stage_directory(src_path, os.path.join(dst_dir, name))
+            else:
+                self.stage_file(src_path, os.path.join(dst_dir, name))
+        self.save()
+
+    def save(self):
+        """
+        Write the checksum records of all directories seen so far.
+        """
+        for directory, record in self.records.items():
+            record_file = os.path.join(directory, RECORD_FILE)
+            tmp_file = f'{record_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(record, f)
+            os.replace(tmp_file, record_file)
+
+    def avoided_bytes(self):
+        """
+        Bytes that were not copied: unchanged, hard-linked and reflinked files.
+        """
+        return self.bytes['unchanged'] + self.bytes['hardlink'] + self.bytes['reflink']
+
+    def report(self, label='Staged'):
+        print(f"{label} {self.stats['files']} files ({self.bytes['files'] / 1e9:.3f} GB): "
+              f"{self.stats['unchanged']} unchanged, {self.stats['hardlink']} hard-linked, "
+              f"{self.stats['reflink']} reflinked, {self.stats['copy']} copied; "
+              f"avoided copying {self.avoided_bytes() / 1e9:.3f} GB")
+
+
+def stage_directory(src_dir, dst_dir, method='reflink', verify=True):
+    """
+    Stage src_dir into dst_dir (see ModelStager) and print what was done.
+    """
+    stager = ModelStager(method, verify)
+    stager.stage_directory(src_dir, dst_dir)
+    stager.report(f"Staged {src_dir} to {dst_dir}:")
+    return stager
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stage a model or database directory into one or more directories.')
+    parser.add_argument('src_dir')
+    parser.add_argument('dst_dirs', nargs='+')
+    parser.add_argument('--method', choices=METHODS, default='reflink')
+    parser.add_argument('--no-verify', action='store_true', help='do not check the checksums of staged copies')
+    args = parser.parse_args()
+    stager = ModelStager(args.method, not args.no_verify)
+    for dst_dir in args.dst_dirs:
+        stager.stage_directory(args.src_dir, dst_dir)
+    stager.report(f"Staged {args.src_dir} to {len(args.dst_dirs)} directories:")
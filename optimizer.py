@@ -0,0 +1,270 @@
+"""
+Preconditioned L-BFGS model update, an alternative to Inversion.gauss_newton_update.
+
+The model and gradient of every iteration (the vp and, optionally, vs files of
+all processor slices and the matching smoothed summed kernels) are kept as
+float32 .npy memmaps in a history directory,
+
+    LBFGS_HISTORY/iter0007/proc000000_vp_model.npy
+    LBFGS_HISTORY/iter0007/proc000000_vp_gradient.npy
+
+bounded to the last `memory` + 1 iterations. The differences of consecutive
+entries are the (s, y) pairs of the two-loop recursion; pairs that violate the
+curvature condition s.y > 0 are skipped. The initial inverse Hessian is the
+diagonal Gauss-Newton preconditioner 1 / (hess + water level) of the summed
+Hessian kernel, so without history (the first iteration) the update is
+exactly the Gauss-Newton update.
+
+The recursion streams through the history memmaps one slice and block at a
+time: the dot products are accumulated in float64 and only their scalars are
+kept, and the working vector (q, then r, then the direction) is a float64
+memmap, saved to the newest entry as
+
+    LBFGS_HISTORY/iter0007/proc000000_vp_direction.npy
+
+The entry and its direction are made once per iteration, on the first update
+after the model or kernel files changed, so the trial steps of a line search
+only write model + step * direction. The working vector is float64 like the
+dot products: it is rewritten by every step of both loops, and rounding it to
+float32 each time would add up over the recursion.
+"""
+import os
+import json
+import shutil
+import numpy as np
+from fortran_io import read_record, create_record
+from model_staging import ModelStager
+
+HISTORY_DIR = 'LBFGS_HISTORY'
+# (parameter, kernel, Hessian water level), as in gauss_newton_update
+VP_FIELD = ('vp', 'alpha', 5e-14)
+VS_FIELD = ('vs', 'beta', None)
+# Values per block of the streaming passes, as in gauss_newton_update
+BLOCK_SIZE = 4194304
+SOURCES_FILE = 'sources.json'
+
+
+def blocks(size, block_size=BLOCK_SIZE):
+    """
+    Slices of at most block_size values covering an array of `size` values.
+    """
+    return [slice(start, min(start + block_size, size)) for start in range(0, size, block_size)]
+
+
+def blockwise(arrays):
+    """
+    A vector over all slices, given as {(processor, parameter): array}, as a function
+    (key, block) -> float64 values of that block.
+    """
+    return lambda key, part: np.asarray(arrays[key][part], dtype='float64')
+
+
+def difference(vectors, i):
+    """
+    The difference of the vectors i + 1 and i of a history as a blockwise vector.
+    """
+    return lambda key, part: np.asarray(vectors[i + 1][key][part], dtype='float64') - vectors[i][key][part]
+
+
+def dot(a, b, sizes, block_size=BLOCK_SIZE):
+    """
+    Dot product of two blockwise vectors over all slices; sizes holds the number of values per key.
+    """
+    return sum(float(np.dot(a(key, part), b(key, part)))
+               for key, size in sizes.items() for part in blocks(size, block_size))
+
+
+class LBFGS:
+    """
+    L-BFGS with a bounded on-disk history and the diagonal Hessian as preconditioner.
+
+    Args:
+        history_dir (str): Directory of the model and gradient history.
+        memory (int): Number of (s, y) pairs used.
+        processor_count (int): Number of processor slices.
+        update_vs (bool): Update vs together with vp.
+    """
+    def __init__(self, history_dir=HISTORY_DIR, memory=5, processor_count=12, update_vs=False):
+        self.history_dir = history_dir
+        self.memory = memory
+        self.processor_count = processor_count
+        self.fields = [VP_FIELD, VS_FIELD] if update_vs else [VP_FIELD]
+
+    def keys(self):
+        return [(proc_id, name) for proc_id in range(self.processor_count) for name, kernel_name, water_level in self.fields]
+
+    def entry_dir(self, iteration):
+        return os.path.join(self.history_dir, f'iter{iteration:04d}')
+
+    def entries(self):
+        """
+        Iterations in the history, in increasing order.
+        """
+        if not os.path.isdir(self.history_dir):
+            return []
+        return sorted(int(name[4:]) for name in os.listdir(self.history_dir) if name.startswith('iter'))
+
+    def load(self, iteration, kind):
+        """
+        The model, gradient or direction ('model' / 'gradient' / 'direction') of an
+        iteration as read-only memmaps.
+        """
+        return {(proc_id, name): np.load(os.path.join(self.entry_dir(iteration), f'proc{proc_id:06d}_{name}_{kind}.npy'),
+                                         mmap_mode='r')
+                for proc_id, name in self.keys()}
+
+    def input_files(self, proc_id, name, model_dir, kernel_dir):
+        """
+        The model, gradient and Hessian files of one slice and parameter.
+        """
+        kernel_name = dict((field[0], field[1]) for field in self.fields)[name]
+        return (os.path.join(model_dir, f'proc{proc_id:06d}_{name}.bin'),
+                os.path.join(kernel_dir, f'proc{proc_id:06d}_{kernel_name}_kernel_summed_clip_smooth_smooth.bin'),
+                os.path.join(kernel_dir, f'proc{proc_id:06d}_hess_kernel_summed_smooth_smooth.bin'))
+
+    def sources(self, model_dir, kernel_dir):
+        """
+        {file: [size, mtime_ns]} of the input files of an entry.
+        """
+        sources = {}
+        for proc_id, name in self.keys():
+            for filename in self.input_files(proc_id, name, model_dir, kernel_dir):
+                stat = os.stat(filename)
+                sources[filename] = [stat.st_size, stat.st_mtime_ns]
+        return sources
+
+    def prepared(self, iteration, model_dir, kernel_dir):
+        """
+        Whether the entry of `iteration` and its direction were made from the current
+        model and kernel files.
+        """
+        entry_dir = self.entry_dir(iteration)
+        sources_file = os.path.join(entry_dir, SOURCES_FILE)
+        if not os.path.exists(sources_file):
+            return False
+        if not all(os.path.exists(os.path.join(entry_dir, f'proc{proc_id:06d}_{name}_direction.npy'))
+                   for proc_id, name in self.keys()):
+            return False
+        with open(sources_file) as f:
+            return json.load(f) == self.sources(model_dir, kernel_dir)
+
+    def store(self, iteration, model_dir, kernel_dir):
+        """
+        Add the model and gradient of `iteration` to the history, replacing an
+        existing entry of that iteration, and drop the entries that are too old or
+        newer than it (left over from an abandoned run).
+        """
+        entry_dir = self.entry_dir(iteration)
+        tmp_dir = entry_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for proc_id, name in self.keys():
+            model_file, kernel_file, hess_file = self.input_files(proc_id, name, model_dir, kernel_dir)
+            model = read_record(model_file, mmap=True)
+            gradient = read_record(kernel_file, count=model.size, mmap=True)
+            np.save(os.path.join(tmp_dir, f'proc{proc_id:06d}_{name}_model.npy'), model)
+            np.save(os.path.join(tmp_dir, f'proc{proc_id:06d}_{name}_gradient.npy'), gradient)
+        with open(os.path.join(tmp_dir, SOURCES_FILE), 'w') as f:
+            json.dump(self.sources(model_dir, kernel_dir), f, indent=1)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+        kept = [entry for entry in self.entries() if entry <= iteration][-(self.memory + 1):]
+        for entry in self.entries():
+            if entry not in kept:
+                shutil.rmtree(self.entry_dir(entry))
+
+    def preconditioner(self, kernel_dir):
+        """
+        The diagonal inverse Hessian 1 / (hess + water level) as a blockwise vector.
+        """
+        hessians = [read_record(os.path.join(kernel_dir, f'proc{proc_id:06d}_hess_kernel_summed_smooth_smooth.bin'),
+                                mmap=True)
+                    for proc_id in range(self.processor_count)]
+        water_levels = dict((name, water_level or 0.0) for name, kernel_name, water_level in self.fields)
+
+        def inverse(key, part):
+            proc_id, name = key
+            return 1.0 / (np.asarray(hessians[proc_id][part], dtype='float64') + water_levels[name])
+        return inverse
+
+    def direction(self, iteration, kernel_dir, block_size=BLOCK_SIZE):
+        """
+        Compute the L-BFGS search direction -H g at the model of `iteration`, which must
+        be the newest history entry, and save it to that entry as proc*_<name>_direction.npy.
+        """
+        entries = [entry for entry in self.entries() if entry <= iteration]
+        models = [self.load(entry, 'model') for entry in entries]
+        gradients = [self.load(entry, 'gradient') for entry in entries]
+        sizes = dict((key, value.size) for key, value in gradients[-1].items())
+
+        pairs = []
+        for i in range(len(entries) - 1):
+            s, y = difference(models, i), difference(gradients, i)
+            sy = dot(s, y, sizes, block_size)
+            if sy > 0:
+                pairs.append((s, y, 1.0 / sy))
+            else:
+                print(f"L-BFGS: skipping the pair of iterations {entries[i]}-{entries[i + 1]} (s.y = {sy})")
+        print(f"L-BFGS: {len(pairs)} correction pairs")
+
+        # The working vector, written under a temporary name until the direction is complete
+        files = dict((key, os.path.join(self.entry_dir(iteration), f'proc{key[0]:06d}_{key[1]}_direction'))
+                     for key in sizes)
+        work = dict((key, np.lib.format.open_memmap(files[key] + '.tmp.npy', mode='w+', dtype='float64',
+                                                    shape=(size,)))
+                    for key, size in sizes.items())
+        vector = blockwise(work)
+
+        def assign(function):
+            for key, size in sizes.items():
+                for part in blocks(size, block_size):
+                    work[key][part] = function(key, part)
+
+        assign(blockwise(gradients[-1]))
+        alphas = []
+        for s, y, rho in reversed(pairs):
+            alpha = rho * dot(s, vector, sizes, block_size)
+            assign(lambda key, part: vector(key, part) - alpha * y(key, part))
+            alphas.append(alpha)
+        inverse = self.preconditioner(kernel_dir)
+        assign(lambda key, part: inverse(key, part) * vector(key, part))
+        for (s, y, rho), alpha in zip(pairs, reversed(alphas)):
+            beta = rho * dot(y, vector, sizes, block_size)
+            assign(lambda key, part: vector(key, part) + (alpha - beta) * s(key, part))
+        assign(lambda key, part: -vector(key, part))
+
+        for key in sizes:
+            work[key].flush()
+        del work
+        for key in sizes:
+            os.replace(files[key] + '.tmp.npy', files[key] + '.npy')
+        return self.load(iteration, 'direction')
+
+    def update(self, iteration, model_dir, kernel_dir, output_dir, step=1.0, databases_mpi_dir='DATABASES_MPI',
+               block_size=BLOCK_SIZE):
+        """
+        Write model + step * direction of `iteration` to output_dir and DATABASES_MPI,
+        one slice and block at a time. The history entry and the direction are made on
+        the first call and reused while the model and kernel files are unchanged, so
+        the trial steps of a line search do not repeat them.
+        """
+        if self.prepared(iteration, model_dir, kernel_dir):
+            print(f"L-BFGS: reusing the direction of iteration {iteration}")
+        else:
+            self.store(iteration, model_dir, kernel_dir)
+            self.direction(iteration, kernel_dir, block_size)
+        model = self.load(iteration, 'model')
+        direction = self.load(iteration, 'direction')
+        os.makedirs(output_dir, exist_ok=True)
+        stager = ModelStager('hardlink')
+        for proc_id, name in self.keys():
+            key = (proc_id, name)
+            output_file = os.path.join(output_dir, f'proc{proc_id:06d}_{name}.bin')
+            updated = create_record(output_file, 'float32', model[key].size)
+            for part in blocks(model[key].size, block_size):
+                updated[part] = model[key][part] + step * np.asarray(direction[key][part], dtype='float64')
+            updated.flush()
+            del updated
+            stager.stage_file(output_file, os.path.join(databases_mpi_dir, f'proc{proc_id:06d}_{name}.bin'))
+        stager.save()
+        stager.report(f"Staged {output_dir} to {databases_mpi_dir}:")
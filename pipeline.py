@@ -0,0 +1,286 @@
+"""
+Pipelined inversion iteration: every event runs its own chain
+
+    forward job -> misfit and adjoint sources -> adjoint job -> kernel accumulation
+
+as soon as the previous step of that event is done, instead of waiting for the
+slowest event at every stage. The only join is the misfit gate: the total
+misfit needs the adjoint sources of all events. Adjoint jobs are submitted
+speculatively before the gate is decided and cancelled if the misfit did not
+drop enough (or an event failed). Kernels are added to running sums as each
+adjoint job finishes, so only the final write-out, smoothing and the next
+model update wait for all events.
+
+Jobs are submitted per event from Python with the job scripts used by
+forward_specfem_all_synmodel.sh and adjoint_specfem_all_adjoint.sh, with the
+resource hints of the event manifest, and tracked by one job_monitor.JobMonitor.
+The total misfit and the kernels are weighted with the manifest weights.
+The adjoint source runs of concurrent events share one budget of --workers
+processes (see WorkerBudget).
+
+Every stage is measured in logs/telemetry.jsonl (see telemetry.py) like the
+stages of run_inversion.py: the model update, the forward, adjoint source,
+adjoint and accumulation stages of every event (with its name) and the
+smoothing.
+
+Usage: python pipeline.py ITERATION [EVENT1 EVENT2 ...] [--workers N]
+"""
+import os
+import sys
+import shutil
+import asyncio
+import argparse
+from job_monitor import JobMonitor, SUCCESS_STATE
+from event_manifest import EventManifest
+from model_staging import stage_directory
+from telemetry import measure_stage
+from Inversion import (OPTIMIZERS, SMOOTHING_ENGINES, update_model, calculate_misfit, compare_misfits,
+                       accumulate_kernels, write_accumulated_kernels, run_smooth_kernel, log_iteration)
+
+FORWARD_SCRIPT = 'Specfem_FWI_for_event.sh'
+ADJOINT_SCRIPT = 'specfem_adjoint_event.sh'
+KERNEL_NAMES = ['alpha', 'beta', 'hess']
+
+
+def stage_forward_inputs(event_dir):
+    """
+    Copy DATA/Par_file into the event directory and stage the current model in
+    DATABASES_MPI there, writing only the files that changed (see model_staging.py).
+    """
+    shutil.copy('DATA/Par_file', os.path.join(event_dir, 'DATA', 'Par_file'))
+    stage_directory('DATABASES_MPI', os.path.join(event_dir, 'DATABASES_MPI'))
+
+
+def submit_event_job(scheduler, event_dir, script, options=()):
+    """
+    Copy a job script into the event directory, remove the old SUCCESS marker and
+    submit the script from there with the sbatch `options`. Returns the job ID.
+    """
+    shutil.copy(script, event_dir)
+    marker = os.path.join(event_dir, 'SUCCESS')
+    if os.path.exists(marker):
+        os.remove(marker)
+    job_id = scheduler.submit(os.path.basename(script), cwd=event_dir, options=options)
+    print(f"Submitted batch job {job_id} for {event_dir} ({script})")
+    return job_id
+
+
+async def create_event_adjoint_sources(event_dir, iteration, measure='l2', workers=1, engine='pyadjoint'):
+    """
+    Create the adjoint sources of one event with adjoint_driver.py and back up its
+    synthetics and misfit to <event>/REF_SEM_<iteration>, like create_adjoint_sources.sh.
+    Returns the misfit of the event.
+    """
+    process = await asyncio.create_subprocess_exec(sys.executable, 'adjoint_driver.py', '--measure', measure,
+                                                   '--workers', str(workers), '--engine', engine,
+                                                   '--iteration', str(iteration), event_dir)
+    if await process.wait() != 0:
+        raise RuntimeError(f"adjoint_driver.py failed for {event_dir}")
+    backup_dir = os.path.join(event_dir, f'REF_SEM_{iteration}')
+    await asyncio.to_thread(backup_event_results, event_dir, backup_dir)
+    with open(os.path.join(event_dir, 'misfit.txt')) as f:
+        return float(f.read())
+
+
+def backup_event_results(event_dir, backup_dir):
+    """
+    Copy OUTPUT_FILES/*.semd and misfit.txt of an event into a fresh backup_dir.
+    """
+    shutil.rmtree(backup_dir, ignore_errors=True)
+    os.makedirs(backup_dir)
+    for filename in os.listdir(os.path.join(event_dir, 'OUTPUT_FILES')):
+        if filename.endswith('.semd'):
+            shutil.copy(os.path.join(event_dir, 'OUTPUT_FILES', filename), backup_dir)
+    shutil.copy(os.path.join(event_dir, 'misfit.txt'), backup_dir)
+
+
+class WorkerBudget:
+    """
+    The `workers` processes of the node, shared by the adjoint source runs of
+    concurrent events so that together they never use more. Every run takes an
+    equal share among the `runs` that have not finished yet (at least one worker,
+    at most the free ones), so the last events get the workers the first ones
+    gave back.
+    """
+    def __init__(self, workers, runs):
+        self.workers = workers
+        self.free = workers
+        self.runs = max(runs, 1)
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        """
+        Wait for a free worker and return the number of workers taken.
+        """
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.free > 0)
+            share = max(1, min(self.free, self.workers // self.runs))
+            self.free -= share
+            return share
+
+    async def release(self, share):
+        """
+        Give back the workers of a finished run.
+        """
+        async with self.condition:
+            self.free += share
+            self.runs = max(self.runs - 1, 1)
+            self.condition.notify_all()
+
+
+class PipelinedIteration:
+    """
+    One pipelined iteration over a list of events; see the module docstring.
+    """
+    def __init__(self, iteration, event_dirs, scheduler=None, measure='l2', workers=1, threshold=0.005,
+                 processor_count=12, check_interval=10, engine='pyadjoint', optimizer='gauss_newton', manifest=None,
+                 smoothing_engine='job'):
+        self.iteration = iteration
+        self.event_dirs = event_dirs
+        self.manifest = manifest or EventManifest()
+        self.monitor = JobMonitor(scheduler, min_interval=check_interval)
+        self.measure = measure
+        self.workers = workers
+        self.engine = engine
+        self.smoothing_engine = smoothing_engine
+        self.optimizer = optimizer
+        self.threshold = threshold
+        self.processor_count = processor_count
+        self.kernel_dir = f'SUMMED_KERNELS_l2_ITER{iteration}'
+        self.accumulator_dir = os.path.join(self.kernel_dir, 'ACCUMULATED')
+        self.misfits = {}
+        self.adjoint_jobs = {}
+        self.current_misfit = None
+        self.stop = None
+        self.aborted = False
+        self.budget = None
+
+    def decide(self, previous_misfit):
+        """
+        The misfit gate, once the misfits of all events are known. Cancels the
+        speculative adjoint jobs if the inversion stops.
+        """
+        current_misfit = sum(self.manifest.weight(event_dir) * self.misfits[event_dir] for event_dir in self.event_dirs)
+        print(f"Total misfit for iteration {self.iteration}: {current_misfit}")
+        self.stop = compare_misfits(previous_misfit, current_misfit, self.threshold)
+        self.current_misfit = current_misfit
+        if self.stop:
+            self.cancel_adjoint_jobs()
+
+    def cancel_adjoint_jobs(self):
+        """
+        Cancel the adjoint jobs that have not finished yet.
+        """
+        finished = set(job.job_id for job in self.monitor.jobs if job.final)
+        for job_id in self.adjoint_jobs.values():
+            if job_id not in finished:
+                self.monitor.cancel(job_id)
+
+    async def run_event(self, event_dir, previous_misfit, lock):
+        """
+        The forward -> adjoint sources -> adjoint -> accumulation chain of one event.
+        """
+        scheduler = self.monitor.scheduler
+        marker = os.path.join(event_dir, 'SUCCESS')
+        options = self.manifest.sbatch_options(event_dir)
+        with measure_stage('forward', self.iteration, event=event_dir):
+            await asyncio.to_thread(stage_forward_inputs, event_dir)
+            job_id = submit_event_job(scheduler, event_dir, FORWARD_SCRIPT, options)
+            state = await self.monitor.wait(job_id, f'{event_dir} forward', marker)
+            if state != SUCCESS_STATE:
+                raise RuntimeError(f"forward simulation of {event_dir} ended with {state}")
+
+        with measure_stage('adjoint_sources', self.iteration, event=event_dir):
+            workers = await self.budget.acquire()
+            try:
+                self.misfits[event_dir] = await create_event_adjoint_sources(event_dir, self.iteration, self.measure,
+                                                                             workers, self.engine)
+            finally:
+                await self.budget.release(workers)
+        if len(self.misfits) == len(self.event_dirs):
+            self.decide(previous_misfit)
+        if self.stop or self.aborted:
+            return
+
+        with measure_stage('adjoint', self.iteration, event=event_dir):
+            # Speculative until the misfit gate has been decided
+            self.adjoint_jobs[event_dir] = submit_event_job(scheduler, event_dir, ADJOINT_SCRIPT, options)
+            state = await self.monitor.wait(self.adjoint_jobs[event_dir], f'{event_dir} adjoint', marker)
+        if self.stop or self.aborted:
+            return
+        if state != SUCCESS_STATE:
+            raise RuntimeError(f"adjoint simulation of {event_dir} ended with {state}")
+        async with lock:
+            with measure_stage('accumulation', self.iteration, event=event_dir):
+                await asyncio.to_thread(accumulate_kernels, event_dir, KERNEL_NAMES, self.accumulator_dir,
+                                        self.processor_count, weight=self.manifest.weight(event_dir))
+
+    async def run_guarded(self, event_dir, previous_misfit, lock):
+        """
+        run_event, cancelling the adjoint jobs of all events if this one fails.
+        """
+        try:
+            await self.run_event(event_dir, previous_misfit, lock)
+        except Exception:
+            # No point in finishing the other adjoint simulations
+            self.aborted = True
+            self.cancel_adjoint_jobs()
+            raise
+
+    async def run(self):
+        """
+        Run the iteration. Returns True if the inversion should stop.
+        """
+        print('new model is created and will launch simulations for iteration', self.iteration)
+        with measure_stage('model_update', self.iteration):
+            await asyncio.to_thread(update_model, self.iteration, optimizer=self.optimizer)
+        previous_misfit = calculate_misfit(self.iteration - 1, self.event_dirs, self.manifest)
+        shutil.rmtree(self.accumulator_dir, ignore_errors=True)
+        lock = asyncio.Lock()
+        self.budget = WorkerBudget(self.workers, len(self.event_dirs))
+        results = await asyncio.gather(*[self.run_guarded(event_dir, previous_misfit, lock)
+                                         for event_dir in self.event_dirs], return_exceptions=True)
+        failed = [f"{event_dir}: {result}" for event_dir, result in zip(self.event_dirs, results)
+                  if isinstance(result, Exception)]
+        if failed:
+            raise RuntimeError(f"iteration {self.iteration} failed:\n" + "\n".join(failed))
+
+        if self.stop:
+            shutil.rmtree(self.accumulator_dir, ignore_errors=True)
+            print('converged')
+        else:
+            with measure_stage('accumulation', self.iteration):
+                await asyncio.to_thread(write_accumulated_kernels, self.accumulator_dir, KERNEL_NAMES, self.kernel_dir,
+                                        self.processor_count)
+                shutil.rmtree(self.accumulator_dir)
+            with measure_stage('smoothing', self.iteration):
+                await asyncio.to_thread(run_smooth_kernel, self.kernel_dir, self.kernel_dir, self.monitor.scheduler,
+                                        self.smoothing_engine, self.processor_count, self.workers)
+        log_iteration(self.iteration, previous_misfit, self.current_misfit, self.stop)
+        return self.stop
+
+
+def pipelined_iteration(current_iteration, event_dirs, scheduler=None, measure='l2', workers=1, threshold=0.005,
+                        processor_count=12, check_interval=10, engine='pyadjoint', optimizer='gauss_newton',
+                        smoothing_engine='job'):
+    """
+    Run one inversion iteration with per-event pipelining; a drop-in replacement of
+    Inversion.inversion_iteration that returns True if the inversion should stop.
+    """
+    return asyncio.run(PipelinedIteration(current_iteration, event_dirs, scheduler, measure, workers, threshold,
+                                          processor_count, check_interval, engine, optimizer,
+                                          smoothing_engine=smoothing_engine).run())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run one pipelined inversion iteration.')
+    parser.add_argument('iteration', type=int)
+    parser.add_argument('event_dirs', nargs='*', help='events (default: the enabled events of the event manifest)')
+    parser.add_argument('--measure', default='l2')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--engine', choices=['pyadjoint', 'batched'], default='pyadjoint')
+    parser.add_argument('--optimizer', choices=OPTIMIZERS, default='gauss_newton')
+    parser.add_argument('--smoothing-engine', choices=SMOOTHING_ENGINES, default='job')
+    args = parser.parse_args()
+    pipelined_iteration(args.iteration, args.event_dirs or EventManifest().events(), measure=args.measure, workers=args.workers,
+                        engine=args.engine, optimizer=args.optimizer, smoothing_engine=args.smoothing_engine)
@@ -1,21 +1,227 @@
-from Inversion import *
-event_dirs = ['EVENT1', 'EVENT2', 'EVENT3', 'EVENT4']
-current_iteration = 7
-inversion_iteration(current_iteration,event_dirs)
-print('current iteration',current_iteration,'is finished and continue to new iteration')
+"""
+Resumable inversion driver.
 
+Every iteration runs the stages
 
+    [line_search ->] model_update -> forward -> adjoint_sources (misfit gate) -> adjoint -> summation -> smoothing
 
-current_iteration = 8
-inversion_iteration(current_iteration,event_dirs)
-print('current iteration',current_iteration,'is finished and continue to new iteration')
+and records each finished stage with the signatures of its outputs in the
+state file (see inversion_state.py). A rerun of the same command skips the
+finished iterations, resumes an interrupted iteration after its last finished
+stage whose outputs are unchanged, and reruns everything after a stage that had
+to be redone.
 
+The optional line search (see line_search.py) picks the step length of the
+model update from forward-only runs of a subset of the events and stops the
+inversion if no step lowers their misfit.
 
-current_iteration = 9
-inversion_iteration(current_iteration,event_dirs)
-print('current iteration',current_iteration,'is finished and continue to new iteration')
+The events, their weights and resource hints come from the event manifest
+(see event_manifest.py) unless --events is given.
 
+With --batch-size B every iteration simulates a seeded random subset of B
+events, with kernels scaled to stay unbiased, and every --full-batch-every
+iterations all events are simulated to run the misfit gate (see minibatch.py).
+The line search then runs on the batch; its events that were not in the batch
+of the previous iteration are simulated at step 0 for the current misfit.
 
-current_iteration = 10
-inversion_iteration(current_iteration,event_dirs)
-print('current iteration',current_iteration,'is finished and continue to new iteration')
\ No newline at end of file
+The time, I/O and memory of every stage and the queue and run times of its
+jobs are appended to logs/telemetry.jsonl; compare iterations with
+`python telemetry.py report` (see telemetry.py).
+
+Usage:
+    python run_inversion.py --start 7 --stop 10 [--events EVENT1 EVENT2 ...] [--workers N]
+                            [--optimizer gauss_newton|lbfgs]
+                            [--batch-size B [--full-batch-every N] [--seed S]] [--smoothing-engine job|python]
+                            [--line-search backtracking|parabolic [--line-search-events EVENT1 ...]]
+"""
+import os
+import argparse
+from Inversion import (OPTIMIZERS, SMOOTHING_ENGINES, update_model, run_simulation, check_simulation_status,
+                       run_create_adjoint_sources, calculate_misfit, compare_misfits, run_adjoint_simulations, sum_kernels,
+                       run_smooth_kernel, log_iteration)
+from inversion_state import InversionState, STATE_FILE
+from event_manifest import load_events
+from job_monitor import SUCCESS_STATE
+from line_search import line_search
+from minibatch import sample_events, batch_scale
+from telemetry import measure_stage
+
+STAGES = ['model_update', 'forward', 'adjoint_sources', 'adjoint', 'summation', 'smoothing']
+# Options of a run, overridden by the command line
+DEFAULT_OPTIONS = {'workers': 1, 'optimizer': 'gauss_newton', 'line_search': None, 'line_search_events': None,
+                   'batch_size': None, 'full_batch_every': 0, 'seed': 0, 'smoothing_engine': 'job'}
+
+
+def stage_outputs(stage, iteration, event_dirs):
+    """
+    Glob patterns of the files a stage of an iteration produces.
+    """
+    kernel_dir = f'SUMMED_KERNELS_l2_ITER{iteration}'
+    if stage == 'line_search':
+        return [os.path.join('logs', f'line_search_iteration_{iteration}.json')]
+    if stage == 'model_update':
+        return [f'MODEL_{iteration}_test/proc*_vp.bin']
+    if stage == 'forward':
+        return [os.path.join(event_dir, 'OUTPUT_FILES', '*.semd') for event_dir in event_dirs]
+    if stage == 'adjoint_sources':
+        return ([os.path.join(event_dir, f'REF_SEM_{iteration}', 'misfit.txt') for event_dir in event_dirs] +
+                [os.path.join(event_dir, 'SEM', '*.adj') for event_dir in event_dirs])
+    if stage == 'adjoint':
+        return [os.path.join(event_dir, 'DATABASES_MPI', f'proc*_{kernel_name}_kernel.bin')
+                for event_dir in event_dirs for kernel_name in ['alpha', 'beta', 'hess']]
+    if stage == 'summation':
+        return [os.path.join(kernel_dir, 'proc*_kernel_summed.bin')]
+    if stage == 'smoothing':
+        return [os.path.join(kernel_dir, 'proc*_alpha_kernel_summed_clip_smooth_smooth.bin'),
+                os.path.join(kernel_dir, 'proc*_hess_kernel_summed_smooth_smooth.bin')]
+    raise ValueError(f"unknown stage {stage}")
+
+
+def wait_for_simulations(event_dirs, job_ids, kind):
+    """
+    Wait for the jobs of one simulation per event; raises RuntimeError if any failed.
+    """
+    if not job_ids:
+        raise RuntimeError(f"no {kind} jobs were submitted")
+    states = check_simulation_status(event_dirs, job_ids)
+    failed = sorted(name for name, state in states.items() if state != SUCCESS_STATE)
+    if failed:
+        raise RuntimeError(f"{kind} simulations failed: {', '.join(failed)}")
+
+
+def previous_full_misfit(state, iteration, event_dirs):
+    """
+    Total misfit of the last full-batch iteration before `iteration` in the state,
+    or else that of all events in the iteration before the first recorded one.
+    """
+    recorded = sorted(int(key) for key in state.state['iterations'])
+    for previous in reversed(recorded):
+        values = state.values(previous)
+        if previous < iteration and values.get('full_batch', True) and 'current_misfit' in values:
+            return values['current_misfit']
+    return float(calculate_misfit(min(recorded + [iteration]) - 1, event_dirs))
+
+
+def run_stage(stage, iteration, event_dirs, values, options=DEFAULT_OPTIONS, batch=None, previous_misfit=None):
+    """
+    Run one stage of an iteration for the events in `batch` (default: all of
+    event_dirs), given the values of the stages before it. Returns the values
+    the stage produces: the step length of the line search, the misfits and the
+    decision of the misfit gate. previous_misfit is the misfit the gate compares
+    with (default: the previous iteration of all events).
+    """
+    kernel_dir = f'SUMMED_KERNELS_l2_ITER{iteration}'
+    batch = batch or event_dirs
+    if stage == 'line_search':
+        step, current_misfit, best_misfit = line_search(iteration, options['line_search_events'] or batch,
+                                                        options['line_search'], workers=options['workers'],
+                                                        optimizer=options['optimizer'])
+        if step is None:
+            print("No step length lowers the misfit; stopping inversion process.")
+            return {'step': None, 'previous_misfit': current_misfit, 'current_misfit': best_misfit, 'stop': True}
+        return {'step': step}
+    if stage == 'model_update':
+        print('new model is created and will launch simulations for iteration', iteration)
+        update_model(iteration, values.get('step', 1), optimizer=options['optimizer'])
+    elif stage == 'forward':
+        wait_for_simulations(batch, run_simulation(event_dirs=batch), 'forward')
+        print('forward simulations are finished')
+    elif stage == 'adjoint_sources':
+        run_create_adjoint_sources(iteration, batch)
+        scale = batch_scale(event_dirs, batch)
+        current_misfit = float(calculate_misfit(iteration, batch)) * scale
+        if previous_misfit is None:
+            previous_misfit = float(calculate_misfit(iteration - 1, event_dirs))
+        full_batch = len(batch) == len(event_dirs)
+        if full_batch:
+            stop = compare_misfits(previous_misfit, current_misfit)
+        else:
+            print(f"Mini-batch of {len(batch)} events: estimated total misfit {current_misfit}; "
+                  "the misfit gate runs on the next full-batch check.")
+            stop = False
+        return {'previous_misfit': previous_misfit, 'current_misfit': current_misfit, 'stop': stop,
+                'full_batch': full_batch, 'batch': batch, 'scale': scale}
+    elif stage == 'adjoint':
+        print('start adjoint simulations')
+        wait_for_simulations(batch, run_adjoint_simulations(batch), 'adjoint')
+    elif stage == 'summation':
+        sum_kernels(batch, output_dir=kernel_dir, workers=options['workers'], scale=batch_scale(event_dirs, batch))
+    elif stage == 'smoothing':
+        run_smooth_kernel(input_dir=kernel_dir, output_dir=kernel_dir, engine=options['smoothing_engine'],
+                          workers=options['workers'])
+    return {}
+
+
+def run_iteration(iteration, event_dirs, state, options=DEFAULT_OPTIONS):
+    """
+    Run the unfinished stages of one iteration. Returns True if the inversion
+    should stop (no step length found or the misfit gate was not passed).
+    """
+    stages = (['line_search'] if options['line_search'] else []) + STAGES
+    batch = sample_events(iteration, event_dirs, options['batch_size'], options['full_batch_every'], options['seed'])
+    if len(batch) < len(event_dirs):
+        print(f"Iteration {iteration}: mini-batch {' '.join(batch)}")
+    if state.iteration(iteration).get('complete'):
+        print(f"Iteration {iteration} is already complete.")
+        return state.values(iteration)['stop']
+    start = state.resume_index(iteration, stages)
+    if start:
+        print(f"Resuming iteration {iteration} after stage {stages[start - 1]}.")
+    state.reset_stages(iteration, stages[start:])
+    for stage in stages[start:]:
+        values = state.values(iteration)
+        if values.get('stop'):
+            break
+        print(f"Iteration {iteration}: running stage {stage}")
+        previous_misfit = previous_full_misfit(state, iteration, event_dirs) if stage == 'adjoint_sources' else None
+        with measure_stage(stage, iteration, events=len(batch)):
+            stage_values = run_stage(stage, iteration, event_dirs, values, options, batch, previous_misfit)
+        state.finish_stage(iteration, stage, stage_outputs(stage, iteration, batch), stage_values)
+    values = state.values(iteration)
+    if values['stop']:
+        print('converged')
+    log_iteration(iteration, values['previous_misfit'], values['current_misfit'], values['stop'])
+    state.set(iteration, complete=True)
+    return values['stop']
+
+
+def run_inversion(start, stop, event_dirs, state_file=STATE_FILE, **options):
+    """
+    Run iterations start..stop (inclusive), resuming from the state file. The
+    keyword arguments override DEFAULT_OPTIONS.
+    """
+    unknown = set(options) - set(DEFAULT_OPTIONS)
+    if unknown:
+        raise TypeError(f"unknown options {sorted(unknown)}")
+    options = dict(DEFAULT_OPTIONS, **options)
+    state = InversionState(state_file)
+    for iteration in range(start, stop + 1):
+        if run_iteration(iteration, event_dirs, state, options):
+            break
+        print('current iteration', iteration, 'is finished and continue to new iteration')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run or resume the inversion over a range of iterations.')
+    parser.add_argument('--start', type=int, required=True, help='first iteration')
+    parser.add_argument('--stop', type=int, required=True, help='last iteration (inclusive)')
+    parser.add_argument('--events', nargs='+', default=None,
+                        help='events (default: the enabled events of the event manifest, see event_manifest.py)')
+    parser.add_argument('--state', default=STATE_FILE, help='state file')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes for kernel summation and smoothing')
+    parser.add_argument('--optimizer', choices=OPTIMIZERS, default='gauss_newton', help='model update')
+    parser.add_argument('--line-search', choices=['backtracking', 'parabolic'], default=None,
+                        help='search the step length before every model update')
+    parser.add_argument('--line-search-events', nargs='+', default=None,
+                        help='events simulated by the line search (default: the events of the iteration)')
+    parser.add_argument('--batch-size', type=int, default=None, help='events simulated per mini-batch iteration')
+    parser.add_argument('--full-batch-every', type=int, default=0,
+                        help='simulate all events every N iterations (and run the misfit gate there)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the mini-batch sampling')
+    parser.add_argument('--smoothing-engine', choices=SMOOTHING_ENGINES, default='job',
+                        help='job: submit smooth_kernel.sh; python: smooth in this process (see smoothing.py)')
+    args = parser.parse_args()
+    run_inversion(args.start, args.stop, args.events or load_events(), args.state, workers=args.workers, optimizer=args.optimizer,
+                  line_search=args.line_search, line_search_events=args.line_search_events,
+                  batch_size=args.batch_size, full_batch_every=args.full_batch_every, seed=args.seed,
+                  smoothing_engine=args.smoothing_engine)
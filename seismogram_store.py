@@ -0,0 +1,119 @@
+"""
+Binary store for the ASCII .semd seismograms of an event.
+
+All traces of a directory (REF_SEIS or OUTPUT_FILES) are converted once into
+
+    seismograms.npy   (ntraces, nt) array, one row per trace
+    seismograms.json  trace names, time offset t0 and dt of every trace, and
+                      the size and mtime of the .semd files it was built from
+
+and read back as zero-copy memmap rows. The store is rebuilt only when the
+.semd files change, so the observed data in REF_SEIS is converted once and
+reused by every iteration.
+"""
+import os
+import glob
+import json
+import numpy as np
+
+STORE_NAME = 'seismograms'
+
+
+def read_semd(filename):
+    """
+    Read a two-column (time, amplitude) .semd file. Returns (t0, dt, data).
+    """
+    values = np.fromfile(filename, sep=' ')
+    if values.size < 4 or values.size % 2:
+        raise ValueError(f"{filename}: expected two columns of at least two samples, got {values.size} values")
+    values = values.reshape((-1, 2))
+    t0 = values[0, 0]
+    dt = round((values[-1, 0] - t0) / (values.shape[0] - 1), 6)
+    return float(t0), dt, values[:, 1]
+
+
+def trace_sources(trace_dir, pattern='*.semd'):
+    """
+    Names and [size, mtime_ns] of the .semd files of a directory, sorted by name.
+    """
+    sources = {}
+    for filename in sorted(glob.glob(os.path.join(trace_dir, pattern))):
+        stat = os.stat(filename)
+        sources[os.path.basename(filename)] = [stat.st_size, stat.st_mtime_ns]
+    return sources
+
+
+def build_store(trace_dir, pattern='*.semd', dtype='float64'):
+    """
+    Convert the .semd files of trace_dir into the binary store and return its index.
+    """
+    sources = trace_sources(trace_dir, pattern)
+    names = list(sources)
+    if not names:
+        raise ValueError(f"no {pattern} files in {trace_dir}")
+    traces = [read_semd(os.path.join(trace_dir, name)) for name in names]
+    nt = traces[0][2].size
+    for name, (t0, dt, data) in zip(names, traces):
+        if data.size != nt:
+            raise ValueError(f"{os.path.join(trace_dir, name)}: {data.size} samples, expected {nt}")
+
+    data_file = os.path.join(trace_dir, f'{STORE_NAME}.npy')
+    tmp_file = f'{data_file}.{os.getpid()}.tmp'
+    data = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=dtype, shape=(len(names), nt))
+    for row, (t0, dt, values) in enumerate(traces):
+        data[row] = values
+    data.flush()
+    del data
+    os.replace(tmp_file, data_file)
+
+    index = {'names': names, 't0': [t[0] for t in traces], 'dt': [t[1] for t in traces],
+             'nt': nt, 'sources': sources}
+    index_file = os.path.join(trace_dir, f'{STORE_NAME}.json')
+    with open(f'{index_file}.{os.getpid()}.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(f'{index_file}.{os.getpid()}.tmp', index_file)
+    return index
+
+
+def refresh_store(trace_dir, pattern='*.semd'):
+    """
+    Build the store of trace_dir unless it is up to date with the .semd files.
+    Returns True if it was (re)built.
+    """
+    index_file = os.path.join(trace_dir, f'{STORE_NAME}.json')
+    if os.path.exists(index_file) and os.path.exists(os.path.join(trace_dir, f'{STORE_NAME}.npy')):
+        with open(index_file) as f:
+            if json.load(f)['sources'] == trace_sources(trace_dir, pattern):
+                return False
+    build_store(trace_dir, pattern)
+    return True
+
+
+class SeismogramStore:
+    """
+    Read access to the store of one directory; traces are memmap rows.
+    """
+    def __init__(self, trace_dir):
+        self.trace_dir = trace_dir
+        with open(os.path.join(trace_dir, f'{STORE_NAME}.json')) as f:
+            index = json.load(f)
+        self.names = index['names']
+        self.t0 = index['t0']
+        self.dt = index['dt']
+        self.rows = {name: row for row, name in enumerate(self.names)}
+        self.data = np.load(os.path.join(trace_dir, f'{STORE_NAME}.npy'), mmap_mode='r')
+
+    def trace(self, name):
+        """
+        Return (t0, dt, data) of the trace read from the .semd file `name`.
+        """
+        row = self.rows[name]
+        return self.t0[row], self.dt[row], self.data[row]
+
+
+def open_store(trace_dir, pattern='*.semd'):
+    """
+    Refresh the store of trace_dir if needed and open it.
+    """
+    refresh_store(trace_dir, pattern)
+    return SeismogramStore(trace_dir)
@@ -0,0 +1,213 @@
+"""
+Kernel clipping and Gaussian smoothing on the GLL points, in place of the
+xclip_sem and xsmooth_sem runs of smooth_kernel.sh.
+
+Like smooth_kernel.sh, the summed alpha kernel is clipped to CLIP_RANGE and
+smoothed twice, and the summed hess kernel is smoothed twice without clipping:
+
+    proc*_alpha_kernel_summed.bin -> _clip.bin -> _clip_smooth.bin -> _clip_smooth_smooth.bin
+    proc*_hess_kernel_summed.bin  -> _smooth.bin -> _smooth_smooth.bin
+
+so gauss_newton_update reads the results unchanged. The smoothing follows
+xsmooth_sem: the widths are converted to the standard deviations
+sigma = width / sqrt(8), and every GLL point becomes the average of the kernel
+over the GLL points of the neighbouring elements, weighted by
+
+    exp(-dh^2 / (2 sigma_h^2) - dv^2 / (2 sigma_v^2)) * jacobian * GLL weights
+
+where dh and dv are the horizontal and vertical distances. Neighbouring elements
+are those whose centers are within 3 sigma plus the element size horizontally
+and vertically; they are found with a k-d tree over the element centers of the
+slice and of the parts of other slices within reach, so the smoothing crosses
+slice boundaries. The mesh coordinates come from the GLL coordinate cache of
+gll_coordinates_model_modify.py. Slices are smoothed in parallel.
+
+Usage: python smoothing.py INPUT_DIR OUTPUT_DIR [--databases DATABASES_MPI] [--processors 12] [--workers N]
+"""
+import os
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.spatial import cKDTree
+from fortran_io import read_record, write_record
+from gll_coordinates_model_modify import load_gll_coordinates, build_gll_cache, GLL_CACHE_DIR
+
+NGLL = 5
+# GLL points and weights of degree 4 on [-1, 1]
+GLL_POINTS = np.array([-1.0, -np.sqrt(3 / 7), 0.0, np.sqrt(3 / 7), 1.0])
+GLL_WEIGHTS = np.array([1 / 10, 49 / 90, 32 / 45, 49 / 90, 1 / 10])
+# Horizontal and vertical smoothing widths [m] of smooth_kernel.sh; sigma = width / sqrt(8)
+WIDTH_H = 2000.0
+WIDTH_V = 1200.0
+CLIP_RANGE = (-5e-11, 5e-11)
+# Kernels smoothed by smooth_kernel.sh and whether they are clipped first
+SMOOTHED_KERNELS = [('alpha', True), ('hess', False)]
+
+
+def gll_derivatives():
+    """
+    D[i, j]: derivative of the j-th Lagrange polynomial of the GLL points at point i.
+    """
+    difference = GLL_POINTS[:, None] - GLL_POINTS[None, :]
+    np.fill_diagonal(difference, 1.0)
+    barycentric = difference.prod(axis=1)
+    derivatives = barycentric[:, None] / barycentric[None, :] / difference
+    np.fill_diagonal(derivatives, 0.0)
+    np.fill_diagonal(derivatives, -derivatives.sum(axis=1))
+    return derivatives
+
+
+def volume_weights(xyz):
+    """
+    Jacobian times GLL weights of every GLL point, for coordinates of shape
+    (3, nspec, 5, 5, 5) stored as [ispec, k, j, i].
+    """
+    derivatives = gll_derivatives()
+    xyz = np.asarray(xyz, dtype='float64')
+    # jacobian[..., c, a]: derivative of coordinate c along the reference axis a (xi, eta, gamma)
+    jacobian = np.stack([np.einsum('il,cekjl->ekjic', derivatives, xyz),
+                         np.einsum('jl,cekli->ekjic', derivatives, xyz),
+                         np.einsum('kl,celji->ekjic', derivatives, xyz)], axis=-1)
+    weights = GLL_WEIGHTS[:, None, None] * GLL_WEIGHTS[None, :, None] * GLL_WEIGHTS[None, None, :]
+    return np.abs(np.linalg.det(jacobian)) * weights
+
+
+def slice_bounds(databases_dir, processor_id, cache_dir=GLL_CACHE_DIR):
+    """
+    Lower and upper corner of a slice and the largest extent of its elements.
+    """
+    xyz = load_gll_coordinates(databases_dir, processor_id, cache_dir)
+    points = xyz.reshape(3, xyz.shape[1], -1)
+    element_size = (points.max(axis=2) - points.min(axis=2)).max() if points.shape[1] else 0.0
+    return points.min(axis=(1, 2)), points.max(axis=(1, 2)), float(element_size)
+
+
+def kernel_file(directory, processor_id, name):
+    return os.path.join(directory, f'proc{processor_id}_{name}.bin')
+
+
+def smooth_slice(processor_id, kernels, output_dir, bounds, databases_dir='DATABASES_MPI',
+                 width_h=WIDTH_H, width_v=WIDTH_V, cache_dir=GLL_CACHE_DIR):
+    """
+    Smooth the (directory, name) kernels, e.g. (SUMMED_KERNELS, alpha_kernel_summed_clip), of
+    one slice and write them to output_dir as <name>_smooth.bin; all share the same weights.
+    bounds holds slice_bounds of every slice, by processor ID.
+    """
+    sigma_h, sigma_v = width_h / np.sqrt(8), width_v / np.sqrt(8)
+    element_size = max(size for lower, upper, size in bounds.values())
+    reach = np.array([3 * sigma_h + element_size] * 2 + [3 * sigma_v + element_size])
+    # Coordinates divided by sqrt(2) sigma, so the Gaussian is exp(-|distance|^2)
+    scale = np.sqrt(2) * np.array([sigma_h, sigma_h, sigma_v])
+
+    target = np.asarray(load_gll_coordinates(databases_dir, processor_id, cache_dir), dtype='float64')
+    nspec = target.shape[1]
+    target_points = target.reshape(3, nspec, -1).transpose(1, 2, 0) / scale
+    target_centers = target.reshape(3, nspec, -1).mean(axis=2).T
+    lower, upper = bounds[processor_id][0] - reach, bounds[processor_id][1] + reach
+
+    # GLL points, weighted kernel values and centers of all elements within reach
+    points, values, centers = [], [], []
+    for source_id, (source_lower, source_upper, size) in sorted(bounds.items()):
+        if np.any(source_lower > upper) or np.any(source_upper < lower):
+            continue
+        source = target if source_id == processor_id else load_gll_coordinates(databases_dir, source_id, cache_dir)
+        source_centers = np.asarray(source, dtype='float64').reshape(3, source.shape[1], -1).mean(axis=2).T
+        selected = np.flatnonzero(np.all((source_centers >= lower) & (source_centers <= upper), axis=1))
+        if not selected.size:
+            continue
+        source = np.asarray(source[:, selected], dtype='float64')
+        weights = volume_weights(source).reshape(selected.size, -1)
+        fields = np.stack([read_record(kernel_file(directory, source_id, name), mmap=True).reshape(-1, NGLL ** 3)
+                           [selected] for directory, name in kernels], axis=-1)
+        # Columns: weight * kernel of every name, then the weight for the normalization
+        values.append(np.concatenate([weights[..., None] * fields, weights[..., None]], axis=-1))
+        points.append(source.reshape(3, selected.size, -1).transpose(1, 2, 0) / scale)
+        centers.append(source_centers[selected])
+    # The Gaussian weights are formed in float32, which halves the time of the exp and the products
+    points, values, centers = np.concatenate(points), np.concatenate(values).astype('float32'), np.concatenate(centers)
+
+    tree = cKDTree(centers / reach)
+    neighbours = tree.query_ball_point(target_centers / reach, r=1.0, p=np.inf)
+    smoothed = np.empty((nspec, NGLL ** 3, len(kernels)))
+    for ispec, elements in enumerate(neighbours):
+        elements = np.array(elements)
+        horizontal = centers[elements, :2] - target_centers[ispec, :2]
+        elements = elements[np.einsum('ij,ij->i', horizontal, horizontal) <= reach[0] ** 2]
+        origin = target_points[ispec].mean(axis=0)
+        here = (target_points[ispec] - origin).astype('float32')
+        there = (points[elements].reshape(-1, 3) - origin).astype('float32')
+        distance = (np.einsum('ij,ij->i', here, here)[:, None] + np.einsum('ij,ij->i', there, there)[None, :]
+                    - 2 * here @ there.T)
+        # Exponents are capped at 80 so the weights stay normal float32 numbers; denormals are very slow
+        totals = np.exp(-np.clip(distance, 0, 80)) @ values[elements].reshape(-1, len(kernels) + 1)
+        smoothed[ispec] = totals[:, :-1] / totals[:, -1:].astype('float64')
+
+    os.makedirs(output_dir, exist_ok=True)
+    for index, (directory, name) in enumerate(kernels):
+        write_record(kernel_file(output_dir, processor_id, f'{name}_smooth'),
+                     smoothed[..., index].astype('float32').ravel())
+
+
+def clip_slice(processor_id, input_dir, output_dir, name, clip_range=CLIP_RANGE):
+    """
+    Clip one kernel of one slice to clip_range and write it as <name>_clip.bin, like xclip_sem.
+    """
+    kernel = read_record(kernel_file(input_dir, processor_id, name))
+    os.makedirs(output_dir, exist_ok=True)
+    write_record(kernel_file(output_dir, processor_id, f'{name}_clip'), np.clip(kernel, *clip_range))
+
+
+def smooth_kernels(input_dir='SUMMED_KERNELS', output_dir='SUMMED_KERNELS', databases_dir='DATABASES_MPI',
+                   processor_count=12, workers=1, width_h=WIDTH_H, width_v=WIDTH_V, clip_range=CLIP_RANGE,
+                   kernels=SMOOTHED_KERNELS, cache_dir=GLL_CACHE_DIR):
+    """
+    Clip and smooth the summed kernels of every slice twice, as smooth_kernel.sh does,
+    spread over `workers` processes.
+
+    Args:
+        input_dir (str): Directory of the proc*_<name>_kernel_summed.bin files.
+        output_dir (str): Directory for the clipped and smoothed kernels.
+        databases_dir (str): Directory of the mesh (proc*_ibool.bin, proc*_x.bin, ...).
+        width_h (float): Horizontal smoothing width [m], as given to xsmooth_sem.
+        width_v (float): Vertical smoothing width [m], as given to xsmooth_sem.
+        kernels (list): (name, clip) pairs; clipped kernels are clipped to clip_range first.
+    """
+    processor_ids = [f'{proc_id:06d}' for proc_id in range(processor_count)]
+    build_gll_cache(databases_dir, processor_count, cache_dir, workers)
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    def run(function, tasks):
+        # Every pass reads the results of the previous one on all slices, so it waits for all of them
+        if executor is None:
+            return [function(*task) for task in tasks]
+        return [future.result() for future in [executor.submit(function, *task) for task in tasks]]
+
+    try:
+        bounds = dict(zip(processor_ids, run(slice_bounds, [(databases_dir, processor_id, cache_dir)
+                                                            for processor_id in processor_ids])))
+        run(clip_slice, [(processor_id, input_dir, output_dir, f'{name}_kernel_summed', clip_range)
+                         for name, clip in kernels if clip for processor_id in processor_ids])
+        sources = [(output_dir, f'{name}_kernel_summed_clip') if clip else (input_dir, f'{name}_kernel_summed')
+                   for name, clip in kernels]
+        for smoothing_pass in range(2):
+            run(smooth_slice, [(processor_id, sources, output_dir, bounds, databases_dir, width_h, width_v, cache_dir)
+                               for processor_id in processor_ids])
+            sources = [(output_dir, f'{name}_smooth') for directory, name in sources]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    print(f"Smoothed {', '.join(name for directory, name in sources)} of {processor_count} slices in {output_dir}.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Clip and smooth summed kernels like smooth_kernel.sh.')
+    parser.add_argument('input_dir')
+    parser.add_argument('output_dir')
+    parser.add_argument('--databases', default='DATABASES_MPI', help='directory of the mesh files')
+    parser.add_argument('--processors', type=int, default=12, help='processor slices')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--width-h', type=float, default=WIDTH_H, help='horizontal smoothing width [m]')
+    parser.add_argument('--width-v', type=float, default=WIDTH_V, help='vertical smoothing width [m]')
+    args = parser.parse_args()
+    smooth_kernels(args.input_dir, args.output_dir, args.databases, args.processors, args.workers, args.width_h,
+                   args.width_v)
@@ -0,0 +1,231 @@
+"""
+Per-stage timing and resource telemetry of inversion iterations.
+
+Every stage run inside `with measure_stage(name, iteration):` appends one JSON
+line to logs/telemetry.jsonl with its wall and CPU time, the bytes it read and
+wrote (/proc/self/io, plus getrusage blocks of finished child processes), its
+peak resident memory and whether it failed. The job monitor appends one line
+per finished Slurm job with the time it waited in the queue and the time it
+ran (from sacct, or from the polls when sacct has no times); job lines carry
+the iteration and stage they were waited on in.
+
+    {"kind": "stage", "stage": "forward", "iteration": 7, "wall_s": 1893.2, ...}
+    {"kind": "job", "job_id": "123", "name": "EVENT1", "stage": "forward", "iteration": 7,
+     "pending_s": 1604.0, "running_s": 271.0, ...}
+
+The log is append-only; compare iterations with
+
+    python telemetry.py report [--file logs/telemetry.jsonl] [--iterations 7 8 9]
+"""
+import os
+import json
+import time
+import socket
+import argparse
+import datetime
+import resource
+import contextlib
+import contextvars
+
+TELEMETRY_FILE = os.path.join('logs', 'telemetry.jsonl')
+# Stages open in the current thread or asyncio task, innermost last
+_open_stages = contextvars.ContextVar('open_stages', default=())
+
+
+def open_stage():
+    """
+    The innermost open stage of the current thread or task ({'stage', 'iteration', ...}), or None.
+    """
+    stages = _open_stages.get()
+    return stages[-1] if stages else None
+
+
+def record(kind, filename=TELEMETRY_FILE, **fields):
+    """
+    Append one record to the telemetry log. The iteration and stage of the
+    innermost open stage are added unless given.
+    """
+    stage = open_stage()
+    if stage is not None:
+        fields.setdefault('iteration', stage['iteration'])
+        fields.setdefault('stage', stage['stage'])
+    line = json.dumps(dict({'kind': kind, 'time': str(datetime.datetime.now()), 'host': socket.gethostname(),
+                            'pid': os.getpid()}, **fields))
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    # A single write of a line to a file opened for appending is not interleaved with other writers
+    with open(filename, 'a') as f:
+        f.write(line + '\n')
+
+
+def io_counters():
+    """
+    {read_bytes, write_bytes, rchar, wchar} of this process, or {} if /proc/self/io
+    is not readable.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            return dict((key, int(value)) for key, value in (line.split(':') for line in f))
+    except OSError:
+        return {}
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process since the last reset, in MB.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident memory to the current one (Linux 4.0+); ignored elsewhere.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+@contextlib.contextmanager
+def measure_stage(stage, iteration=None, filename=TELEMETRY_FILE, **fields):
+    """
+    Measure the enclosed block and append a "stage" record; a failing block is
+    recorded with status "failed" and its error, and the exception is re-raised.
+    Stages may be nested: the peak memory of an outer stage includes the inner ones.
+    Nesting is tracked per thread and asyncio task, so stages running concurrently
+    (e.g. the per-event stages of pipeline.py) are not nested in each other; their
+    I/O and memory figures, which are per process, overlap.
+    """
+    stages = _open_stages.get()
+    if stages:
+        stages[-1]['peak_rss_mb'] = max(stages[-1]['peak_rss_mb'], peak_rss_mb())
+    reset_peak_rss()
+    frame = {'stage': stage, 'iteration': iteration, 'peak_rss_mb': peak_rss_mb(), 'depth': len(stages)}
+    token = _open_stages.set(stages + (frame,))
+    io_start = io_counters()
+    usage_start = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+    start = time.perf_counter()
+    status, error = 'ok', None
+    try:
+        yield frame
+    except BaseException as exception:
+        status, error = 'failed', f'{type(exception).__name__}: {exception}'
+        raise
+    finally:
+        wall = time.perf_counter() - start
+        _open_stages.reset(token)
+        peak = max(frame['peak_rss_mb'], peak_rss_mb())
+        if stages:
+            stages[-1]['peak_rss_mb'] = max(stages[-1]['peak_rss_mb'], peak)
+        io_end = io_counters()
+        usage_end = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+        cpu = sum(end.ru_utime + end.ru_stime - begin.ru_utime - begin.ru_stime
+                  for begin, end in zip(usage_start, usage_end))
+        children_start, children_end = usage_start[1], usage_end[1]
+        measured = {'wall_s': wall, 'cpu_s': cpu, 'peak_rss_mb': peak, 'depth': frame['depth'],
+                    'children_read_bytes': 512 * (children_end.ru_inblock - children_start.ru_inblock),
+                    'children_write_bytes': 512 * (children_end.ru_oublock - children_start.ru_oublock),
+                    'status': status}
+        if children_end.ru_maxrss > children_start.ru_maxrss:
+            measured['children_peak_rss_mb'] = children_end.ru_maxrss / 1024
+        for key in ['read_bytes', 'write_bytes', 'rchar', 'wchar']:
+            if key in io_start and key in io_end:
+                measured[key] = io_end[key] - io_start[key]
+        if error:
+            measured['error'] = error
+        record('stage', filename, stage=stage, iteration=iteration, **dict(fields, **measured))
+
+
+def read_records(filename=TELEMETRY_FILE):
+    """
+    All records of a telemetry log; lines cut off by a crash are skipped.
+    """
+    records = []
+    with open(filename) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def summarize(records, iterations=None):
+    """
+    Per (iteration, stage): wall time, bytes read and written, peak memory and the
+    queue and run times of its jobs. Reruns of a stage are added up.
+    """
+    summary = {}
+    for entry in records:
+        iteration = entry.get('iteration')
+        if entry['kind'] not in ('stage', 'job') or iteration is None or (iterations and iteration not in iterations):
+            continue
+        row = summary.setdefault((iteration, entry.get('stage')), {
+            'wall_s': 0.0, 'read_bytes': 0, 'write_bytes': 0, 'peak_rss_mb': 0.0, 'failed': 0,
+            'jobs': 0, 'pending_s': [], 'running_s': [], 'nested': False})
+        if entry['kind'] == 'stage':
+            row['wall_s'] += entry['wall_s']
+            row['nested'] = entry.get('depth', 0) > 0
+            row['read_bytes'] += entry.get('read_bytes', 0) + entry.get('children_read_bytes', 0)
+            row['write_bytes'] += entry.get('write_bytes', 0) + entry.get('children_write_bytes', 0)
+            row['peak_rss_mb'] = max(row['peak_rss_mb'], entry['peak_rss_mb'], entry.get('children_peak_rss_mb', 0))
+            row['failed'] += entry['status'] != 'ok'
+        elif entry['kind'] == 'job':
+            row['jobs'] += 1
+            if entry.get('pending_s') is not None:
+                row['pending_s'].append(entry['pending_s'])
+            if entry.get('running_s') is not None:
+                row['running_s'].append(entry['running_s'])
+    return summary
+
+
+def report(filename=TELEMETRY_FILE, iterations=None):
+    """
+    Print the stage wall times of every iteration side by side, then per stage
+    the I/O, memory and job queue/run times.
+    """
+    summary = summarize(read_records(filename), iterations)
+    stages = []
+    for iteration, stage in summary:
+        if stage not in stages:
+            stages.append(stage)
+    iteration_list = sorted(set(iteration for iteration, stage in summary))
+
+    print('wall time [s]')
+    print(f"{'iteration':>9} " + ' '.join(f'{str(stage):>15}' for stage in stages) + f" {'total':>10}  slowest")
+    for iteration in iteration_list:
+        rows = [summary.get((iteration, stage)) for stage in stages]
+        walls = [row['wall_s'] if row is not None else None for row in rows]
+        # Nested stages are part of their outer stage's time
+        total = sum(row['wall_s'] for row in rows if row is not None and not row['nested'])
+        slowest = max(((wall, str(stage)) for wall, stage in zip(walls, stages) if wall is not None), default=(0, '-'))[1]
+        print(f"{iteration:>9} " + ' '.join(f'{wall:>15.1f}' if wall is not None else f"{'-':>15}" for wall in walls)
+              + f" {total:>10.1f}  {slowest}")
+
+    print()
+    print(f"{'iteration':>9} {'stage':>15} {'read GB':>9} {'write GB':>9} {'peak MB':>9} {'jobs':>5} "
+          f"{'queue mean/max [s]':>19} {'run mean/max [s]':>17}")
+    for (iteration, stage), row in sorted(summary.items(), key=lambda item: (item[0][0], stages.index(item[0][1]))):
+        queue = (f"{sum(row['pending_s']) / len(row['pending_s']):.0f}/{max(row['pending_s']):.0f}"
+                 if row['pending_s'] else '-')
+        run = f"{sum(row['running_s']) / len(row['running_s']):.0f}/{max(row['running_s']):.0f}" if row['running_s'] else '-'
+        failed = f"  ({row['failed']} failed)" if row['failed'] else ''
+        print(f"{iteration:>9} {str(stage):>15} {row['read_bytes'] / 1e9:>9.3f} {row['write_bytes'] / 1e9:>9.3f} "
+              f"{row['peak_rss_mb']:>9.1f} {row['jobs']:>5} {queue:>19} {run:>17}{failed}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report the telemetry of inversion iterations.')
+    parser.add_argument('command', choices=['report'])
+    parser.add_argument('--file', default=TELEMETRY_FILE)
+    parser.add_argument('--iterations', type=int, nargs='+', default=None)
+    args = parser.parse_args()
+    report(args.file, args.iterations)
@@ -0,0 +1,19 @@
+"""
+Shared test setup: the repository on sys.path and a small synthetic SPECFEM tree.
+"""
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.synthetic_mesh import make_tree
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """
+    A synthetic tree (see benchmarks/synthetic_mesh.py) of 2 slices of 64 elements
+    and 3 events under tmp_path, returned as a string.
+    """
+    make_tree(str(tmp_path), nspec=64, processor_count=2, event_count=3, stations=1, nt=10)
+    return str(tmp_path)
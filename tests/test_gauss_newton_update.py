@@ -0,0 +1,28 @@
+"""
+The blocked gauss_newton_update against the concatenate version it replaced.
+"""
+import os
+import numpy as np
+from Inversion import gauss_newton_update
+
+
+def test_gauss_newton_update_matches_concatenate_version(tree, monkeypatch):
+    # The updated model is staged to DATABASES_MPI in the current directory
+    monkeypatch.chdir(tree)
+    gauss_newton_update('MODEL_1_test', 'SUMMED_KERNELS', 'MODEL_2_test', perturb_vp=0.5, perturb_vs=0.25,
+                        processor_count=2, update_vs=True, block_size=1000)
+
+    for proc_id in range(2):
+        prefix = f'proc{proc_id:06d}'
+        hessian = np.fromfile(os.path.join('SUMMED_KERNELS', f'{prefix}_hess_kernel_summed_smooth_smooth.bin'),
+                              dtype='float32')[1:-1]
+        for name, kernel_name, step, water_level in [('vp', 'alpha', 0.5, 5e-14), ('vs', 'beta', 0.25, 0.0)]:
+            model = np.fromfile(os.path.join('MODEL_1_test', f'{prefix}_{name}.bin'), dtype='float32')
+            kernel_file = os.path.join('SUMMED_KERNELS', f'{prefix}_{kernel_name}_kernel_summed_clip_smooth_smooth.bin')
+            kernel = np.fromfile(kernel_file, dtype='float32')[1:-1]
+            expected = np.concatenate(([model[0]], model[1:-1] - step * kernel / (hessian + water_level), [model[-1]]))
+            updated = np.fromfile(os.path.join('MODEL_2_test', f'{prefix}_{name}.bin'), dtype='float32')
+            assert updated.view('int32')[0] == updated.view('int32')[-1] == model.view('int32')[0]
+            np.testing.assert_allclose(updated[1:-1], expected[1:-1], rtol=1e-6)
+            staged = np.fromfile(os.path.join('DATABASES_MPI', f'{prefix}_{name}.bin'), dtype='float32')
+            np.testing.assert_array_equal(staged, updated)
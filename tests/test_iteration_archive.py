@@ -0,0 +1,30 @@
+"""
+Archiving iterations and restoring them gives back files with the same sha1.
+"""
+import os
+from iteration_archive import IterationArchive
+from model_staging import file_sha1
+from fortran_io import read_record, write_record
+
+
+def test_archive_restore_round_trip(tree, monkeypatch):
+    # Paths in the archive are relative to the inversion directory
+    monkeypatch.chdir(tree)
+    os.makedirs('MODEL_2_test')
+    for proc_id in range(2):
+        for name in ['vp', 'vs']:
+            model = read_record(os.path.join('MODEL_1_test', f'proc{proc_id:06d}_{name}.bin'))
+            model[::7] *= 1.001
+            write_record(os.path.join('MODEL_2_test', f'proc{proc_id:06d}_{name}.bin'), model)
+
+    archive = IterationArchive('ARCHIVE')
+    # MODEL_2_test is delta-encoded against MODEL_1_test
+    archive.archive_iteration(1, ['MODEL_1_test', 'SUMMED_KERNELS'])
+    archive.archive_iteration(2, ['MODEL_2_test', os.path.join('EVENT1', 'REF_SEIS')])
+
+    for iteration in [1, 2]:
+        files = archive.manifest(iteration)
+        archive.restore(iteration, 'restored')
+        for path in files:
+            assert file_sha1(os.path.join('restored', path)) == file_sha1(path), path
+    assert archive.meta(archive.manifest(2)[os.path.join('MODEL_2_test', 'proc000000_vp.bin')])['base'] is not None
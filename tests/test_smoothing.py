@@ -0,0 +1,28 @@
+"""
+smooth_kernels on constant kernels, which clipping and smoothing must keep constant.
+"""
+import os
+import numpy as np
+from smoothing import smooth_kernels, CLIP_RANGE
+from fortran_io import read_record, write_record
+
+
+def test_smooth_kernels_keeps_constant_field(tree):
+    kernel_dir = os.path.join(tree, 'SUMMED_KERNELS')
+    size = read_record(os.path.join(tree, 'MODEL_1_test', 'proc000000_vp.bin')).size
+    for proc_id in range(2):
+        # alpha is above the clip range, so it is clipped to its upper end before smoothing
+        write_record(os.path.join(kernel_dir, f'proc{proc_id:06d}_alpha_kernel_summed.bin'),
+                     np.full(size, 2 * CLIP_RANGE[1], dtype='float32'))
+        write_record(os.path.join(kernel_dir, f'proc{proc_id:06d}_hess_kernel_summed.bin'),
+                     np.full(size, 3.0, dtype='float32'))
+    smooth_kernels(kernel_dir, kernel_dir, os.path.join(tree, 'DATABASES_MPI'), processor_count=2, workers=2,
+                   cache_dir=os.path.join(tree, 'gll_cache'))
+
+    for proc_id in range(2):
+        alpha = read_record(os.path.join(kernel_dir, f'proc{proc_id:06d}_alpha_kernel_summed_clip_smooth_smooth.bin'),
+                            count=size)
+        hess = read_record(os.path.join(kernel_dir, f'proc{proc_id:06d}_hess_kernel_summed_smooth_smooth.bin'),
+                           count=size)
+        np.testing.assert_allclose(alpha, CLIP_RANGE[1], rtol=1e-5)
+        np.testing.assert_allclose(hess, 3.0, rtol=1e-5)
@@ -0,0 +1,46 @@
+"""
+stack_kernels against the per-kernel np.fromfile sums it replaced, and with
+any number of workers against one worker.
+"""
+import os
+import numpy as np
+from Inversion import stack_kernels
+
+KERNEL_NAMES = ['alpha', 'beta', 'hess']
+
+
+def event_dirs(tree):
+    return [os.path.join(tree, f'EVENT{event}') for event in range(1, 4)]
+
+
+def test_stack_kernels_matches_fromfile_sums(tree):
+    output_dir = os.path.join(tree, 'SUMMED')
+    # Small chunks, so every slice is streamed in several chunks
+    stack_kernels(event_dirs(tree), KERNEL_NAMES, output_dir, processor_count=2, chunk_size=1000)
+
+    for proc_id in range(2):
+        for name in KERNEL_NAMES:
+            kernels = [np.fromfile(os.path.join(event_dir, 'DATABASES_MPI', f'proc{proc_id:06d}_{name}_kernel.bin'),
+                                   dtype='float32') for event_dir in event_dirs(tree)]
+            expected = kernels[0][1:-1].copy()
+            for kernel in kernels[1:]:
+                expected += kernel[1:-1]
+            summed_file = os.path.join(output_dir, f'proc{proc_id:06d}_{name}_kernel_summed.bin')
+            summed = np.fromfile(summed_file, dtype='float32')
+            # The record markers are copied from the first event
+            np.testing.assert_array_equal(summed.view('int32')[[0, -1]], kernels[0].view('int32')[[0, -1]])
+            np.testing.assert_allclose(summed[1:-1], expected, rtol=1e-5, atol=1e-16)
+
+
+def test_stack_kernels_is_bit_identical_for_any_worker_count(tree):
+    serial_dir, parallel_dir = os.path.join(tree, 'SERIAL'), os.path.join(tree, 'PARALLEL')
+    stack_kernels(event_dirs(tree), KERNEL_NAMES, serial_dir, processor_count=2, chunk_size=1000, workers=1)
+    # More workers than slices, so every slice is split into value ranges
+    stack_kernels(event_dirs(tree), KERNEL_NAMES, parallel_dir, processor_count=2, chunk_size=1000, workers=5)
+
+    assert sorted(os.listdir(parallel_dir)) == sorted(os.listdir(serial_dir))
+    for name in os.listdir(serial_dir):
+        with open(os.path.join(serial_dir, name), 'rb') as f:
+            expected = f.read()
+        with open(os.path.join(parallel_dir, name), 'rb') as f:
+            assert f.read() == expected, name